@@ -5,15 +5,52 @@ import uuid
 import firebase_admin
 from firebase_admin import credentials, firestore
 from datetime import datetime
+from dataclasses import dataclass
+from types import MappingProxyType
 import numpy as np
 import zipfile
 import io
 import json
+import re
+import bisect
+import unicodedata
+import hashlib
+import sys
+import pickle
+import stat
+import tempfile
+import os
+import time
+import random
+import queue
+import collections
+import functools
+import threading
+import multiprocessing
+import atexit
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 
 # --- IMPORTS AJOUTÉS POUR GOOGLE DRIVE ---
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient import discovery_cache
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+import httplib2
+import google_auth_httplib2
+
+import image_processing
+import form_normalization
+import photo_spool
+import outbox
+import report_builder
+import settings
+
+# Début de l'exécution du script (mesure du temps de rendu, voir MESURE DU TEMPS DE RENDU)
+_RUN_STARTED = time.perf_counter()
 
 # --- CONFIGURATION ET STYLE (inchangés) ---
 st.set_page_config(page_title="Formulaire Dynamique - Firestore", layout="centered")
@@ -35,30 +72,16 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# --- LOGIQUE DE RENOMMAGE ET D'AFFICHAGE DU PROJET (inchangée) ---
-
-PROJECT_RENAME_MAP = {
-    'Intitulé': 'Intitulé',
-    'Fournisseur Bornes AC [Bornes]': 'Fournisseur Bornes AC',
-    'Fournisseur Bornes DC [Bornes]': 'Fournisseur Bornes DC',
-    'L [Plan de Déploiement]': 'PDC Lent',
-    'R [Plan de Déploiement]': 'PDC Rapide',
-    'UR [Plan de Déploiement]': 'PDC Ultra-rapide',
-    'Pré L [Plan de Déploiement]': 'PDC L pré-équipés',
-    'Pré R [Plan de Déploiement]': 'PDC R pré-équipés',
-    'Pré UR [Plan de Déploiement]': 'PDC UR pré-équipés',
-}
+# --- LOGIQUE DE RENOMMAGE ET D'AFFICHAGE DU PROJET (inchangée, partagée avec les scripts) ---
 
-DISPLAY_GROUPS = [
-    ['Intitulé', 'Fournisseur Bornes AC [Bornes]', 'Fournisseur Bornes DC [Bornes]'],
-    ['L [Plan de Déploiement]', 'R [Plan de Déploiement]', 'UR [Plan de Déploiement]'],
-    ['Pré L [Plan de Déploiement]', 'Pré R [Plan de Déploiement]','Pré UR [Plan de Déploiement]' ],
-]
+PROJECT_RENAME_MAP = settings.PROJECT_RENAME_MAP
+DISPLAY_GROUPS = settings.DISPLAY_GROUPS
 
 # -----------------------------------------------------------
-# --- LOGIQUE D'ATTENTE DE PHOTOS (inchangée) ---
+# --- LOGIQUE D'ATTENTE DE PHOTOS ---
 # -----------------------------------------------------------
 
+# Règles par défaut, utilisées si le document Firestore des règles est absent ou illisible
 SECTION_PHOTO_RULES = {
     "Bornes DC": ['R [Plan de Déploiement]', 'UR [Plan de Déploiement]'],
     "Bornes AC": ['L [Plan de Déploiement]'],
@@ -89,216 +112,2477 @@ def get_expected_photo_count(section_name, project_data):
     detail_str = " + ".join(details)
     return total_expected, detail_str
 
-# --- INITIALISATION FIREBASE SÉCURISÉE (inchangée) ---
+# --- INITIALISATION FIREBASE SÉCURISÉE ---
+
+@st.cache_resource
 def initialize_firebase():
-    if not firebase_admin._apps:
-        try:
-            cred_dict = {
-                "type": st.secrets["firebase_type"],
-                "project_id": st.secrets["firebase_project_id"],
-                "private_key_id": st.secrets["firebase_private_key_id"],
-                "private_key": st.secrets["firebase_private_key"].replace('\\n', '\n'),
-                "client_email": st.secrets["firebase_client_email"],
-                "client_id": st.secrets["firebase_client_id"],
-                "auth_uri": st.secrets["firebase_auth_uri"],
-                "token_uri": st.secrets["firebase_token_uri"],
-                "auth_provider_x509_cert_url": st.secrets["firebase_auth_provider_x509_cert_url"],
-                "client_x509_cert_url": st.secrets["firebase_client_x509_cert_url"],
-                "universe_domain": st.secrets["firebase_universe_domain"],
-            }
-            
-            project_id = cred_dict["project_id"]
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred, {'projectId': project_id})
-            st.sidebar.success("Connexion BDD réussie 🟢")
+    """
+    Client Firestore unique pour le processus (et non recréé à chaque rerun). Après
+    initialize_firebase.clear(), une nouvelle application Firebase est ouverte à côté de la
+    précédente, qui n'est jamais supprimée : les requêtes en cours des autres sessions et des
+    threads d'arrière-plan se terminent sur l'ancien client, les suivantes passent par get_db().
+    """
+    # Première application : celle par défaut ; les suivantes (après clear) portent un nom unique
+    app_name = firebase_admin._DEFAULT_APP_NAME if not firebase_admin._apps else f"firestore-{uuid.uuid4().hex[:8]}"
+    emulator_host = os.environ.get("FIRESTORE_EMULATOR_HOST")
+    if emulator_host:
+        # Tests locaux : le client Firestore se connecte de lui-même à l'émulateur
+        project_id = os.environ.get("GCLOUD_PROJECT", "demo-questionnaire")
+        app = firebase_admin.initialize_app(settings.EmulatorCredential(), {'projectId': project_id}, name=app_name)
+        st.sidebar.info(f"Émulateur Firestore : {emulator_host} 🧪")
+        return firestore.client(app)
+    try:
+        cred_dict = {
+            "type": st.secrets["firebase_type"],
+            "project_id": st.secrets["firebase_project_id"],
+            "private_key_id": st.secrets["firebase_private_key_id"],
+            "private_key": st.secrets["firebase_private_key"].replace('\\n', '\n'),
+            "client_email": st.secrets["firebase_client_email"],
+            "client_id": st.secrets["firebase_client_id"],
+            "auth_uri": st.secrets["firebase_auth_uri"],
+            "token_uri": st.secrets["firebase_token_uri"],
+            "auth_provider_x509_cert_url": st.secrets["firebase_auth_provider_x509_cert_url"],
+            "client_x509_cert_url": st.secrets["firebase_client_x509_cert_url"],
+            "universe_domain": st.secrets["firebase_universe_domain"],
+        }
         
-        except KeyError as e:
-            st.sidebar.error(f"Erreur de configuration Secrets : Clé manquante ({e})")
-            st.stop()
-        except Exception as e:
-            st.sidebar.error(f"Erreur de connexion Firebase : {e}")
-            st.stop()
-    return firestore.client()
+        project_id = cred_dict["project_id"]
+        cred = credentials.Certificate(cred_dict)
+        app = firebase_admin.initialize_app(cred, {'projectId': project_id}, name=app_name)
+        st.sidebar.success("Connexion BDD réussie 🟢")
+    
+    except KeyError as e:
+        st.sidebar.error(f"Erreur de configuration Secrets : Clé manquante ({e})")
+        st.stop()
+        raise  # Hors exécution du script (thread d'arrière-plan), st.stop() ne fait rien
+    except Exception as e:
+        st.sidebar.error(f"Erreur de connexion Firebase : {e}")
+        st.stop()
+        raise
+    return firestore.client(app)
+
+def get_db():
+    """Client Firestore courant, à relire à chaque usage (refresh_firestore_client le remplace)."""
+    return initialize_firebase()
 
-db = initialize_firebase()
+get_db()
+
+def refresh_firestore_client():
+    """
+    Nouveau client Firestore (jeton révoqué, clé tournée...) pour toutes les sessions et tous les
+    threads, sans supprimer l'application en cours d'utilisation.
+    """
+    initialize_firebase.clear()
+    client = get_db()
+    refresh_outbox_delivery()
+    return client
 
 # ---------------------------------------------------------
 # --- NOUVELLES FONCTIONS GOOGLE DRIVE (AJOUTÉES) ---
 # ---------------------------------------------------------
 
+def _drive_setting(key, default):
+    """Lit un paramètre optionnel de la section [google_drive] des secrets."""
+    try:
+        return st.secrets["google_drive"].get(key, default)
+    except Exception:
+        return default
+
+# Nombre d'uploads Drive simultanés (configurable via st.secrets["google_drive"]["upload_workers"])
+DRIVE_UPLOAD_WORKERS = max(1, int(_drive_setting("upload_workers", 4)))
+# Taille des morceaux de l'upload résumable (multiple de 256 Ko imposé par Drive)
+_DRIVE_CHUNK_ALIGN = 256 * 1024
+DRIVE_UPLOAD_CHUNK_SIZE = max(1, int(_drive_setting("upload_chunk_size", 4 * 1024 * 1024)) // _DRIVE_CHUNK_ALIGN) * _DRIVE_CHUNK_ALIGN
+# Nombre de reprises d'un même morceau après une erreur réseau ou serveur
+DRIVE_CHUNK_MAX_RETRIES = int(_drive_setting("upload_chunk_retries", 5))
+# Réutilisation d'un fichier Drive existant quand le même contenu a déjà été envoyé
+DRIVE_DEDUPLICATE = bool(_drive_setting("deduplicate", True))
+
+# Délai réseau d'une requête Drive (secondes)
+DRIVE_HTTP_TIMEOUT = int(_drive_setting("http_timeout", 120))
+
+# Serveur Drive de substitution pour les tests (ex. "http://localhost:8089/"), sinon l'API Google
+DRIVE_API_ENDPOINT = _drive_setting("api_endpoint", None)
+
+def _build_drive_service(creds):
+    if not DRIVE_API_ENDPOINT:
+        # Document de découverte embarqué : aucun aller-retour réseau pour construire le client
+        return build('drive', 'v3', credentials=creds, static_discovery=True, cache_discovery=False)
+    # Toutes les URL, upload compris (schéma http accepté), pointent vers le serveur de substitution
+    document = json.loads(discovery_cache.get_static_doc('drive', 'v3'))
+    root_url = DRIVE_API_ENDPOINT.rstrip('/') + '/'
+    document['rootUrl'] = root_url
+    document['baseUrl'] = root_url + document['servicePath']
+    document.pop('mtlsRootUrl', None)
+    return build_from_document(document, credentials=creds)
+
+class DriveClient:
+    """
+    Service Drive partagé par le processus. httplib2 n'étant pas thread-safe, chaque requête
+    emprunte une connexion authentifiée à un pool (réutilisée d'un upload à l'autre) et la
+    passe explicitement à execute()/next_chunk().
+    """
+
+    def __init__(self, creds, pool_size):
+        self.credentials = creds
+        self.service = _build_drive_service(creds)
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _new_http(self):
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+
+    @contextmanager
+    def lease(self):
+        """Emprunte une connexion du pool (créée si le pool est vide)."""
+        try:
+            http = self._pool.get_nowait()
+        except queue.Empty:
+            http = self._new_http()
+        try:
+            yield http
+        finally:
+            try:
+                self._pool.put_nowait(http)
+            except queue.Full:
+                pass
+
+    def execute(self, request):
+        with self.lease() as http:
+            return request.execute(http=http)
+
+    def ensure_fresh(self):
+        """Rafraîchit le jeton du compte de service s'il est expiré ou absent."""
+        if not self.credentials.valid:
+            self.credentials.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT)))
+
+    def is_healthy(self):
+        """Appel léger (about.get) pour vérifier jeton et connectivité."""
+        try:
+            self.ensure_fresh()
+            self.execute(self.service.about().get(fields='user(emailAddress)'))
+            return True
+        except Exception:
+            return False
+
+def get_drive_credentials():
+    """Construit les identifiants du compte de service Drive."""
+    if DRIVE_API_ENDPOINT and "service_account_json" not in st.secrets.get("google_drive", {}):
+        return AnonymousCredentials()  # Serveur de substitution sans authentification
+    # On suppose que le JSON complet est dans st.secrets["google_drive"]["service_account_json"]
+    service_account_info = json.loads(st.secrets["google_drive"]["service_account_json"])
+    return service_account.Credentials.from_service_account_info(
+        service_account_info,
+        scopes=['https://www.googleapis.com/auth/drive']
+    )
+
+@st.cache_resource
+def get_drive_client():
+    """Client Drive unique pour le processus (identifiants, service et pool de connexions)."""
+    # Uploads de la sauvegarde + uploads d'arrière-plan peuvent tourner en même temps
+    return DriveClient(get_drive_credentials(), pool_size=2 * DRIVE_UPLOAD_WORKERS)
+
+def refresh_drive_client():
+    """Recrée le client Drive (identifiants révoqués, jeton non rafraîchissable...)."""
+    get_drive_client.clear()
+    drive = get_drive_client()
+    refresh_outbox_delivery()
+    return drive
+
 def get_drive_service():
     """Initialise et retourne le service Google Drive."""
     try:
-        # On suppose que le JSON complet est dans st.secrets["google_drive"]["service_account_json"]
-        service_account_info = json.loads(st.secrets["google_drive"]["service_account_json"])
-        
-        creds = service_account.Credentials.from_service_account_info(
-            service_account_info,
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        return build('drive', 'v3', credentials=creds)
+        drive = get_drive_client()
+        if not drive.is_healthy():
+            drive = refresh_drive_client()
+        return drive.service
     except Exception as e:
         st.error(f"Erreur d'initialisation Google Drive : {e}")
         return None
 
-def upload_file_to_drive(file_obj, project_name, phase_name, drive_service):
-    """Uploade un fichier vers Drive et retourne son lien."""
+def build_drive_file_name(file_obj, project_name, phase_name):
+    """Nom du fichier sur Drive : projet_phase_nomorigine (caractères spéciaux nettoyés)."""
+    sanitized_project = str(project_name).replace(' | ', '_').replace(' ', '_').replace('/', '_')
+    sanitized_phase = str(phase_name).replace(' ', '_').replace('/', '_')
+    return f"{sanitized_project}_{sanitized_phase}_{file_obj.name}"
+
+class BufferReader(io.RawIOBase):
+    """
+    Lecteur en lecture seule sur le tampon d'un fichier chargé (memoryview, sans copie).
+    Chaque upload a son propre curseur : pas de course sur le seek() du fichier d'origine.
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        self._pos = max(0, min(self._pos, len(self._view)))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+def open_upload_stream(file_obj):
+    """Flux de lecture sans copie du contenu d'un fichier chargé."""
+    if isinstance(file_obj, photo_spool.PhotoHandle):
+        return file_obj.open()  # Lu par morceaux, fermé après l'upload
+    if hasattr(file_obj, 'getbuffer'):
+        return BufferReader(file_obj.getbuffer())
+    file_obj.seek(0)
+    return file_obj
+
+def _stream_md5(stream, chunk_size=DRIVE_UPLOAD_CHUNK_SIZE):
+    """MD5 calculé morceau par morceau (mémoire bornée), curseur remis au début."""
+    md5 = hashlib.md5()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        md5.update(chunk)
+    stream.seek(0)
+    return md5.hexdigest()
+
+def _is_retryable_upload_error(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in (408, 429, 500, 502, 503, 504)
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+def _upload_to_drive(stream, mime_type, file_name, folder_id, drive):
+    """
+    Upload résumable par morceaux de DRIVE_UPLOAD_CHUNK_SIZE (sans appel Streamlit, utilisable
+    depuis un thread). Un morceau en échec est repris dans la même session d'upload, puis
+    le MD5 renvoyé par Drive est comparé au MD5 local. Retourne {'id', 'webViewLink', ...}.
+    Lève en cas d'erreur.
+    """
+    file_metadata = {
+        'name': file_name,
+        'parents': [folder_id]
+    }
+    local_md5 = _stream_md5(stream)
+    media = MediaIoBaseUpload(stream, mimetype=mime_type, chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=True)
+    
+    request = drive.service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id, webViewLink, md5Checksum'
+    )
+    uploaded_file = None
+    retries = 0
+    with drive.lease() as http:
+        while uploaded_file is None:
+            try:
+                _, uploaded_file = request.next_chunk(http=http)
+                retries = 0
+            except Exception as e:
+                if not _is_retryable_upload_error(e) or retries >= DRIVE_CHUNK_MAX_RETRIES:
+                    raise
+                retries += 1
+                # next_chunk() reprend à partir du dernier octet confirmé par Drive
+                time.sleep(min(2 ** retries, 30))
+
+    remote_md5 = uploaded_file.get('md5Checksum')
+    if remote_md5 and remote_md5 != local_md5:
+        try:
+            drive.execute(drive.service.files().delete(fileId=uploaded_file['id']))
+        except Exception:
+            pass
+        raise IOError(f"Somme MD5 différente après upload ({remote_md5} != {local_md5})")
+    return uploaded_file
+
+def upload_files_concurrently(jobs, project_name, max_workers=DRIVE_UPLOAD_WORKERS, on_progress=None, ledger=None):
+    """
+    Uploade une liste de (file_obj, phase_name) en parallèle (pool de threads borné).
+    Les fichiers déjà présents dans le registre `ledger` ne sont pas ré-uploadés.
+    Retourne (liens, erreurs) : liens[i] est le webViewLink du job i ou None en cas d'échec,
+    erreurs est une liste de messages. on_progress(terminés, total, nom_fichier, ok) est appelé
+    depuis le thread principal après chaque fichier.
+    """
+    links = [None] * len(jobs)
+    errors = []
+    if not jobs:
+        return links, errors
+
+    context = delivery_context()
+
+    def _worker(file_obj, phase_name):
+        file_name = build_drive_file_name(file_obj, project_name, phase_name)
+        return _upload_with_ledger(file_obj, file_name, context, ledger)
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = {executor.submit(_worker, f, phase): i for i, (f, phase) in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            file_obj = jobs[i][0]
+            try:
+                links[i] = future.result()
+            except Exception as e:
+                errors.append(f"Erreur upload Drive pour {file_obj.name}: {e}")
+            done += 1
+            if on_progress:
+                on_progress(done, len(jobs), file_obj.name, links[i] is not None)
+    return links, errors
+
+
+# --- PRÉ-TRAITEMENT DES IMAGES AVANT UPLOAD ---
+
+def _image_setting(key, default):
+    """Lit un paramètre optionnel de la section [image_processing] des secrets."""
     try:
-        DRIVE_FOLDER_ID = st.secrets["google_drive"]["target_folder_id"]
-        
-        # Nettoyage du nom pour éviter les caractères spéciaux
-        sanitized_project = str(project_name).replace(' | ', '_').replace(' ', '_').replace('/', '_')
-        sanitized_phase = str(phase_name).replace(' ', '_').replace('/', '_')
-        file_name = f"{sanitized_project}_{sanitized_phase}_{file_obj.name}"
-        
-        file_metadata = {
-            'name': file_name,
-            'parents': [DRIVE_FOLDER_ID]
+        return st.secrets["image_processing"].get(key, default)
+    except Exception:
+        return default
+
+IMAGE_PROCESSING_ENABLED = bool(_image_setting("enabled", True)) and image_processing.is_available()
+IMAGE_MAX_EDGE = int(_image_setting("max_edge", 2048))
+IMAGE_JPEG_QUALITY = int(_image_setting("jpeg_quality", 82))
+IMAGE_KEEP_EXIF = bool(_image_setting("keep_exif", False))
+IMAGE_PROCESSING_WORKERS = max(1, int(_image_setting("workers", min(4, os.cpu_count() or 1))))
+
+def _start_process_pool(max_workers):
+    """ProcessPoolExecutor 'spawn' (pas de fork d'un serveur Streamlit multi-threadé), arrêté à la sortie du processus."""
+    pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    atexit.register(pool.shutdown, wait=False, cancel_futures=True)
+    return pool
+
+class ImageProcessPool:
+    """
+    Pool de processus de recompression, remplacé s'il casse (processus tué...) sans repasser
+    par le cache Streamlit : les threads d'upload et de livraison en gardent la référence.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def current(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = _start_process_pool(self.max_workers)
+            return self._pool
+
+    def discard(self, broken):
+        """Arrête le pool cassé (processus fils libérés) ; un nouveau est créé au prochain appel."""
+        with self._lock:
+            if self._pool is broken:
+                self._pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+@st.cache_resource
+def get_image_process_pool():
+    """Pool de processus partagé pour la recompression (ne bloque pas le thread du script)."""
+    return ImageProcessPool(IMAGE_PROCESSING_WORKERS)
+
+def prepare_media_for_upload(file_obj, image_pool):
+    """
+    Retourne (flux, type_mime, taille) à envoyer : image recompressée si activé (fichier
+    temporaire lu par morceaux), sinon un lecteur sans copie sur le fichier d'origine.
+    """
+    if IMAGE_PROCESSING_ENABLED:
+        pool = image_pool.current()
+        try:
+            if isinstance(file_obj, photo_spool.PhotoHandle):
+                return _compress_spooled_photo(file_obj, pool)
+            # Fichier resté en mémoire (spool indisponible) : le contenu y est déjà en entier
+            future = pool.submit(
+                image_processing.compress_image, file_obj.getvalue(), file_obj.type,
+                IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY, IMAGE_KEEP_EXIF
+            )
+            data, mime_type = future.result()
+            return io.BytesIO(data), mime_type, len(data)
+        except BrokenProcessPool:
+            # Processus tué... : pool recréé au prochain appel, on envoie l'original
+            image_pool.discard(pool)
+        except Exception:
+            pass  # Image illisible par Pillow : on envoie l'original
+    stream = open_upload_stream(file_obj)
+    size = stream.seek(0, io.SEEK_END)
+    stream.seek(0)
+    return stream, file_obj.type, size
+
+def _compress_spooled_photo(handle, pool):
+    """
+    Recompression de fichier à fichier dans le pool de processus (seuls les chemins sont
+    transmis). Retourne (flux, type_mime, taille) sur le fichier produit, ou l'original.
+    """
+    # À côté du spool (disque) plutôt que dans un /tmp éventuellement en mémoire
+    spool_root = os.path.dirname(os.path.dirname(handle.path)) or None
+    fd, output_path = tempfile.mkstemp(prefix="upload-", suffix=".jpg.tmp", dir=spool_root)
+    os.close(fd)
+    try:
+        result = pool.submit(
+            image_processing.compress_image_file, handle.path, handle.type, output_path,
+            IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY, IMAGE_KEEP_EXIF
+        ).result()
+        if result is None:
+            stream = open_upload_stream(handle)
+            size = stream.seek(0, io.SEEK_END)
+            stream.seek(0)
+            return stream, handle.type, size
+        mime_type, size = result
+        return open(output_path, 'rb'), mime_type, size
+    finally:
+        try:
+            os.remove(output_path)  # Déjà ouvert : reste lisible jusqu'à la fermeture du flux
+        except OSError:
+            pass
+
+def _with_jpeg_extension(file_name, mime_type):
+    root, ext = os.path.splitext(file_name)
+    if mime_type == 'image/jpeg' and ext.lower() not in ('.jpg', '.jpeg'):
+        return f"{root}.jpg"
+    return file_name
+
+
+# --- SPOOL DISQUE DES PHOTOS ---
+
+def _spool_setting(key, default):
+    """Lit un paramètre optionnel de la section [photo_spool] des secrets."""
+    try:
+        return st.secrets["photo_spool"].get(key, default)
+    except Exception:
+        return default
+
+PHOTO_SPOOL_DIR = _spool_setting("directory", None)
+# Un fichier non utilisé depuis ce délai est supprimé par le nettoyage périodique
+PHOTO_SPOOL_TTL_HOURS = float(_spool_setting("ttl_hours", 24))
+PHOTO_SPOOL_JANITOR_MINUTES = float(_spool_setting("janitor_interval_minutes", 60))
+
+@st.cache_resource
+def get_photo_spool():
+    """Spool unique pour le processus, avec son thread de nettoyage (None si le disque est inutilisable)."""
+    try:
+        spool = photo_spool.PhotoSpool(PHOTO_SPOOL_DIR, ttl_seconds=PHOTO_SPOOL_TTL_HOURS * 3600)
+    except OSError:
+        return None
+    # Client résolu ici : le thread de nettoyage ne lit ni secrets ni cache Streamlit
+    spool.protect(functools.partial(draft_photo_hashes, get_db()))
+    spool.start_janitor(PHOTO_SPOOL_JANITOR_MINUTES * 60)
+    return spool
+
+def spool_uploaded_files(files):
+    """
+    Remplace les UploadedFile d'un file_uploader par des PhotoHandle (écriture unique par fichier,
+    mémorisée dans la session). Les fichiers sont gardés tels quels si le spool est indisponible.
+    """
+    spool = get_photo_spool()
+    if spool is None:
+        return files
+    spooled = st.session_state.setdefault('spooled_files', {})
+    handles = []
+    for uploaded in files:
+        key = getattr(uploaded, 'file_id', None) or str(id(uploaded))
+        handle = spooled.get(key)
+        if handle is None:
+            try:
+                handle = spool.put_uploaded(uploaded)
+            except OSError:
+                handles.append(uploaded)  # Disque plein : ce fichier reste en mémoire
+                continue
+            spooled[key] = handle
+        handles.append(handle)
+    return handles
+
+# --- REGISTRE D'UPLOAD PAR SOUMISSION (reprise idempotente) ---
+
+def content_hash(file_obj):
+    """Empreinte SHA-256 du contenu d'un fichier chargé."""
+    if isinstance(file_obj, photo_spool.PhotoHandle):
+        return file_obj.sha256  # Déjà calculée à l'écriture dans le spool
+    if hasattr(file_obj, 'getbuffer'):
+        return hashlib.sha256(file_obj.getbuffer()).hexdigest()
+    return hashlib.sha256(file_obj.getvalue()).hexdigest()
+
+class UploadLedger:
+    """
+    Registre des fichiers d'une soumission déjà présents sur Drive (empreinte -> lien et tailles).
+    Persisté dans Firestore (UploadLedger/<submission_id>) pour qu'une nouvelle tentative
+    de sauvegarde n'uploade que ce qui manque. Utilisable depuis les threads d'upload.
+    """
+
+    def __init__(self, submission_id, client):
+        self.submission_id = submission_id
+        self._client = client  # Résolu par l'appelant : utilisable depuis les threads
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._in_flight = {}  # empreinte -> Event de l'upload en cours (un seul envoi par contenu)
+        try:
+            snapshot = client.collection('UploadLedger').document(submission_id).get()
+            if snapshot.exists:
+                self._entries = {h: e for h, e in (snapshot.to_dict().get('files') or {}).items() if e.get('link')}
+        except Exception:
+            pass  # Registre vide : au pire on ré-uploade
+
+    def get(self, file_hash):
+        with self._lock:
+            entry = self._entries.get(file_hash)
+        return entry.get('link') if entry else None
+
+    def begin_upload(self, file_hash):
+        """
+        None si l'appelant devient responsable de l'upload de ce contenu (end_upload ensuite),
+        sinon l'Event de l'upload déjà en cours (arrière-plan...) à attendre avant de relire get().
+        """
+        with self._lock:
+            event = self._in_flight.get(file_hash)
+            if event is None:
+                self._in_flight[file_hash] = threading.Event()
+            return event
+
+    def end_upload(self, file_hash):
+        with self._lock:
+            event = self._in_flight.pop(file_hash, None)
+        if event is not None:
+            event.set()
+
+    def record(self, file_hash, link, file_name, original_size=None, uploaded_size=None, deduplicated=False):
+        entry = {
+            "link": link, "name": file_name, "original_size": original_size,
+            "uploaded_size": uploaded_size, "deduplicated": deduplicated,
         }
-        
-        # Important : Rembobiner le fichier avant lecture
-        file_obj.seek(0)
-        
-        media = MediaIoBaseUpload(io.BytesIO(file_obj.read()),
-                                  mimetype=file_obj.type,
-                                  resumable=True)
-        
-        uploaded_file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webViewLink'
-        ).execute()
-        
-        # Rembobiner à nouveau pour d'autres usages éventuels (zip, etc.)
-        file_obj.seek(0)
-        
-        return uploaded_file.get('webViewLink')
-    except Exception as e:
-        st.error(f"Erreur upload Drive pour {file_obj.name}: {e}")
+        with self._lock:
+            self._entries[file_hash] = entry
+        try:
+            self._client.collection('UploadLedger').document(self.submission_id).set({
+                "submission_id": self.submission_id,
+                "updated_at": datetime.now(),
+                "files": {file_hash: entry},
+            }, merge=True)
+        except Exception:
+            pass  # Le registre en mémoire suffit pour les reprises dans ce processus
+
+    def media_stats(self):
+        """Tailles d'origine et envoyées de chaque fichier, pour le document de soumission."""
+        with self._lock:
+            return [
+                {"name": e.get("name"), "original_size": e.get("original_size"), "uploaded_size": e.get("uploaded_size")}
+                for e in self._entries.values()
+            ]
+
+    def deduplicated_files(self):
+        """Fichiers dont le lien provient d'un upload antérieur (index de contenu)."""
+        with self._lock:
+            return [{"name": e.get("name"), "link": e.get("link")} for e in self._entries.values() if e.get("deduplicated")]
+
+# Registres inutilisés depuis ce délai retirés de la mémoire (relus depuis Firestore si besoin)
+UPLOAD_LEDGER_IDLE_SECONDS = 6 * 3600
+
+@st.cache_resource
+def _upload_ledger_registry():
+    return {}, threading.Lock()
+
+def get_upload_ledger(submission_id, context=None):
+    """Registre partagé par le processus pour une soumission donnée (context : depuis un thread)."""
+    ledgers, lock = context.ledgers if context else _upload_ledger_registry()
+    now = time.monotonic()
+    with lock:
+        entry = ledgers.get(submission_id)
+        if entry is not None:
+            ledgers[submission_id] = (entry[0], now)
+            return entry[0]
+    # Lecture Firestore hors du verrou : les autres soumissions ne l'attendent pas
+    ledger = UploadLedger(submission_id, context.db if context else get_db())
+    with lock:
+        for key, (_, last_used) in list(ledgers.items()):
+            if now - last_used > UPLOAD_LEDGER_IDLE_SECONDS:
+                del ledgers[key]
+        # Deux lectures concurrentes : la première enregistrée est gardée
+        return ledgers.setdefault(submission_id, (ledger, now))[0]
+
+def release_upload_ledger(submission_id, context=None):
+    """Soumission livrée : son registre quitte la mémoire (il reste dans Firestore)."""
+    ledgers, lock = context.ledgers if context else _upload_ledger_registry()
+    with lock:
+        ledgers.pop(submission_id, None)
+
+# --- INDEX DE CONTENU DES PHOTOS (déduplication entre soumissions) ---
+
+@st.cache_resource
+def _photo_index_cache():
+    return {}, threading.Lock()
+
+def lookup_photo_index(file_hash, context):
+    """
+    Retourne le lien d'un fichier Drive existant de même contenu (PhotoIndex/<sha256>),
+    après avoir vérifié qu'il n'a pas été supprimé. None si absent.
+    """
+    drive = context.drive
+    cache, lock = context.photo_index
+    with lock:
+        entry = cache.get(file_hash)
+    if entry is None:
+        try:
+            snapshot = context.db.collection('PhotoIndex').document(file_hash).get()
+        except Exception:
+            return None
+        if not snapshot.exists:
+            return None
+        entry = snapshot.to_dict()
+    if not entry.get('file_id'):
         return None
+    # Seuls un fichier introuvable (404) ou à la corbeille invalident l'entrée ; toute autre
+    # erreur (délai, 5xx, quota, réseau...) est passagère : on uploade sans toucher à l'index
+    try:
+        meta = drive.execute(drive.service.files().get(fileId=entry['file_id'], fields='id, trashed'))
+    except HttpError as e:
+        if e.resp.status == 404:
+            _forget_photo_index(file_hash, context)
+        return None
+    except Exception:
+        return None
+    if meta.get('trashed'):
+        _forget_photo_index(file_hash, context)
+        return None
+    with lock:
+        cache[file_hash] = entry
+    return entry.get('link')
+
+def register_photo_index(file_hash, file_id, link, file_name, context):
+    entry = {"file_id": file_id, "link": link, "name": file_name, "created_at": datetime.now()}
+    cache, lock = context.photo_index
+    with lock:
+        cache[file_hash] = entry
+    try:
+        context.db.collection('PhotoIndex').document(file_hash).set(entry)
+    except Exception:
+        pass  # Index best-effort : au pire, le prochain envoi identique sera ré-uploadé
+
+def _forget_photo_index(file_hash, context):
+    cache, lock = context.photo_index
+    with lock:
+        cache.pop(file_hash, None)
+    try:
+        context.db.collection('PhotoIndex').document(file_hash).delete()
+    except Exception:
+        pass
+
+# --- CONTEXTE DE LIVRAISON (clients résolus pour les threads) ---
+
+@dataclass(frozen=True, slots=True)
+class DeliveryContext:
+    """
+    Clients et réglages résolus pendant l'exécution du script. Les threads d'upload et le worker
+    de la boîte d'envoi les reçoivent tels quels : ils ne lisent ni st.secrets ni le cache Streamlit.
+    """
+    db: object
+    drive: object
+    folder_id: str
+    image_pool: object
+    ledgers: tuple
+    photo_index: tuple
+
+def delivery_context():
+    """Contexte courant, à construire depuis le script (lève une exception si Drive n'est pas configuré)."""
+    return DeliveryContext(
+        db=get_db(), drive=get_drive_client(), folder_id=st.secrets["google_drive"]["target_folder_id"],
+        image_pool=get_image_process_pool(), ledgers=_upload_ledger_registry(),
+        photo_index=_photo_index_cache(),
+    )
+
+def _upload_with_ledger(file_obj, file_name, context, ledger):
+    """
+    Pré-traite puis uploade, sauf si le même contenu est déjà enregistré pour cette soumission
+    (registre) ou déjà présent sur Drive pour une autre soumission (index de contenu).
+    """
+    file_hash = content_hash(file_obj)
+    if ledger is None:
+        return _upload_new_content(file_obj, file_hash, file_name, context, None)
+    while True:
+        link = ledger.get(file_hash)
+        if link:
+            return link
+        in_flight = ledger.begin_upload(file_hash)
+        if in_flight is None:
+            break
+        # Même contenu déjà en cours d'envoi (upload anticipé) : on attend son lien plutôt
+        # que de l'envoyer une seconde fois ; en cas d'échec, on reprend l'upload à notre compte
+        in_flight.wait()
+    try:
+        return _upload_new_content(file_obj, file_hash, file_name, context, ledger)
+    finally:
+        ledger.end_upload(file_hash)
+
+def _upload_new_content(file_obj, file_hash, file_name, context, ledger):
+    original_size = getattr(file_obj, 'size', None)
+    if DRIVE_DEDUPLICATE:
+        link = lookup_photo_index(file_hash, context)
+        if link:
+            if ledger is not None:
+                ledger.record(file_hash, link, file_name, original_size=original_size, uploaded_size=0, deduplicated=True)
+            return link
+    stream, mime_type, size = prepare_media_for_upload(file_obj, context.image_pool)
+    try:
+        uploaded = _upload_to_drive(
+            stream, mime_type, _with_jpeg_extension(file_name, mime_type), context.folder_id, context.drive
+        )
+    finally:
+        if stream is not file_obj:
+            stream.close()  # Fichier temporaire ou lecteur propre à cet upload
+    link = uploaded.get('webViewLink')
+    if link:
+        if DRIVE_DEDUPLICATE:
+            register_photo_index(file_hash, uploaded['id'], link, file_name, context)
+        if ledger is not None:
+            ledger.record(file_hash, link, file_name, original_size=original_size, uploaded_size=size)
+    return link
+
+
+# --- UPLOAD EN ARRIÈRE-PLAN (dès la validation d'une phase) ---
+
+# Délai max d'attente d'un upload d'arrière-plan encore en cours au moment de la sauvegarde
+BACKGROUND_UPLOAD_WAIT_SECONDS = 120
+
+@st.cache_resource
+def get_background_upload_executor():
+    """Pool de threads partagé par le processus pour les uploads anticipés."""
+    return ThreadPoolExecutor(max_workers=DRIVE_UPLOAD_WORKERS, thread_name_prefix="drive-upload")
+
+def _file_key(file_obj):
+    """Identifiant stable d'un fichier chargé (file_id Streamlit, sinon identité de l'objet)."""
+    return getattr(file_obj, 'file_id', None) or str(id(file_obj))
+
+def _iter_answer_files(answers):
+    for v in answers.values():
+        if isinstance(v, list) and v and hasattr(v[0], 'read'):
+            yield from v
+        elif hasattr(v, 'read'):
+            yield v
+
+def start_background_uploads(phase_entry, project_name):
+    """Lance l'upload Drive des photos d'une phase validée sans bloquer le script."""
+    try:
+        context = delivery_context()
+    except Exception:
+        return  # Drive non configuré : save_form_data gérera le repli
+    executor = get_background_upload_executor()
+    pending = st.session_state['background_uploads']
+    phase_name = phase_entry["phase_name"]
+    ledger = get_upload_ledger(st.session_state['submission_id'], context)
+
+    def _worker(file_obj):
+        file_name = build_drive_file_name(file_obj, project_name, phase_name)
+        return _upload_with_ledger(file_obj, file_name, context, ledger)
+
+    for file_obj in _iter_answer_files(phase_entry["answers"]):
+        key = _file_key(file_obj)
+        if key not in pending:
+            pending[key] = executor.submit(_worker, file_obj)
+
+def resolve_background_uploads(file_objs, timeout=BACKGROUND_UPLOAD_WAIT_SECONDS):
+    """
+    Liens des uploads anticipés (None si absent, en échec ou encore en cours), avec une seule
+    échéance pour l'ensemble : l'attente ne croît pas avec le nombre de photos. Un upload encore
+    en cours n'est pas renvoyé par le repli : le registre d'upload fait attendre son résultat.
+    """
+    pending = st.session_state.get('background_uploads', {})
+    futures = [pending.get(_file_key(file_obj)) for file_obj in file_objs]
+    wait([f for f in futures if f is not None], timeout=timeout)
+    links = []
+    for future in futures:
+        if future is None or not future.done() or future.exception() is not None:
+            links.append(None)
+        else:
+            links.append(future.result())
+    return links
+
+def background_upload_status():
+    """(terminés, total) des uploads anticipés de la session."""
+    pending = st.session_state.get('background_uploads', {})
+    done = sum(1 for f in pending.values() if f.done() and not f.exception())
+    return done, len(pending)
 
 
 # --- FONCTIONS DE CHARGEMENT ET SAUVEGARDE FIREBASE (MODIFIÉE POUR DRIVE) ---
 
-@st.cache_data(ttl=3600)
 def load_form_structure_from_firestore():
-    # Logique inchangée
+    # Normalisation vectorisée : voir form_normalization.py
     try:
-        docs = db.collection('formsquestions').order_by('id').get()
+        docs = get_db().collection('formsquestions').order_by('id').get()
         data = [doc.to_dict() for doc in docs]
         if not data: return None
-        df = pd.DataFrame(data)
-        df.columns = df.columns.str.strip()
-        
-        rename_map = {'Conditon value': 'Condition value', 'condition value': 'Condition value', 'Condition Value': 'Condition value', 'Condition': 'Condition value', 'Conditon on': 'Condition on', 'condition on': 'Condition on'}
-        actual_rename = {k: v for k, v in rename_map.items() if k in df.columns}
-        df = df.rename(columns=actual_rename)
-        
-        expected_cols = ['options', 'Description', 'Condition value', 'Condition on', 'section', 'id', 'question', 'type', 'obligatoire']
-        for col in expected_cols:
-            if col not in df.columns: df[col] = np.nan 
-        
-        df['options'] = df['options'].fillna('')
-        df['Description'] = df['Description'].fillna('')
-        df['Condition value'] = df['Condition value'].fillna('')
-        df['Condition on'] = df['Condition on'].apply(lambda x: int(x) if pd.notna(x) and str(x).isdigit() else 0)
+        return form_normalization.normalize_form_records(data)
+    except Exception as e:
+        return None
+
+# --- MOTEUR DE CONDITIONS PRÉCOMPILÉES ---
+# Syntaxe de "Condition value" : comparaisons "id=valeur", "id!=valeur", "id in (v1, v2)"
+# combinées avec AND / OR (AND prioritaire), ex. "12=Oui AND 14 in (AC, DC) OR 20!=Non".
+# Compatibilité avec l'ancien check_condition (une seule comparaison "id=valeur") :
+# - le texte n'est découpé sur AND / OR / && / || que si chaque morceau est une comparaison ;
+#   sinon il est lu comme une seule comparaison ("12=Rock AND Roll" -> valeur "rock and roll") ;
+# - "id!=valeur" (autrefois illisible, donc question toujours visible) reste visible tant que
+#   la question cible n'a pas de réponse.
+
+_OR_SPLIT = re.compile(r'\s+OR\s+|\s*\|\|\s*')
+_AND_SPLIT = re.compile(r'\s+AND\s+|\s*&&\s*')
+_COMPARISON = re.compile(r'^\s*(\d+)\s*(?:(!=|=)|\s(in)\s)\s*(.*?)\s*$', re.IGNORECASE | re.DOTALL)
+
+def _clean_condition_value(raw):
+    return raw.strip().strip('"').strip("'").lower()
+
+@dataclass(frozen=True, slots=True)
+class Comparison:
+    target: int
+    op: str
+    values: frozenset
+
+    @property
+    def targets(self):
+        return (self.target,)
+
+    def evaluate(self, lookup):
+        answer = lookup(self.target)
+        if answer is None:
+            return self.op == '!='
+        answer = str(answer).lower()
+        if self.op == '!=':
+            return answer not in self.values
+        return answer in self.values
+
+@dataclass(frozen=True, slots=True)
+class AllOf:
+    children: tuple
+    targets: tuple
+
+    def evaluate(self, lookup):
+        return all(child.evaluate(lookup) for child in self.children)
+
+@dataclass(frozen=True, slots=True)
+class AnyOf:
+    children: tuple
+    targets: tuple
+
+    def evaluate(self, lookup):
+        return any(child.evaluate(lookup) for child in self.children)
+
+def _combine(cls, children):
+    if len(children) == 1:
+        return children[0]
+    targets = tuple(dict.fromkeys(t for child in children for t in child.targets))
+    return cls(tuple(children), targets)
+
+def _parse_comparison(text):
+    match = _COMPARISON.match(text)
+    if not match:
+        raise ValueError(text)
+    target, op, in_op, raw_value = match.groups()
+    if in_op:
+        raw_value = raw_value.strip()
+        if raw_value[:1] in '([' and raw_value[-1:] in ')]':
+            raw_value = raw_value[1:-1]
+        return Comparison(int(target), 'in', frozenset(_clean_condition_value(v) for v in raw_value.split(',')))
+    return Comparison(int(target), op, frozenset([_clean_condition_value(raw_value)]))
+
+def parse_condition(condition_on, condition_value):
+    """
+    Compile une condition en prédicat. None = question toujours visible (pas de condition,
+    condition vide ou illisible, comme l'ancien check_condition).
+    """
+    if condition_on != 1:
+        return None
+    text = str(condition_value).strip()
+    if not text:
+        return None
+    try:
+        return _combine(AnyOf, [
+            _combine(AllOf, [_parse_comparison(part) for part in _AND_SPLIT.split(branch)])
+            for branch in _OR_SPLIT.split(text)
+        ])
+    except (ValueError, TypeError):
+        pass
+    try:
+        return _parse_comparison(text)  # Ancienne valeur contenant AND / OR
+    except (ValueError, TypeError):
+        return None
+
+# --- MODÈLE COMPILÉ DE LA STRUCTURE DU FORMULAIRE ---
+
+@dataclass(frozen=True, slots=True)
+class Question:
+    """Question du formulaire, champs déjà nettoyés et typés."""
+    id: int
+    section: str
+    text: str
+    type: str
+    description: str = ""
+    mandatory: bool = False
+    options: tuple = ()
+    condition_on: int = 0
+    condition_value: str = ""
+    condition: object = None
+
+@dataclass(frozen=True, slots=True)
+class FormModel:
+    """Structure immuable compilée une fois par chargement et partagée par toutes les sessions."""
+    identification_section: str
+    sections: tuple
+    available_phases: tuple
+    questions_by_section: MappingProxyType
+    questions_by_id: MappingProxyType
+    photo_question_count: MappingProxyType
+    dependents: MappingProxyType
+    render_blocks: MappingProxyType
+
+    def questions(self, section_name):
+        return self.questions_by_section.get(section_name, ())
+
+    def question_text(self, q_id):
+        question = self.questions_by_id.get(q_id)
+        return question.text if question else None
+
+def _render_blocks(section_questions, dependents):
+    """
+    Découpe une section en blocs contigus (positions des questions), chacun affiché par un
+    fragment : une question et celles de la section dont la visibilité en dépend, directement
+    ou non, sont dans le même bloc ; une réponse modifiée ne réaffiche donc que son bloc.
+    """
+    position = {}
+    for i, q in enumerate(section_questions):
+        position.setdefault(q.id, i)
+    span_end = list(range(len(section_questions)))
+    for i, q in enumerate(section_questions):
+        for section, dep_id in dependents.get(q.id, ()):
+            j = position.get(dep_id)
+            if section == q.section and j is not None:
+                lo, hi = min(i, j), max(i, j)
+                span_end[lo] = max(span_end[lo], hi)
+    blocks, start, reach = [], 0, 0
+    for i in range(len(section_questions)):
+        if i > reach:
+            blocks.append(tuple(range(start, i)))
+            start = i
+        reach = max(reach, span_end[i])
+    if section_questions:
+        blocks.append(tuple(range(start, len(section_questions))))
+    return tuple(blocks)
+
+def compile_form_model(df):
+    """Compile le DataFrame normalisé en index section -> questions et id -> question."""
+    by_section = {}
+    by_id = {}
+    typed = form_normalization.typed_question_columns(df)
+    typed = typed[typed['id'].notna()]  # Lignes sans id exploitable
+    for row in typed.itertuples(index=False):
+        question = Question(
+            id=int(row.id),
+            section=row.section,
+            text=row.text,
+            type=str(row.type),
+            description=row.description,
+            mandatory=bool(row.mandatory),
+            options=row.options,
+            condition_on=int(row.condition_on),
+            condition_value=row.condition_value,
+            condition=parse_condition(int(row.condition_on), row.condition_value),
+        )
+        by_section.setdefault(question.section, []).append(question)
+        by_id.setdefault(question.id, question)  # Comme df[df['id'] == id].iloc[0] : première occurrence
+
+    sections = tuple(df['section'].unique().tolist())
+    identification_section = df['section'].iloc[0]
+    excluded = {str(identification_section).strip().lower(), "phase"}
+    available_phases = tuple(
+        sec for sec in sections
+        if not (pd.isna(sec) or not sec or str(sec).strip().lower() in excluded)
+    )
+    # Graphe de dépendances : id de la question cible -> questions dont la visibilité en dépend
+    dependents = {}
+    for qs in by_section.values():
+        for q in qs:
+            for target in (q.condition.targets if q.condition else ()):
+                dependents.setdefault(target, []).append((q.section, q.id))
+    return FormModel(
+        identification_section=identification_section,
+        sections=sections,
+        available_phases=available_phases,
+        questions_by_section=MappingProxyType({sec: tuple(qs) for sec, qs in by_section.items()}),
+        questions_by_id=MappingProxyType(by_id),
+        photo_question_count=MappingProxyType({
+            sec: sum(1 for q in qs if q.type == 'photo') for sec, qs in by_section.items()
+        }),
+        dependents=MappingProxyType({target: tuple(keys) for target, keys in dependents.items()}),
+        render_blocks=MappingProxyType({sec: _render_blocks(qs, dependents) for sec, qs in by_section.items()}),
+    )
+
+# --- MAGASIN PARTAGÉ DES TABLES DE RÉFÉRENCE ---
+
+# Durée de validité d'une version avant rechargement depuis Firestore (secondes)
+REFERENCE_TTL_SECONDS = 3600
+# Versions conservées : une session commencée sur l'ancienne version la garde jusqu'au bout
+REFERENCE_VERSIONS_KEPT = 2
+FORM_TABLE = 'form_structure'
+_CATEGORICAL_COLUMNS = ('section', 'type', 'obligatoire')
+
+def compact_reference_frame(df):
+    """Types compacts : catégories pour les colonnes répétitives, entiers réduits pour les colonnes numériques."""
+    df = df.copy()
+    for col in _CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    for col in ('id', 'Condition on'):
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+@dataclass(frozen=True, slots=True)
+class ReferenceTable:
+    """Version publiée d'une table de référence : ni les sessions ni le code ne la modifient."""
+    name: str
+    version: int
+    frame: pd.DataFrame
+    model: object
+    loaded_at: float
+    memory_bytes: int
+    schema_version: object = None
+    content_hash: str = ""
+
+class ReferenceStore:
+    """
+    Tables de référence uniques pour le processus, versionnées. Les sessions ne conservent que
+    le numéro de version (session_state['form_version']) et relisent la table ici.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._tables = {}
+        self._current = {}
+        self._next_version = 1
+
+    def publish(self, name, frame, model=None, schema_version=None, content_hash=""):
+        frame = compact_reference_frame(frame)
+        with self._lock:
+            table = ReferenceTable(
+                name=name, version=self._next_version, frame=frame, model=model,
+                loaded_at=time.time(), memory_bytes=int(frame.memory_usage(deep=True).sum()),
+                schema_version=schema_version, content_hash=content_hash,
+            )
+            self._next_version += 1
+            versions = self._tables.setdefault(name, {})
+            versions[table.version] = table
+            for old in sorted(versions)[:-REFERENCE_VERSIONS_KEPT]:
+                del versions[old]
+            self._current[name] = table.version
+            return table
+
+    def current(self, name):
+        with self._lock:
+            version = self._current.get(name)
+            return self._tables.get(name, {}).get(version)
+
+    def get(self, name, version):
+        """Version demandée si elle est encore conservée, sinon None (pas de repli silencieux)."""
+        with self._lock:
+            return self._tables.get(name, {}).get(version)
+
+    @contextmanager
+    def refreshing(self):
+        """Une seule session à la fois recharge une table (les autres attendent sa publication)."""
+        with self._refresh_lock:
+            yield self
+
+    def invalidate(self, name):
+        with self._lock:
+            self._current.pop(name, None)
+
+    def memory_report(self):
+        with self._lock:
+            tables = [t for versions in self._tables.values() for t in versions.values()]
+        return [
+            {'table': t.name, 'version': t.version, 'courante': self._current.get(t.name) == t.version,
+             'lignes': len(t.frame), 'mémoire (Ko)': round(t.memory_bytes / 1024, 1)}
+            for t in sorted(tables, key=lambda t: (t.name, t.version))
+        ]
+
+@st.cache_resource
+def get_reference_store():
+    return ReferenceStore()
+
+# --- INSTANTANÉ DISQUE ET VERSION DU SCHÉMA ---
+
+def _form_cache_setting(key, default):
+    """Lit un paramètre optionnel de la section [form_cache] des secrets."""
+    try:
+        return st.secrets["form_cache"].get(key, default)
+    except Exception:
+        return default
+
+# Document Firestore dont le champ "version" est modifié à chaque changement du formulaire
+# (sans ce document, la structure est rechargée toutes les REFERENCE_TTL_SECONDS)
+FORM_SCHEMA_COLLECTION = _form_cache_setting("schema_collection", "Meta")
+FORM_SCHEMA_DOCUMENT = _form_cache_setting("schema_document", "form_schema")
+# L'instantané est un pickle : son répertoire doit rester privé (0700, propriétaire = processus)
+FORM_SNAPSHOT_DIR = _form_cache_setting(
+    "snapshot_dir", os.path.join(tempfile.gettempdir(), "questionnaire_chantier", "form_snapshot")
+)
+_SNAPSHOT_POINTER = "form_structure.json"
+
+def _private_snapshot_dir(create=False):
+    """
+    Répertoire de l'instantané, seulement s'il n'est ni un lien ni accessible à d'autres
+    utilisateurs : un pickle déposé par un tiers exécuterait du code dans l'application.
+    """
+    try:
+        if create:
+            os.makedirs(FORM_SNAPSHOT_DIR, mode=0o700, exist_ok=True)
+        info = os.lstat(FORM_SNAPSHOT_DIR)
+        if not stat.S_ISDIR(info.st_mode):
+            return None
+        if hasattr(os, 'getuid'):
+            if info.st_uid != os.getuid():
+                return None
+            if info.st_mode & 0o077:
+                if not create:
+                    return None
+                os.chmod(FORM_SNAPSHOT_DIR, 0o700)  # Répertoire créé par une ancienne version
+        return FORM_SNAPSHOT_DIR
+    except OSError:
+        return None
+
+def form_content_hash(df):
+    """Empreinte du contenu normalisé (colonnes + valeurs) : clé de l'instantané disque."""
+    digest = hashlib.sha256(json.dumps([str(c) for c in df.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df.astype(str), index=True).values.tobytes())
+    return digest.hexdigest()
+
+def read_form_snapshot(schema_version):
+    """DataFrame de l'instantané disque s'il correspond à la version du schéma, sinon None."""
+    directory = _private_snapshot_dir()
+    if directory is None:
+        return None, None
+    try:
+        with open(os.path.join(directory, _SNAPSHOT_POINTER), encoding='utf-8') as f:
+            pointer = json.load(f)
+        if pointer.get('schema_version') != schema_version:
+            return None, None
+        with open(os.path.join(directory, os.path.basename(pointer['file'])), 'rb') as f:
+            payload = f.read()
+        # Octets vérifiés avant toute désérialisation
+        if hashlib.sha256(payload).hexdigest() != pointer.get('file_sha256'):
+            return None, None
+        df = pickle.loads(payload)
+        if form_content_hash(df) != pointer.get('content_hash'):
+            return None, None  # Fichier tronqué ou modifié
+        return df, pointer['content_hash']
+    except Exception:
+        return None, None
+
+def write_form_snapshot(df, content_hash, schema_version):
+    """Écrit l'instantané (écriture atomique) et supprime les instantanés précédents."""
+    directory = _private_snapshot_dir(create=True)
+    if directory is None:
+        return  # Répertoire partagé ou appartenant à un autre utilisateur : pas d'instantané
+    try:
+        file_name = f"form_structure-{content_hash}.pkl"
+        data = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+        for name, payload in (
+            (file_name, data),
+            (_SNAPSHOT_POINTER, json.dumps({
+                'schema_version': schema_version, 'content_hash': content_hash, 'file': file_name,
+                'file_sha256': hashlib.sha256(data).hexdigest(),
+            }, default=str).encode('utf-8')),
+        ):
+            tmp_path = os.path.join(directory, f".{name}.tmp")
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, os.path.join(directory, name))
+        for name in os.listdir(directory):
+            if name.startswith("form_structure-") and name != file_name:
+                os.remove(os.path.join(directory, name))
+    except OSError:
+        pass  # Disque en lecture seule : on se passe de l'instantané
+
+class FormSchemaWatcher:
+    """
+    Suit le document de version du schéma avec un écouteur on_snapshot : une modification du
+    formulaire est connue du processus sans relire la collection formsquestions.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.available = False
+        self._watch = None
+        ref = get_db().collection(FORM_SCHEMA_COLLECTION).document(FORM_SCHEMA_DOCUMENT)
+        try:
+            self._apply(ref.get())
+            self._watch = ref.on_snapshot(self._on_snapshot)
+        except Exception:
+            self.available = False
+
+    def _apply(self, snapshot):
+        self.available = snapshot.exists
+        if snapshot.exists:
+            data = snapshot.to_dict() or {}
+            # Comparée à celle de l'instantané disque (JSON) : toujours sous forme de texte
+            self.version = str(data.get('version', snapshot.update_time))
+        else:
+            self.version = None
+
+    def _on_snapshot(self, snapshots, _changes, _read_time):
+        for snapshot in snapshots:
+            self._apply(snapshot)
+
+@st.cache_resource
+def get_form_schema_watcher():
+    return FormSchemaWatcher()
+
+def _form_table_is_fresh(table, watcher):
+    if table is None:
+        return False
+    if watcher.available:
+        return table.schema_version == watcher.version
+    return time.time() - table.loaded_at < REFERENCE_TTL_SECONDS
+
+def load_form_table():
+    """Version courante de la structure du formulaire. Ordre : mémoire du processus, instantané
+    disque de la même version du schéma, puis Firestore (une seule session recharge).
+    None si la structure n'a pas pu être chargée."""
+    store = get_reference_store()
+    watcher = get_form_schema_watcher()
+    table = store.current(FORM_TABLE)
+    if _form_table_is_fresh(table, watcher):
+        return table
+    with store.refreshing():
+        # Une autre session a pu recharger pendant l'attente du verrou
+        latest = store.current(FORM_TABLE)
+        if _form_table_is_fresh(latest, watcher):
+            return latest
+        schema_version = watcher.version if watcher.available else None
+        df, content_hash = (None, None)
+        if schema_version is not None:
+            df, content_hash = read_form_snapshot(schema_version)
+        if df is None:
+            df = load_form_structure_from_firestore()
+            if df is None or df.empty:
+                return latest  # On garde la version précédente si Firestore est indisponible
+            content_hash = form_content_hash(df)
+            if schema_version is not None:
+                write_form_snapshot(df, content_hash, schema_version)
+        if latest is not None and latest.content_hash == content_hash:
+            # Version du schéma modifiée sans changement de contenu : pas de recompilation
+            model = latest.model
+        else:
+            model = compile_form_model(df)
+        return store.publish(FORM_TABLE, df, model, schema_version=schema_version, content_hash=content_hash)
+
+def check_form_version():
+    """
+    Si la version épinglée par la session n'est plus conservée (REFERENCE_VERSIONS_KEPT
+    publications plus tard), bascule sur la version courante et le signale à l'utilisateur.
+    """
+    version = st.session_state.get('form_version')
+    if version is None:
+        return
+    store = get_reference_store()
+    if store.get(FORM_TABLE, version) is not None:
+        return
+    current = store.current(FORM_TABLE)
+    if current is None:
+        return
+    st.session_state['form_version'] = current.version
+    st.warning(
+        f"La structure du formulaire a changé pendant la saisie (version {version} → {current.version}) : "
+        "les questions suivent désormais la nouvelle version, vérifiez les réponses de la phase en cours."
+    )
+
+def current_form_model():
+    """Modèle de la version de formulaire sur laquelle la session a commencé."""
+    version = st.session_state.get('form_version')
+    if version is None:
+        return None
+    store = get_reference_store()
+    table = store.get(FORM_TABLE, version)
+    if table is None:
+        check_form_version()  # Version retirée entre-temps : bascule signalée
+        table = store.get(FORM_TABLE, st.session_state.get('form_version'))
+    return table.model if table else None
+
+# --- INDEX DE RECHERCHE DES SITES ---
+
+# Nombre maximum de résultats proposés dans la liste de sélection
+SITE_SEARCH_LIMIT = 50
+
+def fold_text(text):
+    """Minuscules, sans accents ni ponctuation : 'Orléans - Gare' -> 'orleans gare'."""
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', stripped.lower()).split())
+
+_EMPTY_POSTING = frozenset()
+_RECENT_SEARCHES = 256
+_INTERSECT_UNTIL = 512
+# Supérieur à tout caractère d'un texte normalisé (0-9, a-z, espace) : borne haute des plages de préfixe
+_AFTER_LAST_CHAR = '{'
+
+def _trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+# Au-delà de ce nombre de modifications d'un coup, les listes triées sont reconstruites
+# plutôt que mises à jour élément par élément
+_BULK_REBUILD_THRESHOLD = 200
+
+class SiteSearchIndex:
+    """
+    Index des intitulés de sites (clé = id du document Sites), insensible à la casse et aux
+    accents, mis à jour sur place quand un site est ajouté, modifié ou supprimé.
+    Chaque mot de la recherche doit apparaître dans l'intitulé (n'importe où : ville, code...).
+    Les résultats sont classés : début d'intitulé, puis début de mot, puis ailleurs, et par
+    ordre alphabétique à rang égal (à partir du mot trouvé pour le rang « début de mot »). Les deux premiers rangs sont lus directement dans des
+    listes triées (bisect) ; les trigrammes ne servent qu'aux correspondances en milieu de mot.
+    Non thread-safe : les accès sont protégés par le verrou de SiteStore.
+    """
+
+    def __init__(self):
+        self._titles = {}
+        self._folded = {}
+        self._sorted = []
+        self._word_starts = []
+        self._postings = {}
+        self._ordinal = None
+        # Résultats récents (la même recherche est rejouée à chaque rerun Streamlit)
+        self._recent = {}
+
+    def __len__(self):
+        return len(self._titles)
+
+    def title(self, key):
+        return self._titles.get(key)
+
+    def keys(self):
+        return list(self._titles)
+
+    @staticmethod
+    def _word_entries(folded, key):
+        return [(folded[m.end():], key) for m in re.finditer(r' (?=\S)', folded)]
+
+    def update(self, upserts=(), removals=()):
+        """Applique un lot de modifications : upserts = [(clé, intitulé)], removals = [clé]."""
+        changes = [(key, None) for key in removals] + list(upserts)
+        bulk = len(changes) > _BULK_REBUILD_THRESHOLD
+        self._ordinal = None
+        self._recent = {}
+        for key, title in changes:
+            folded = self._folded.pop(key, None)
+            self._titles.pop(key, None)
+            if folded is not None:
+                for gram in _trigrams(folded):
+                    posting = self._postings.get(gram)
+                    if posting is not None:
+                        posting.discard(key)
+                        if not posting:
+                            del self._postings[gram]
+                if not bulk:
+                    self._remove_sorted(self._sorted, (folded, key))
+                    for entry in self._word_entries(folded, key):
+                        self._remove_sorted(self._word_starts, entry)
+            if not isinstance(title, str) or not title:
+                continue
+            folded = fold_text(title)
+            self._titles[key] = title
+            self._folded[key] = folded
+            for gram in _trigrams(folded):
+                self._postings.setdefault(gram, set()).add(key)
+            if not bulk:
+                bisect.insort(self._sorted, (folded, key))
+                for entry in self._word_entries(folded, key):
+                    bisect.insort(self._word_starts, entry)
+        if bulk:
+            self._sorted = sorted((folded, key) for key, folded in self._folded.items())
+            self._word_starts = sorted(
+                entry for key, folded in self._folded.items() for entry in self._word_entries(folded, key)
+            )
+
+    def _ordinals(self):
+        """Rang alphabétique de chaque clé (recalculé après une modification) : trier des entiers
+        est bien plus rapide que trier des intitulés."""
+        if self._ordinal is None:
+            self._ordinal = {key: i for i, (_, key) in enumerate(self._sorted)}
+        return self._ordinal
+
+    @staticmethod
+    def _remove_sorted(items, entry):
+        i = bisect.bisect_left(items, entry)
+        if i < len(items) and items[i] == entry:
+            del items[i]
+
+    def _candidates(self, tokens):
+        grams = set().union(*(_trigrams(tok) for tok in tokens))
+        if not grams:
+            return None
+        postings = sorted((self._postings.get(g, _EMPTY_POSTING) for g in grams), key=len)
+        candidates = postings[0]
+        # Pré-filtre seulement : chaque candidat est vérifié ensuite, inutile d'intersecter
+        # les listes les plus longues une fois le nombre de candidats réduit
+        for posting in postings[1:]:
+            if len(candidates) <= _INTERSECT_UNTIL:
+                break
+            candidates = candidates & posting
+        return candidates
+
+    def search(self, query, limit=SITE_SEARCH_LIMIT):
+        """Retourne [(clé, intitulé)] classés ; un intitulé en double n'est proposé qu'une fois."""
+        tokens = fold_text(query).split()
+        if not tokens:
+            return []
+        cache_key = (tuple(tokens), limit)
+        if cache_key in self._recent:
+            return list(self._recent[cache_key])
+        results = self._search(tokens, limit)
+        if len(self._recent) >= _RECENT_SEARCHES:
+            self._recent.pop(next(iter(self._recent)))
+        self._recent[cache_key] = tuple(results)
+        return results
+
+    def _search(self, tokens, limit):
+        first, others = tokens[0], tokens[1:]
+        folded_of = self._folded
+        results = []
+        seen = set()
+        seen_titles = set()
+        # Recherche à plusieurs mots : les autres mots restreignent d'abord les candidats
+        allowed = self._candidates(others) if others else None
+
+        def _take(keys, checked=False):
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                title = self._titles[key]
+                if title in seen_titles:
+                    continue
+                if not checked:
+                    folded = folded_of[key]
+                    if first not in folded or not all(tok in folded for tok in others):
+                        continue
+                seen_titles.add(title)
+                results.append((key, title))
+                if len(results) >= limit:
+                    return True
+            return False
+
+        def _take_alphabetical(keys):
+            ordinal = self._ordinals()
+            if others:
+                matching = [
+                    ordinal[key] for key in keys
+                    if key not in seen and first in (folded := folded_of[key]) and all(tok in folded for tok in others)
+                ]
+            else:
+                matching = [ordinal[key] for key in keys if key not in seen and first in folded_of[key]]
+            matching.sort()
+            return _take((self._sorted[i][1] for i in matching), checked=True)
+
+        # Rang 0 : intitulés commençant par le premier mot (plage contiguë de la liste triée)
+        start = bisect.bisect_left(self._sorted, (first,))
+        end = bisect.bisect_left(self._sorted, (first + _AFTER_LAST_CHAR,), lo=start)
+        if allowed is not None and len(allowed) < end - start:
+            found = _take_alphabetical(k for k in allowed if folded_of[k].startswith(first))
+        else:
+            found = _take(self._sorted[i][1] for i in range(start, end) if allowed is None or self._sorted[i][1] in allowed)
+        if found:
+            return results
+
+        # Rang 1 : un mot de l'intitulé commence par le premier mot de la recherche
+        # (ordre alphabétique à partir de ce mot)
+        start = bisect.bisect_left(self._word_starts, (first,))
+        end = bisect.bisect_left(self._word_starts, (first + _AFTER_LAST_CHAR,), lo=start)
+        if allowed is not None and len(allowed) < end - start:
+            found = _take_alphabetical(
+                k for k in allowed if any(w.startswith(first) for w in folded_of[k].split()[1:])
+            )
+        else:
+            found = _take(
+                self._word_starts[i][1] for i in range(start, end)
+                if allowed is None or self._word_starts[i][1] in allowed
+            )
+        if found:
+            return results
+
+        # Rang 2 : correspondance en milieu de mot, via les trigrammes
+        candidates = self._candidates(tokens)
+        _take_alphabetical(candidates if candidates is not None else folded_of.keys())
+        return results
+
+# --- SYNCHRONISATION INCRÉMENTALE DES SITES ---
+
+# Délai max d'attente du premier chargement de la liste des sites (secondes)
+SITE_SYNC_TIMEOUT = 60
+# Seul champ nécessaire à la recherche : le reste du site est lu à la sélection
+SITE_SEARCH_FIELDS = ['Intitulé']
+
+def _sites_setting(key, default):
+    """Lit un paramètre optionnel de la section [sites] des secrets."""
+    try:
+        return st.secrets["sites"].get(key, default)
+    except Exception:
+        return default
+
+# Champ horodaté des documents Sites mis à jour à chaque modification (ex. "updated_at") :
+# s'il existe, seuls les documents modifiés après le dernier filigrane sont lus ou écoutés
+SITES_UPDATED_FIELD = _sites_setting("updated_field", None)
+# Champ booléen d'une suppression logique (ex. "deleted") : le site est retiré de la liste
+SITES_DELETED_FIELD = _sites_setting("deleted_field", None)
+# Synchronisation en arrière-plan (écoute + relectures) ; sinon seul le chargement initial
+# (et le bouton de rechargement) alimente la liste
+SITES_SYNC_ENABLED = bool(_sites_setting("sync_enabled", True))
+# Avancée du filigrane : l'écoute repart des documents modifiés depuis le dernier passage
+SITE_SYNC_SECONDS = float(_sites_setting("sync_seconds", 600))
+# Gigue relative des intervalles (0.2 = ±20 %) : les processus ne relisent pas en même temps
+SITE_SYNC_JITTER = min(0.9, max(0.0, float(_sites_setting("sync_jitter", 0.2))))
+# Plafond du délai entre deux essais après des échecs consécutifs (backoff exponentiel)
+SITE_SYNC_MAX_BACKOFF_SECONDS = float(_sites_setting("sync_max_backoff_seconds", 3600))
+# Rechargement complet projeté (seul moyen de voir une suppression physique, ou tout changement
+# sans updated_field) : désactivé par défaut (0), en heures sinon
+SITE_FULL_RESYNC_HOURS = float(_sites_setting("full_resync_hours", 0))
+
+def _clean_site_record(data):
+    return {str(k).strip(): v for k, v in (data or {}).items()}
+
+def _jittered(seconds):
+    """Intervalle décalé au hasard de ±SITE_SYNC_JITTER pour désynchroniser les processus."""
+    return seconds * random.uniform(1 - SITE_SYNC_JITTER, 1 + SITE_SYNC_JITTER)
+
+def _site_fields():
+    return SITE_SEARCH_FIELDS + [f for f in (SITES_UPDATED_FIELD, SITES_DELETED_FIELD) if f]
+
+class SiteStore:
+    """
+    Liste légère des sites (id du document + intitulé), partagée par le processus.
+    Chargée une fois par une requête projetée (select) : seuls les intitulés sont transférés.
+    Avec [sites] updated_field, seuls les documents modifiés après le filigrane (plus grande
+    valeur du champ déjà vue) sont ensuite écoutés (on_snapshot), ou relus par requête si
+    l'écoute est indisponible ; une suppression logique ([sites] deleted_field) retire le
+    site. Le rechargement complet ([sites] full_resync_hours) est désactivé par défaut.
+    Intervalles avec gigue et backoff exponentiel après échec ([sites] sync_enabled,
+    sync_seconds, sync_jitter, sync_max_backoff_seconds).
+    L'enregistrement complet d'un site n'est lu qu'à la sélection (fetch_record).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.index = SiteSearchIndex()
+        self._ready = threading.Event()
+        self._watch = None
+        self._watch_from = None
+        self._sync_thread = None
+        self.watermark = None
+        self.last_sync = None
+        self.last_full_sync = None
+        self._next_full_sync = None
+        self.failures = 0
+        self.error = None
+        self.start()
+
+    def start(self):
+        self._ready.clear()
+        self.error = None
+        try:
+            self.full_resync()
+        except Exception as e:
+            self.error = e
+            self._ready.set()
+            return
+        self._ready.set()
+        if not SITES_SYNC_ENABLED:
+            return
+        self._listen()
+        if self._sync_thread is None and (SITES_UPDATED_FIELD or SITE_FULL_RESYNC_HOURS > 0):
+            self._sync_thread = threading.Thread(target=self._sync_loop, name="sites-sync", daemon=True)
+            self._sync_thread.start()
+
+    def full_resync(self):
+        """Recharge tous les intitulés par une requête projetée et n'applique que les différences."""
+        titles = {}
+        watermark = self.watermark
+        for doc in get_db().collection('Sites').select(_site_fields()).stream():
+            data = _clean_site_record(doc.to_dict())
+            watermark = self._later(watermark, data)
+            if not (SITES_DELETED_FIELD and data.get(SITES_DELETED_FIELD)):
+                titles[doc.id] = data.get('Intitulé')
+        with self._lock:
+            upserts = [(doc_id, title) for doc_id, title in titles.items() if title != self.index.title(doc_id)]
+            removals = [doc_id for doc_id in self.index.keys() if doc_id not in titles]
+            if upserts or removals:
+                self.index.update(upserts, removals)
+            self.watermark = watermark
+            self.last_sync = self.last_full_sync = datetime.now()
+            self._next_full_sync = time.monotonic() + _jittered(SITE_FULL_RESYNC_HOURS * 3600)
+
+    def sync_changes(self):
+        """Relit seulement les documents modifiés après le filigrane (sans écoute active)."""
+        if not SITES_UPDATED_FIELD or self.watermark is None:
+            return
+        query = (get_db().collection('Sites')
+                 .where(SITES_UPDATED_FIELD, '>', self.watermark)
+                 .select(_site_fields()))
+        self._apply_changes([(doc.id, _clean_site_record(doc.to_dict())) for doc in query.stream()], [])
+        with self._lock:
+            self.last_sync = datetime.now()
+
+    @staticmethod
+    def _later(watermark, data):
+        updated = data.get(SITES_UPDATED_FIELD) if SITES_UPDATED_FIELD else None
+        try:
+            if updated is not None and (watermark is None or updated > watermark):
+                return updated
+        except TypeError:
+            pass  # Valeur d'un autre type que l'horodatage attendu
+        return watermark
+
+    def _apply_changes(self, changed, removed):
+        """changed = [(id, enregistrement)] ; une suppression logique vaut suppression."""
+        upserts, removals = [], list(removed)
+        with self._lock:
+            watermark = self.watermark
+            for doc_id, data in changed:
+                watermark = self._later(watermark, data)
+                if SITES_DELETED_FIELD and data.get(SITES_DELETED_FIELD):
+                    removals.append(doc_id)
+                elif data.get('Intitulé') != self.index.title(doc_id):
+                    upserts.append((doc_id, data.get('Intitulé')))
+            if upserts or removals:
+                self.index.update(upserts, removals)
+            self.watermark = watermark
+
+    def _listen(self):
+        """(Ré)ouvre l'écoute des documents modifiés après le filigrane, s'il a avancé."""
+        if not SITES_UPDATED_FIELD or self.watermark is None or self.watermark == self._watch_from:
+            return
+        self._unsubscribe()
+        try:
+            # Les écoutes ne gèrent pas les projections : la requête limite les documents
+            # transférés à ceux modifiés depuis le filigrane
+            query = get_db().collection('Sites').where(SITES_UPDATED_FIELD, '>', self.watermark)
+            self._watch = query.on_snapshot(self._on_snapshot)
+            self._watch_from = self.watermark
+        except Exception:
+            self._watch = None  # sync_changes prend le relais
+
+    def _unsubscribe(self):
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception:
+                pass
+        self._watch = None
+        self._watch_from = None
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self._next_delay())
+            try:
+                if self._full_resync_due():
+                    self.full_resync()
+                elif self._watch is None:
+                    self.sync_changes()
+                self._listen()  # Filigrane avancé : l'écoute repart sans les documents déjà lus
+                self.failures = 0
+            except Exception:
+                self.failures += 1  # Nouvel essai après un délai croissant
+
+    def _next_delay(self):
+        """Intervalle avec gigue ; après des échecs, backoff exponentiel plafonné."""
+        if self.failures:
+            return outbox.backoff_delay(self.failures, SITE_SYNC_SECONDS, SITE_SYNC_MAX_BACKOFF_SECONDS)
+        return _jittered(SITE_SYNC_SECONDS)
+
+    def _full_resync_due(self):
+        if SITE_FULL_RESYNC_HOURS <= 0 or self._next_full_sync is None:
+            return False
+        return time.monotonic() >= self._next_full_sync
+
+    def restart(self):
+        """Relance le chargement et l'écoute depuis zéro (après une erreur...)."""
+        self._unsubscribe()
+        with self._lock:
+            self.index = SiteSearchIndex()
+            self.watermark = None
+        self.start()
+
+    def _on_snapshot(self, _snapshots, changes, read_time):
+        changed, removed = [], []
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                removed.append(change.document.id)
+            else:
+                changed.append((change.document.id, _clean_site_record(change.document.to_dict())))
+        self._apply_changes(changed, removed)
+        with self._lock:
+            self.last_sync = read_time
+
+    def wait_ready(self, timeout=SITE_SYNC_TIMEOUT):
+        """True quand la liste des sites a été chargée sans erreur."""
+        return self._ready.wait(timeout) and self.error is None
+
+    def fetch_record(self, doc_id):
+        """Enregistrement complet d'un site (toutes les colonnes), lu par id. None si absent."""
+        snapshot = get_db().collection('Sites').document(doc_id).get()
+        return _clean_site_record(snapshot.to_dict()) if snapshot.exists else None
+
+    def title(self, doc_id):
+        with self._lock:
+            return self.index.title(doc_id)
+
+    def search(self, query, limit=SITE_SEARCH_LIMIT):
+        with self._lock:
+            return self.index.search(query, limit)
+
+    def searchable_count(self):
+        with self._lock:
+            return len(self.index)
+
+    def memory_bytes(self):
+        """Estimation de la mémoire des intitulés (bruts et normalisés), recalculée après une synchro."""
+        with self._lock:
+            cached = getattr(self, '_memory_estimate', None)
+            if cached is not None and cached[0] == self.last_sync:
+                return cached[1]
+            titles = self.index._titles
+            size = sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in titles.items())
+            size += sum(sys.getsizeof(v) for v in self.index._folded.values())
+            self._memory_estimate = (self.last_sync, size)
+            return size
+
+@st.cache_resource
+def get_site_store():
+    """Liste des sites unique pour le processus (synchronisée en continu)."""
+    return SiteStore()
+
+# --- PROFIL DU PROJET SÉLECTIONNÉ ---
+
+# Suffixe des colonnes de comptage des points de charge
+DEPLOYMENT_SUFFIX = '[Plan de Déploiement]'
+PHOTO_RULES_DOCUMENT = 'photo_rules'
+
+@st.cache_data(ttl=600)
+def load_section_photo_rules():
+    """
+    Règles section -> colonnes de comptage, lues dans Meta/photo_rules
+    ({"rules": {"Bornes DC": ["R [Plan de Déploiement]", ...]}, "labels": {colonne: libellé}}).
+    Retourne (règles, libellés) ; SECTION_PHOTO_RULES et PROJECT_RENAME_MAP si le document est absent.
+    """
+    try:
+        snapshot = get_db().collection(FORM_SCHEMA_COLLECTION).document(PHOTO_RULES_DOCUMENT).get()
+        data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        rules = {
+            str(section).strip(): [str(col).strip() for col in columns]
+            for section, columns in (data.get('rules') or {}).items()
+            if isinstance(columns, (list, tuple))
+        }
+        if rules:
+            labels = {**PROJECT_RENAME_MAP, **(data.get('labels') or {})}
+            return rules, labels
+    except Exception:
+        pass
+    return SECTION_PHOTO_RULES, PROJECT_RENAME_MAP
+
+# Nombre décimal ASCII (chemin vectorisé) ; les autres textes ('1_000', chiffres arabes...) passent par float()
+_PLAIN_NUMBER = r'[ \t\r\n]*[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?[ \t\r\n]*'
+_COUNT_LIMIT = float(2 ** 63)  # Au-delà, le comptage ne tient pas dans un int64 : chemin d'origine
+
+def _legacy_count(val):
+    """Conversion d'origine int(float(...)) ; 0 pour une valeur vide, invalide ou infinie."""
+    try:
+        if pd.isna(val) or val == "":
+            return 0
+        return int(float(str(val).replace(',', '.')))
+    except Exception:
+        return 0
+
+def coerce_deployment_counts(records, columns=None):
+    """
+    Comptages entiers des colonnes demandées (par défaut les colonnes [Plan de Déploiement]) d'un
+    DataFrame d'un ou plusieurs sites : même résultat que _legacy_count cellule par cellule
+    (colonne en entiers Python si un comptage dépasse int64).
+    """
+    if columns is None:
+        columns = [col for col in records.columns if str(col).endswith(DEPLOYMENT_SUFFIX)]
+    values = records[list(columns)]
+    text = values.astype(str).apply(lambda col: col.str.replace(',', '.', regex=False))
+    plain = text.apply(lambda col: col.str.fullmatch(_PLAIN_NUMBER)).fillna(False).astype(bool)
+    numbers = text.where(plain).apply(pd.to_numeric, errors='coerce').astype(float)
+    vectorized = plain & np.isfinite(numbers) & (numbers.abs() < _COUNT_LIMIT)
+    counts = np.trunc(numbers.where(vectorized, 0.0)).astype('int64')
+    for col in columns:
+        other = ~vectorized[col]
+        if other.any():
+            legacy = values.loc[other, col].map(_legacy_count).tolist()
+            if any(abs(count) >= _COUNT_LIMIT for count in legacy):
+                counts[col] = counts[col].astype(object)  # Hors int64 : entiers Python
+            counts.loc[other, col] = legacy
+    return counts
+
+@dataclass(frozen=True, slots=True)
+class ProjectProfile:
+    """Projet sélectionné, comptages convertis et photos attendues par section calculés une fois."""
+    site_id: str
+    title: str
+    counts: MappingProxyType
+    expected_photos: MappingProxyType
+
+    def expected_photo_count(self, section_name):
+        """(total, détail) comme get_expected_photo_count ; (None, None) si la section n'a pas de règle."""
+        return self.expected_photos.get(section_name, (None, None))
+
+def build_project_profile(site_id, project_data):
+    """
+    Profil du projet : comptages des colonnes [Plan de Déploiement] et de toute colonne citée par
+    les règles photo de Firestore (quel que soit son suffixe), puis photos attendues par section.
+    """
+    rules, labels = load_section_photo_rules()
+    record = dict(project_data or {})
+    for columns in rules.values():
+        for col in columns:
+            record.setdefault(col, 0)  # Colonne absente du site : 0 attendu
+    count_columns = list(dict.fromkeys(
+        [col for col in record if str(col).endswith(DEPLOYMENT_SUFFIX)]
+        + [col for columns in rules.values() for col in columns]
+    ))
+    counts = coerce_deployment_counts(pd.DataFrame([record]), count_columns).iloc[0].to_dict()
+    expected = {}
+    for section, columns in rules.items():
+        numbers = [int(counts.get(col, 0)) for col in columns]
+        details = [f"{num} {labels.get(col, col)}" for num, col in zip(numbers, columns)]
+        expected[section] = (sum(numbers), " + ".join(details))
+    return ProjectProfile(
+        site_id=site_id,
+        title=record.get('Intitulé', 'Projet Inconnu'),
+        counts=MappingProxyType({col: int(num) for col, num in counts.items()}),
+        expected_photos=MappingProxyType(expected),
+    )
+
+def expected_photo_count(section_name):
+    """Photos attendues pour la section, lues dans le profil du projet de la session."""
+    profile = st.session_state.get('project_profile')
+    if profile is None:
+        return get_expected_photo_count(section_name, st.session_state.get('project_data') or {})
+    return profile.expected_photo_count(section_name)
+
+def _assign_upload_result(cleaned_data, slot, value):
+    phase_idx, key, pos = slot
+    if pos is None:
+        cleaned_data[phase_idx]["answers"][key] = value
+    else:
+        cleaned_data[phase_idx]["answers"][key][pos] = value
+
+# --- STOCKAGE DES RÉPONSES : EN-TÊTE + UNE SOUS-COLLECTION DE PHASES ---
+
+ANSWERS_COLLECTION = 'FormAnswers'
+PHASES_SUBCOLLECTION = 'phases'
+# Limite Firestore d'un document (1 Mio) moins une marge pour l'estimation
+FIRESTORE_MAX_DOCUMENT_BYTES = 1_048_576 - 16_384
+FIRESTORE_MAX_BATCH_WRITES = 500
+
+def _firestore_value_size(value):
+    """Taille stockée d'une valeur selon les règles de calcul de Firestore."""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, datetime)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_firestore_value_size(str(k)) + _firestore_value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_firestore_value_size(v) for v in value)
+    if hasattr(value, 'path'):  # DocumentReference
+        return _firestore_value_size(value.path)
+    return _firestore_value_size(str(value))
+
+def firestore_document_size(path, data):
+    """Taille estimée d'un document : nom (segments du chemin + 16) + champs + 32."""
+    name_size = sum(_firestore_value_size(segment) for segment in path.split('/')) + 16
+    return name_size + _firestore_value_size(data) + 32
+
+def project_fingerprint(project_data):
+    """Empreinte de la fiche site au moment de la saisie (détecte une modification ultérieure du site)."""
+    payload = json.dumps(project_data or {}, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def write_form_answers(doc_id, header, phases, client=None):
+    """
+    Écrit l'en-tête FormAnswers/<doc_id> et une sous-collection phases/<nnn> (une phase par
+    document) en un seul WriteBatch atomique, après contrôle de la taille de chaque document.
+    """
+    client = client or get_db()  # Un seul client pour les références et le lot
+    header_ref = client.collection(ANSWERS_COLLECTION).document(doc_id)
+    writes = [(header_ref, header)]
+    for index, phase in enumerate(phases):
+        phase_doc = {"index": index, "phase_name": phase["phase_name"], "answers": phase["answers"]}
+        writes.append((header_ref.collection(PHASES_SUBCOLLECTION).document(f"{index:03d}"), phase_doc))
+
+    if len(writes) > FIRESTORE_MAX_BATCH_WRITES:
+        raise ValueError(f"Trop de phases pour une écriture atomique ({len(phases)}).")
+    for ref, data in writes:
+        size = firestore_document_size(ref.path, data)
+        if size > FIRESTORE_MAX_DOCUMENT_BYTES:
+            raise ValueError(
+                f"Document trop volumineux pour Firestore : {ref.path} ({size // 1024} Ko, "
+                f"max {FIRESTORE_MAX_DOCUMENT_BYTES // 1024} Ko)."
+            )
+
+    batch = client.batch()
+    for ref, data in writes:
+        batch.set(ref, data)
+    batch.commit()
+
+def build_answers_header(submission_id, project_data, site_id, cleaned_data, start_date, submission_date=None,
+                         context=None):
+    """Document d'en-tête FormAnswers (identification, dates, statistiques des photos)."""
+    ledger = get_upload_ledger(submission_id, context)
+    client = context.db if context else get_db()
+    header_document = {
+        "project_intitule": project_data.get('Intitulé', 'N/A'),
+        "project_site_id": site_id,
+        "project_ref": client.collection('Sites').document(site_id) if site_id else None,
+        "project_hash": project_fingerprint(project_data),
+        "submission_id": submission_id,
+        "start_date": start_date,
+        "submission_date": submission_date or datetime.now(),
+        "status": "Completed",
+        "phase_count": len(cleaned_data),
+        "phase_names": [phase["phase_name"] for phase in cleaned_data],
+        "media_stats": ledger.media_stats(),
+        "deduplicated_files": ledger.deduplicated_files()
+    }
+    if not site_id:
+        # Site sans identifiant (cas imprévu) : on garde une copie pour ne rien perdre
+        header_document["project_details"] = project_data
+    return header_document
+
+def get_submission_doc_id(project_data, submission_id):
+    """ID de document figé à la première tentative : une reprise (ou la boîte d'envoi) réécrit le même document."""
+    doc_id = st.session_state.get('submission_doc_id')
+    if not doc_id:
+        doc_id_base = str(project_data.get('Intitulé', 'form')).replace(" ", "_").replace("/", "_")[:20]
+        doc_id = f"{doc_id_base}_{datetime.now().strftime('%Y%m%d_%H%M')}_{submission_id[:6]}"
+        st.session_state['submission_doc_id'] = doc_id
+        update_draft(submission_id, {'submission_doc_id': doc_id})  # Repris tel quel après restauration
+    return doc_id
+
+def save_form_data(collected_data, project_data, drive_service=None):
+    """
+    MODIFIÉE : Uploade les photos vers Drive et sauvegarde les liens dans Firestore.
+    """
+    try:
+        # Si le service Drive n'est pas passé, on tente de l'initialiser
+        if drive_service is None:
+            drive_service = get_drive_service()
+            
+        project_name = project_data.get('Intitulé', 'Projet_Inconnu')
+        submission_id = st.session_state.get('submission_id') or str(uuid.uuid4())
+        cleaned_data = []
+        # Fichiers à uploader : (file_obj, phase_name) + emplacement (index phase, clé, liste ou non)
+        upload_jobs = []
+        upload_slots = []
+
+        for phase in collected_data:
+            clean_phase = {
+                "phase_name": phase["phase_name"],
+                "answers": {}
+            }
+            for k, v in phase["answers"].items():
+                
+                # --- LOGIQUE DRIVE ---
+                if isinstance(v, list) and v and hasattr(v[0], 'read'): 
+                    # C'est une liste de fichiers -> Upload Drive (différé, en parallèle)
+                    if drive_service:
+                        clean_phase["answers"][str(k)] = [None] * len(v)
+                        for i, file_obj in enumerate(v):
+                            upload_jobs.append((file_obj, phase["phase_name"]))
+                            upload_slots.append((len(cleaned_data), str(k), i))
+                    else:
+                        # Fallback si Drive non configuré (comportement ancien)
+                        file_names = ", ".join([f.name for f in v])
+                        clean_phase["answers"][str(k)] = f"ÉCHEC DRIVE - Fichiers locaux : {file_names}"
+                
+                elif hasattr(v, 'read'): 
+                    # Cas rare d'un fichier unique non listé
+                    if drive_service:
+                        clean_phase["answers"][str(k)] = None
+                        upload_jobs.append((v, phase["phase_name"]))
+                        upload_slots.append((len(cleaned_data), str(k), None))
+                    else:
+                         clean_phase["answers"][str(k)] = f"Image chargée (Nom: {v.name})"
+                else:
+                    # Donnée texte/nombre standard
+                    clean_phase["answers"][str(k)] = v
+            
+            cleaned_data.append(clean_phase)
+
+        # Les photos déjà envoyées en arrière-plan ne sont pas ré-uploadées
+        remaining_jobs, remaining_slots = [], []
+        background_links = resolve_background_uploads([job[0] for job in upload_jobs])
+        for job, slot, link in zip(upload_jobs, upload_slots, background_links):
+            if link:
+                _assign_upload_result(cleaned_data, slot, link)
+            else:
+                remaining_jobs.append(job)
+                remaining_slots.append(slot)
+        upload_jobs, upload_slots = remaining_jobs, remaining_slots
+
+        if upload_jobs:
+            progress_bar = st.progress(0.0, text=f"Upload vers Drive : 0/{len(upload_jobs)} photos")
+
+            def _on_progress(done, total, file_name, ok):
+                status = "✅" if ok else "❌"
+                progress_bar.progress(done / total, text=f"Upload vers Drive : {done}/{total} photos ({status} {file_name})")
+
+            links, upload_errors = upload_files_concurrently(
+                upload_jobs, project_name, on_progress=_on_progress,
+                ledger=get_upload_ledger(submission_id)
+            )
+            for err in upload_errors:
+                st.error(err)
+
+            for (file_obj, _), slot, link in zip(upload_jobs, upload_slots, links):
+                _assign_upload_result(cleaned_data, slot, link if link else f"Erreur upload: {file_obj.name}")
         
-        for col in df.select_dtypes(include=['object']).columns:
-            df[col] = df[col].astype(str).str.strip()
+        header_document = build_answers_header(
+            submission_id, project_data, st.session_state.get('project_site_id'), cleaned_data,
+            start_date=st.session_state.get('form_start_time', datetime.now()),
+        )
+        doc_id = get_submission_doc_id(project_data, submission_id)
+        write_form_answers(doc_id, header_document, cleaned_data)
+        release_upload_ledger(submission_id)
+        discard_draft(submission_id)
+        return True, submission_id 
+    except Exception as e:
+        return False, str(e)
+
+# --- BROUILLONS (reprise après rechargement ou redémarrage) ---
+
+DRAFTS_COLLECTION = 'Drafts'
+# Brouillons en cours proposés pour le chantier sélectionné
+DRAFT_LIST_LIMIT = 5
+
+def _serialize_answer(value):
+    if isinstance(value, list) and value and hasattr(value[0], 'read'):
+        return [item for item in (_serialize_answer(v) for v in value) if item is not None]
+    if hasattr(value, 'read'):
+        if not isinstance(value, photo_spool.PhotoHandle):
+            spool = get_photo_spool()
             try:
-                df[col] = df[col].apply(lambda x: x.encode('utf-8', 'ignore').decode('utf-8', 'ignore'))
-            except Exception: pass 
-        return df
+                value = spool.put_uploaded(value) if spool is not None else None
+            except OSError:
+                value = None
+            if value is None:
+                return None  # Photo restée en mémoire et non écrite : non reprise
+        return {'__photo__': True, 'sha256': value.sha256, 'name': value.name, 'type': value.type, 'size': value.size}
+    return value
+
+def _deserialize_answer(value, spool):
+    if isinstance(value, list):
+        return [_deserialize_answer(v, spool) for v in value]
+    if isinstance(value, dict) and value.get('__photo__'):
+        if spool is None:
+            return photo_spool.PhotoHandle(value['sha256'], value['name'], value['type'], value['size'], path='')
+        handle = spool.handle(value['sha256'], value['name'], value['type'], value['size'])
+        spool.touch(handle)  # Repris : ne doit pas être supprimé par le nettoyage
+        return handle
+    return value
+
+def _local_datetime(value):
+    """Horodatage Firestore (UTC) -> heure locale naïve, comme datetime.now()."""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+def serialize_phase(entry):
+    """Phase validée au format Firestore (clés texte, photos réduites à leur empreinte)."""
+    answers = {}
+    for q_id, value in entry['answers'].items():
+        serialized = _serialize_answer(value)
+        if serialized is not None:
+            answers[str(q_id)] = serialized
+    return {'phase_name': entry['phase_name'], 'answers': answers}
+
+def deserialize_phase(data, spool):
+    """Phase relue (brouillon, boîte d'envoi) ; spool : get_photo_spool() résolu par l'appelant."""
+    answers = {}
+    for q_id, value in (data.get('answers') or {}).items():
+        answers[int(q_id) if str(q_id).isdigit() else q_id] = _deserialize_answer(value, spool)
+    return {'phase_name': data.get('phase_name'), 'answers': answers}
+
+def start_draft():
+    """Crée le brouillon de la soumission en cours (en-tête seulement, les phases suivent une à une)."""
+    submission_id = st.session_state['submission_id']
+    project_data = st.session_state['project_data'] or {}
+    try:
+        get_db().collection(DRAFTS_COLLECTION).document(submission_id).set({
+            'submission_id': submission_id,
+            'status': 'in_progress',
+            'project_site_id': st.session_state.get('project_site_id'),
+            'project_intitule': project_data.get('Intitulé', 'Projet Inconnu'),
+            'project_data': project_data,
+            'form_start_time': st.session_state.get('form_start_time'),
+            'submission_doc_id': st.session_state.get('submission_doc_id'),
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            'phase_count': 0,
+            'phases': {},
+        })
+        st.query_params['draft'] = submission_id
+    except Exception:
+        pass  # Brouillon indisponible : le formulaire fonctionne comme avant
+
+def update_draft(submission_id, fields):
+    """Met à jour quelques champs du brouillon (sans effet si le brouillon n'existe pas)."""
+    try:
+        get_db().collection(DRAFTS_COLLECTION).document(submission_id).update({
+            **fields, 'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+    except Exception:
+        pass
+
+def checkpoint_phase(entry, phase_index):
+    """Ajoute une seule phase validée au brouillon (écriture delta, pas tout l'audit)."""
+    submission_id = st.session_state.get('submission_id')
+    if not submission_id:
+        return
+    try:
+        get_db().collection(DRAFTS_COLLECTION).document(submission_id).update({
+            f'phases.{phase_index}': serialize_phase(entry),
+            'phase_count': phase_index + 1,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+    except Exception:
+        pass
+
+def draft_photo_hashes(client):
+    """
+    Empreintes des photos citées par les brouillons en cours (à garder dans le spool pour
+    leur reprise). Une erreur de lecture remonte : le nettoyage est alors reporté.
+    """
+    hashes = set()
+    query = (client.collection(DRAFTS_COLLECTION)
+             .where('status', '==', 'in_progress')
+             .select(['phases']))
+    for doc in query.stream():
+        for phase in ((doc.to_dict() or {}).get('phases') or {}).values():
+            for value in (phase.get('answers') or {}).values():
+                for item in (value if isinstance(value, list) else [value]):
+                    if isinstance(item, dict) and item.get('__photo__') and item.get('sha256'):
+                        hashes.add(item['sha256'])
+    return hashes
+
+def discard_draft(submission_id, clear_url=True, client=None):
+    """Supprime le brouillon une fois la soumission enregistrée dans FormAnswers."""
+    try:
+        (client or get_db()).collection(DRAFTS_COLLECTION).document(submission_id).delete()
+    except Exception:
+        pass
+    if clear_url and st.query_params.get('draft') == submission_id:
+        del st.query_params['draft']
+
+def list_site_drafts(site_id):
+    """Brouillons en cours pour un chantier : [(submission_id, libellé)]."""
+    try:
+        docs = (get_db().collection(DRAFTS_COLLECTION)
+                .where('project_site_id', '==', site_id)
+                .where('status', '==', 'in_progress')
+                .select(['phase_count', 'form_start_time'])
+                .limit(DRAFT_LIST_LIMIT).get())
+    except Exception:
+        return []
+    drafts = []
+    for doc in docs:
+        data = doc.to_dict() or {}
+        started = _local_datetime(data.get('form_start_time'))
+        started_str = started.strftime('%d/%m/%Y %H:%M') if hasattr(started, 'strftime') else '?'
+        drafts.append((doc.id, f"Commencé le {started_str} - {data.get('phase_count', 0)} phase(s) validée(s)"))
+    return drafts
+
+def restore_draft(submission_id):
+    """Restaure un audit en cours en une seule lecture. Retourne (ok, message)."""
+    try:
+        snapshot = get_db().collection(DRAFTS_COLLECTION).document(submission_id).get()
     except Exception as e:
-        return None
+        return False, f"Erreur de lecture du brouillon : {e}"
+    data = snapshot.to_dict() if snapshot.exists else None
+    if data and data.get('status') == 'queued':
+        return False, "Audit déjà transmis à la boîte d'envoi : il sera enregistré automatiquement."
+    if not data or data.get('status') != 'in_progress':
+        return False, "Brouillon introuvable ou déjà envoyé."
+
+    phases = data.get('phases') or {}
+    spool = get_photo_spool()
+    collected_data = [deserialize_phase(phases[k], spool) for k in sorted(phases, key=int)]
+    project_data = data.get('project_data') or {}
+    form_table = load_form_table()
+    if form_table is None:
+        return False, "Structure du formulaire indisponible."
+
+    for key in ('answer_index', 'visibility_tracker'):
+        st.session_state.pop(key, None)
+    st.session_state['project_data'] = project_data
+    st.session_state['project_site_id'] = data.get('project_site_id')
+    st.session_state['project_profile'] = build_project_profile(data.get('project_site_id'), project_data)
+    st.session_state['form_version'] = form_table.version
+    st.session_state['form_start_time'] = _local_datetime(data.get('form_start_time')) or datetime.now()
+    st.session_state['submission_id'] = submission_id
+    st.session_state['submission_doc_id'] = data.get('submission_doc_id')
+    st.session_state['collected_data'] = collected_data
+    st.session_state['identification_completed'] = bool(collected_data)
+    st.session_state['step'] = 'LOOP_DECISION' if collected_data else 'IDENTIFICATION'
+    st.session_state['current_phase_temp'] = {}
+    st.session_state['current_phase_name'] = None
+    st.session_state['iteration_id'] = str(uuid.uuid4())
+    st.session_state['show_comment_on_error'] = False
+    st.session_state['background_uploads'] = {}
+    st.query_params['draft'] = submission_id
+
+    # Photos déjà sur Drive : le registre répond sans relire le fichier ; les autres repartent
+    project_name = project_data.get('Intitulé', 'Projet_Inconnu')
+    for entry in collected_data:
+        start_background_uploads(entry, project_name)
+    ledger = get_upload_ledger(submission_id)
+    missing = sum(
+        1 for entry in collected_data for f in _iter_answer_files(entry['answers'])
+        if not f.exists() and not ledger.get(f.sha256)
+    )
+    message = f"Brouillon repris : {len(collected_data)} phase(s) restaurée(s)."
+    if missing:
+        message += f" ⚠️ {missing} photo(s) ne sont plus disponibles et devront être rechargées."
+    return True, message
+
+# --- BOÎTE D'ENVOI LOCALE (livraison différée si Firestore/Drive sont indisponibles) ---
+
+def _outbox_setting(key, default):
+    """Lit un paramètre optionnel de la section [outbox] des secrets."""
+    try:
+        return st.secrets["outbox"].get(key, default)
+    except Exception:
+        return default
+
+# Fichier SQLite sur un disque persistant (volume monté...) : sans [outbox] path, pas de boîte
+# d'envoi (un répertoire temporaire peut être vidé au redémarrage, soumissions comprises)
+OUTBOX_PATH = _outbox_setting("path", None)
+OUTBOX_POLL_SECONDS = float(_outbox_setting("poll_seconds", 10))
+OUTBOX_RATE_PER_MINUTE = float(_outbox_setting("rate_per_minute", 30))
+OUTBOX_MAX_ATTEMPTS = int(_outbox_setting("max_attempts", 20))
+OUTBOX_BASE_DELAY_SECONDS = float(_outbox_setting("base_delay_seconds", 10))
+OUTBOX_MAX_DELAY_SECONDS = float(_outbox_setting("max_delay_seconds", 900))
+# Laisse à la sauvegarde au premier plan le temps d'aboutir avant que le worker ne s'en charge
+OUTBOX_FOREGROUND_GRACE_SECONDS = 300
+# Réservation d'une soumission pendant une livraison (premier plan ou worker)
+OUTBOX_CLAIM_SECONDS = float(_outbox_setting("claim_seconds", outbox.CLAIM_LEASE_SECONDS))
+# Relecture de l'état pendant que le worker livre la soumission affichée
+OUTBOX_DELIVERY_POLL_SECONDS = 3
+
+def deliver_outbox_payload(payload, context, spool):
+    """
+    Livre une soumission de la boîte d'envoi (thread du worker, sans appel Streamlit) : photos
+    vers Drive via le registre d'upload (rien n'est renvoyé deux fois), puis écriture atomique de
+    FormAnswers. context et spool sont résolus à la construction du worker. Lève une exception
+    si la livraison doit être retentée.
+    """
+    context.drive.ensure_fresh()
+    submission_id = payload['submission_id']
+    project_data = payload['project_data']
+    project_name = project_data.get('Intitulé', 'Projet_Inconnu')
+    ledger = get_upload_ledger(submission_id, context)
+
+    def _link(file_obj, phase_name):
+        if not file_obj.exists() and not ledger.get(file_obj.sha256):
+            return f"Erreur upload: {file_obj.name} (fichier local supprimé)"
+        file_name = build_drive_file_name(file_obj, project_name, phase_name)
+        link = _upload_with_ledger(file_obj, file_name, context, ledger)
+        if not link:
+            raise RuntimeError(f"Upload Drive sans lien pour {file_obj.name}")
+        return link
+
+    cleaned_data = []
+    for phase_data in payload['phases']:
+        phase = deserialize_phase(phase_data, spool)
+        answers = {}
+        for k, v in phase['answers'].items():
+            if isinstance(v, list) and v and hasattr(v[0], 'read'):
+                answers[str(k)] = [_link(f, phase['phase_name']) for f in v]
+            elif hasattr(v, 'read'):
+                answers[str(k)] = _link(v, phase['phase_name'])
+            else:
+                answers[str(k)] = v
+        cleaned_data.append({"phase_name": phase['phase_name'], "answers": answers})
+
+    header_document = build_answers_header(
+        submission_id, project_data, payload.get('project_site_id'), cleaned_data,
+        start_date=datetime.fromisoformat(payload['start_date']),
+        submission_date=datetime.fromisoformat(payload['submission_date']),
+        context=context,
+    )
+    write_form_answers(payload['doc_id'], header_document, cleaned_data, client=context.db)
+    release_upload_ledger(submission_id, context)
+    discard_draft(submission_id, clear_url=False, client=context.db)
+
+def _outbox_deliver():
+    """Livraison liée aux clients courants (résolus ici, dans le script)."""
+    return functools.partial(deliver_outbox_payload, context=delivery_context(), spool=get_photo_spool())
 
-@st.cache_data(ttl=3600)
-def load_site_data_from_firestore():
-    # Logique inchangée
+@st.cache_resource
+def get_outbox_worker():
+    """
+    Boîte d'envoi et worker de livraison uniques pour le processus. None sans [outbox] path,
+    si le disque est inutilisable ou si Drive n'est pas configuré.
+    """
+    if not OUTBOX_PATH:
+        return None
     try:
-        docs = db.collection('Sites').get()
-        data = [doc.to_dict() for doc in docs]
-        if not data: return None
-        df_site = pd.DataFrame(data)
-        df_site.columns = df_site.columns.str.strip()
-        return df_site
-    except Exception as e:
+        deliver = _outbox_deliver()
+        box = outbox.Outbox(OUTBOX_PATH)
+    except Exception:
         return None
+    spool = get_photo_spool()
+    if spool is not None:
+        spool.protect(box.pending_photo_hashes)
+    worker = outbox.OutboxWorker(
+        box, deliver, poll_seconds=OUTBOX_POLL_SECONDS,
+        rate_per_minute=OUTBOX_RATE_PER_MINUTE, max_attempts=OUTBOX_MAX_ATTEMPTS,
+        base_delay_seconds=OUTBOX_BASE_DELAY_SECONDS, max_delay_seconds=OUTBOX_MAX_DELAY_SECONDS,
+        lease_seconds=OUTBOX_CLAIM_SECONDS,
+    )
+    worker.start()
+    return worker
 
-def save_form_data(collected_data, project_data, drive_service=None):
+def refresh_outbox_delivery():
+    """Client Firestore ou Drive remplacé : le worker livre désormais avec les nouveaux clients."""
+    worker = get_outbox_worker()
+    if worker is not None:
+        try:
+            worker.deliver = _outbox_deliver()
+        except Exception:
+            pass  # Drive non configuré : le worker garde ses clients
+
+def enqueue_submission(collected_data, project_data):
+    """Écrit la soumission terminée dans la boîte d'envoi locale. Retourne False si c'est impossible."""
+    worker = get_outbox_worker()
+    if worker is None:
+        return False
+    submission_id = st.session_state['submission_id']
+    start_date = st.session_state.get('form_start_time') or datetime.now()
+    phases = [serialize_phase(entry) for entry in collected_data]
+    photo_hashes = [
+        value['sha256'] for phase in phases for answer in phase['answers'].values()
+        for value in (answer if isinstance(answer, list) else [answer])
+        if isinstance(value, dict) and value.get('__photo__')
+    ]
+    payload = {
+        'submission_id': submission_id,
+        'doc_id': get_submission_doc_id(project_data, submission_id),
+        'project_site_id': st.session_state.get('project_site_id'),
+        'project_data': project_data,
+        'start_date': start_date.isoformat(),
+        'submission_date': datetime.now().isoformat(),
+        'phases': phases,
+    }
+    try:
+        worker.outbox.enqueue(
+            submission_id, json.loads(json.dumps(payload, default=str)),
+            label=project_data.get('Intitulé', 'Projet Inconnu'), photo_hashes=photo_hashes,
+            delay_seconds=OUTBOX_FOREGROUND_GRACE_SECONDS,
+        )
+    except Exception:
+        return False
+    # Pris en charge par la boîte d'envoi : le brouillon n'est plus proposé à la reprise
+    update_draft(submission_id, {'status': 'queued'})
+    return True
+
+def _foreground_owner(submission_id):
+    return f"foreground-{submission_id}"
+
+def claim_foreground_save(submission_id):
     """
-    MODIFIÉE : Uploade les photos vers Drive et sauvegarde les liens dans Firestore.
+    Réserve la soumission pour la sauvegarde au premier plan. Retourne (réservée, statut) :
+    (True, None) sans boîte d'envoi ; (False, 'in_progress') si le worker la livre déjà ;
+    (False, 'done') si elle est déjà livrée.
     """
-    try:
-        # Si le service Drive n'est pas passé, on tente de l'initialiser
-        if drive_service is None:
-            drive_service = get_drive_service()
-            
-        project_name = project_data.get('Intitulé', 'Projet_Inconnu')
-        cleaned_data = []
+    worker = get_outbox_worker()
+    if worker is None or not st.session_state.get('outbox_enqueued'):
+        return True, None
+    if worker.outbox.claim(submission_id, _foreground_owner(submission_id), OUTBOX_CLAIM_SECONDS, include_failed=True):
+        return True, outbox.STATUS_IN_PROGRESS
+    row = worker.outbox.get(submission_id)
+    if row is None:
+        return True, None  # Ligne purgée : sauvegarde directe
+    return False, row['status']
 
-        for phase in collected_data:
-            clean_phase = {
-                "phase_name": phase["phase_name"],
-                "answers": {}
-            }
-            for k, v in phase["answers"].items():
-                
-                # --- LOGIQUE DRIVE ---
-                if isinstance(v, list) and v and hasattr(v[0], 'read'): 
-                    # C'est une liste de fichiers -> Upload Drive
-                    if drive_service:
-                        drive_links = []
-                        with st.spinner(f"Upload vers Drive : {phase['phase_name']}..."):
-                            for file_obj in v:
-                                link = upload_file_to_drive(file_obj, project_name, phase["phase_name"], drive_service)
-                                if link:
-                                    drive_links.append(link)
-                                else:
-                                    drive_links.append(f"Erreur upload: {file_obj.name}")
-                        
-                        clean_phase["answers"][str(k)] = drive_links
-                    else:
-                        # Fallback si Drive non configuré (comportement ancien)
-                        file_names = ", ".join([f.name for f in v])
-                        clean_phase["answers"][str(k)] = f"ÉCHEC DRIVE - Fichiers locaux : {file_names}"
-                
-                elif hasattr(v, 'read'): 
-                    # Cas rare d'un fichier unique non listé
-                    if drive_service:
-                        link = upload_file_to_drive(v, project_name, phase["phase_name"], drive_service)
-                        clean_phase["answers"][str(k)] = link if link else f"Erreur upload: {v.name}"
-                    else:
-                         clean_phase["answers"][str(k)] = f"Image chargée (Nom: {v.name})"
-                else:
-                    # Donnée texte/nombre standard
-                    clean_phase["answers"][str(k)] = v
-            
-            cleaned_data.append(clean_phase)
-        
-        submission_id = st.session_state.get('submission_id', str(uuid.uuid4()))
-        
-        final_document = {
-            "project_intitule": project_data.get('Intitulé', 'N/A'),
-            "project_details": project_data,
-            "submission_id": submission_id,
-            "start_date": st.session_state.get('form_start_time', datetime.now()),
-            "submission_date": datetime.now(),
-            "status": "Completed",
-            "collected_phases": cleaned_data
-        }
-        
-        doc_id_base = str(project_data.get('Intitulé', 'form')).replace(" ", "_").replace("/", "_")[:20]
-        doc_id = f"{doc_id_base}_{datetime.now().strftime('%Y%m%d_%H%M')}_{submission_id[:6]}"
-        
-        db.collection('FormAnswers').document(doc_id).set(final_document)
-        return True, submission_id 
-    except Exception as e:
-        return False, str(e)
+def keep_foreground_claim(submission_id):
+    """Renouvelle la réservation de la sauvegarde au premier plan tant qu'elle dure."""
+    worker = get_outbox_worker()
+    if worker is None or not st.session_state.get('outbox_enqueued'):
+        return nullcontext()
+    return outbox.ClaimKeeper(worker.outbox, submission_id, _foreground_owner(submission_id), OUTBOX_CLAIM_SECONDS)
+
+def hand_over_to_outbox(submission_id):
+    """La sauvegarde au premier plan a échoué : le worker prend le relais immédiatement."""
+    worker = get_outbox_worker()
+    if worker is not None:
+        worker.outbox.release(submission_id, _foreground_owner(submission_id))
+        worker.wake()
+
+@st.fragment(run_every=OUTBOX_DELIVERY_POLL_SECONDS)
+def render_outbox_delivery(submission_id):
+    """Livraison en cours par le worker : la page reprend dès que le résultat est connu."""
+    worker = get_outbox_worker()
+    row = worker.outbox.get(submission_id) if worker is not None else None
+    if row is None or row['status'] != outbox.STATUS_IN_PROGRESS:
+        st.rerun()
+    st.info("📤 Cet audit est en cours d'envoi par le serveur : le résultat s'affichera ici.")
+
+def mark_submission_delivered(submission_id):
+    """Livrée au premier plan ; sans effet si la réservation a été reprise par le worker entre-temps."""
+    worker = get_outbox_worker()
+    if worker is not None:
+        worker.outbox.mark_done(submission_id, _foreground_owner(submission_id))
+
+def render_outbox_status():
+    """État de la boîte d'envoi du serveur (barre latérale)."""
+    worker = get_outbox_worker()
+    if worker is None:
+        return
+    summary = worker.outbox.summary()
+    waiting = summary.get(outbox.STATUS_PENDING, 0) + summary.get(outbox.STATUS_IN_PROGRESS, 0)
+    failed = summary.get(outbox.STATUS_FAILED, 0)
+    title = f"📤 Envois en attente : {waiting + failed}" if waiting or failed else "📤 Envois : tout est livré"
+    with st.sidebar.expander(title, expanded=bool(failed)):
+        st.caption(f"Livrés (7 derniers jours) : {summary.get(outbox.STATUS_DONE, 0)}")
+        for item in worker.outbox.undelivered():
+            next_try = datetime.fromtimestamp(item['next_attempt_at']).strftime('%H:%M:%S')
+            if item['status'] == outbox.STATUS_FAILED:
+                status = "❌ En échec"
+            elif item['status'] == outbox.STATUS_IN_PROGRESS:
+                status = "🔄 Envoi en cours"
+            else:
+                status = f"⏳ Prochain essai {next_try}"
+            st.markdown(f"**{item['label']}** - {status} ({item['attempts']} tentative(s))")
+            if item['last_error']:
+                st.caption(item['last_error'])
+            if item['status'] == outbox.STATUS_FAILED and st.button("Relancer", key=f"outbox_retry_{item['submission_id']}"):
+                worker.outbox.retry_now(item['submission_id'])
+                worker.wake()
+                st.rerun()
 
 # --- FONCTIONS EXPORT (MODIFIÉE POUR ZIP) ---
 
-def create_csv_export(collected_data, df_struct):
+def create_csv_export(collected_data, form_model):
     """Gère les listes de fichiers (maintenant URLs ou Objets) dans l'export CSV."""
     rows = []
     submission_id = st.session_state.get('submission_id', 'N/A')
@@ -312,12 +2596,6 @@ def create_csv_export(collected_data, df_struct):
         phase_name = item['phase_name']
         for q_id, val in item['answers'].items():
             
-            if int(q_id) == 100:
-                q_text = "Commentaire Écart Photo"
-            else:
-                q_row = df_struct[df_struct['id'] == int(q_id)]
-                q_text = q_row.iloc[0]['question'] if not q_row.empty else f"Question ID {q_id}"
-            
             # Affichage dans le CSV
             if isinstance(val, list) and val:
                 # Si ce sont des objets fichiers (avant save) ou des liens (après save ?)
@@ -343,31 +2621,232 @@ def create_csv_export(collected_data, df_struct):
                 "Projet": project_name,
                 "Phase": phase_name,
                 "ID": q_id,
-                "Question": q_text,
+                "Question": None,
                 "Réponse": final_val
             })
             
-    df_export = pd.DataFrame(rows)
+    df_export = pd.DataFrame(rows, columns=["ID Formulaire", "Date Début", "Date Fin", "Projet", "Phase", "ID", "Question", "Réponse"])
+    # Intitulés des questions en une seule jointure sur l'id (et non une recherche par réponse)
+    question_ids = pd.to_numeric(df_export["ID"], errors='coerce')
+    question_texts = pd.Series({q_id: q.text for q_id, q in form_model.questions_by_id.items()}, dtype=object)
+    question_texts[COMMENT_ID] = "Commentaire Écart Photo"
+    df_export["Question"] = question_ids.map(question_texts).fillna("Question ID " + df_export["ID"].astype(str))
     return df_export.to_csv(index=False, sep=';', encoding='utf-8-sig')
 
-def create_zip_export(collected_data):
+# Archives déjà construites, servies depuis le disque tant que la soumission ne change pas
+ZIP_CACHE_DIR = os.path.join(tempfile.gettempdir(), "questionnaire_chantier", "zip_cache")
+ZIP_CACHE_TTL_SECONDS = 7 * 24 * 3600
+_UNSAFE_PATH_CHARS = re.compile(r'[\\/:*?"<>|]+')
+drive_file_id = report_builder.drive_file_id
+
+def _safe_path_part(text):
+    return _UNSAFE_PATH_CHARS.sub('_', str(text)).strip() or '_'
+
+def load_submission(doc_id):
+    """(en-tête, phases) d'une soumission enregistrée dans FormAnswers, ou None si absente."""
+    snapshot = get_db().collection(ANSWERS_COLLECTION).document(doc_id).get()
+    if not snapshot.exists:
+        return None
+    header = snapshot.to_dict() or {}
+    if 'collected_phases' in header:  # Ancien format : phases dans l'en-tête
+        phases = header['collected_phases']
+    else:
+        phases = [doc.to_dict() or {} for doc in snapshot.reference.collection(PHASES_SUBCOLLECTION).order_by('index').stream()]
+    return header, phases
+
+def load_submission_photo_links(doc_id):
+    """[(phase, id question, lien)] des photos d'une soumission enregistrée dans FormAnswers."""
+    submission = load_submission(doc_id)
+    if submission is None:
+        return []
+    _header, phases = submission
+    links = []
+    for phase in phases:
+        for q_id, value in (phase.get('answers') or {}).items():
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, str) and item.startswith('http'):
+                    links.append((phase.get('phase_name', ''), q_id, item))
+    return links
+
+def _download_drive_file(drive, file_id, directory):
+    """Télécharge un fichier Drive par morceaux dans un fichier temporaire (sans appel Streamlit). Retourne (chemin, nom)."""
+    metadata = drive.execute(drive.service.files().get(fileId=file_id, fields='name'))
+    request = drive.service.files().get_media(fileId=file_id)
+    fd, path = tempfile.mkstemp(dir=directory)
+    try:
+        with drive.lease() as http, os.fdopen(fd, 'wb') as fh:
+            request.http = http
+            downloader = MediaIoBaseDownload(fh, request, chunksize=DRIVE_UPLOAD_CHUNK_SIZE)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk(num_retries=DRIVE_CHUNK_MAX_RETRIES)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, metadata.get('name') or file_id
+
+def _purge_cache_dir(directory, ttl_seconds):
+    """Supprime les fichiers d'un répertoire de cache non utilisés depuis ttl_seconds."""
+    limit = time.time() - ttl_seconds
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.isfile(path) and os.stat(path).st_mtime < limit:
+                os.remove(path)
+        except OSError:
+            pass
+
+def create_zip_export(doc_id, on_progress=None):
     """
-    MODIFIÉE : Crée un ZIP contenant un fichier texte explicatif au lieu des photos,
-    puisque les photos sont envoyées sur Drive.
+    Archive ZIP des photos d'une soumission, entrées phase/id_question/nom_du_fichier.
+    Les fichiers Drive sont téléchargés en parallèle par morceaux vers des fichiers temporaires
+    puis copiés sans recompression (ZIP_STORED) : la mémoire dépend de la taille des morceaux,
+    pas de celle de l'archive. Retourne (chemin de l'archive ou None, erreurs).
     """
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-        # Création du message explicatif
-        msg = (
-            "Les photos de ce projet ont été automatiquement transférées vers Google Drive.\n"
-            "Veuillez consulter le dossier Google Drive correspondant au projet.\n\n"
-            f"ID Soumission : {st.session_state.get('submission_id', 'N/A')}\n"
-            f"Date : {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        )
-        zip_file.writestr("LISEZ_MOI_PHOTOS_DRIVE.txt", msg)
-                    
-    return zip_buffer
+    entries = load_submission_photo_links(doc_id)
+    if not entries:
+        return None, []
+    digest = hashlib.sha256("\n".join([doc_id] + [link for _, _, link in entries]).encode('utf-8')).hexdigest()[:16]
+    zip_path = os.path.join(ZIP_CACHE_DIR, f"{_safe_path_part(doc_id)}_{digest}.zip")
+    if os.path.exists(zip_path):
+        os.utime(zip_path)
+        return zip_path, []
+    os.makedirs(ZIP_CACHE_DIR, exist_ok=True)
+    _purge_cache_dir(ZIP_CACHE_DIR, ZIP_CACHE_TTL_SECONDS)
+
+    errors = []
+    by_file_id = {}
+    for phase_name, q_id, link in entries:
+        file_id = drive_file_id(link)
+        if file_id is None:
+            errors.append(f"Lien Drive non reconnu : {link}")
+            continue
+        by_file_id.setdefault(file_id, []).append((phase_name, q_id))
+
+    drive = get_drive_client()
+    tmp_zip = f"{zip_path}.{uuid.uuid4().hex}.tmp"
+    used_names = set()
+    with tempfile.TemporaryDirectory(dir=ZIP_CACHE_DIR) as work_dir, \
+            ThreadPoolExecutor(max_workers=DRIVE_UPLOAD_WORKERS, thread_name_prefix="drive-zip") as pool, \
+            zipfile.ZipFile(tmp_zip, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        futures = {pool.submit(_download_drive_file, drive, file_id, work_dir): file_id for file_id in by_file_id}
+        for done, future in enumerate(as_completed(futures), 1):
+            file_id = futures[future]
+            try:
+                file_path, file_name = future.result()
+            except Exception as e:
+                errors.append(f"Téléchargement Drive impossible ({file_id}) : {e}")
+            else:
+                for phase_name, q_id in by_file_id[file_id]:
+                    root, ext = os.path.splitext(_safe_path_part(file_name))
+                    arcname = f"{_safe_path_part(phase_name)}/{q_id}/{root}{ext}"
+                    n = 1
+                    while arcname in used_names:
+                        n += 1
+                        arcname = f"{_safe_path_part(phase_name)}/{q_id}/{root}_{n}{ext}"
+                    used_names.add(arcname)
+                    zf.write(file_path, arcname)
+                os.remove(file_path)
+            if on_progress:
+                on_progress(done, len(futures))
+
+    if errors:
+        # Archive incomplète : servie une fois, mais pas mise en cache
+        partial_path = zip_path.replace('.zip', '_incomplet.zip')
+        os.replace(tmp_zip, partial_path)
+        return partial_path, errors
+    os.replace(tmp_zip, zip_path)
+    return zip_path, errors
+
+# --- RAPPORT WORD (DOCX) ---
+
+def _report_setting(key, default):
+    """Lit un paramètre optionnel de la section [report] des secrets."""
+    try:
+        return st.secrets["report"].get(key, default)
+    except Exception:
+        return default
+
+REPORT_DIR = _report_setting("directory", os.path.join(tempfile.gettempdir(), "questionnaire_chantier", "reports"))
+# Miniatures par id de fichier Drive : chaque photo n'est téléchargée et réduite qu'une fois
+REPORT_THUMBNAIL_DIR = os.path.join(REPORT_DIR, "thumbnails")
+REPORT_THUMBNAIL_EDGE = int(_report_setting("thumbnail_edge", report_builder.THUMBNAIL_EDGE))
+REPORT_WORKERS = max(1, int(_report_setting("workers", 2)))
+REPORT_CACHE_TTL_SECONDS = float(_report_setting("cache_ttl_days", 7)) * 24 * 3600
+
+@st.cache_resource
+def get_report_process_pool():
+    """Pool de processus des rapports : miniatures et mise en page DOCX hors du processus Streamlit."""
+    return _start_process_pool(REPORT_WORKERS)
+
+@st.cache_resource
+def get_report_executor():
+    """Threads qui préparent les rapports (lectures Firestore, téléchargements Drive) sans bloquer le script."""
+    return ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+
+def generate_report(doc_id, question_texts, drive, pool):
+    """
+    Rapport DOCX d'une soumission enregistrée (sans appel Streamlit, exécutée dans un thread).
+    Seules les photos sans miniature en cache sont téléchargées ; la mise en page se fait dans
+    le pool de processus. Retourne (chemin du rapport, erreurs).
+    """
+    submission = load_submission(doc_id)
+    if submission is None:
+        raise ValueError(f"Soumission introuvable : {doc_id}")
+    header, phases = submission
+    project_data = header.get('project_details')
+    site_id = header.get('project_site_id')
+    if site_id:
+        snapshot = get_db().collection('Sites').document(site_id).get()
+        if snapshot.exists:
+            project_data = _clean_site_record(snapshot.to_dict())
+    report = report_builder.submission_report(
+        doc_id, header, phases, project_data, question_texts, DISPLAY_GROUPS, PROJECT_RENAME_MAP
+    )
+
+    digest = hashlib.sha256(json.dumps(report, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+    report_path = os.path.join(REPORT_DIR, f"{_safe_path_part(doc_id)}_{digest}.docx")
+    if os.path.exists(report_path):
+        os.utime(report_path)
+        return report_path, []
+    os.makedirs(REPORT_THUMBNAIL_DIR, exist_ok=True)
+    _purge_cache_dir(REPORT_DIR, REPORT_CACHE_TTL_SECONDS)
+    _purge_cache_dir(REPORT_THUMBNAIL_DIR, REPORT_CACHE_TTL_SECONDS)
+
+    file_ids = {file_id for phase in report['phases'] for answer in phase['answers'] for file_id in answer['photos']}
+    missing = [
+        file_id for file_id in file_ids
+        if not os.path.exists(report_builder.thumbnail_path(REPORT_THUMBNAIL_DIR, file_id, REPORT_THUMBNAIL_EDGE))
+    ]
+    errors = []
+    with tempfile.TemporaryDirectory(dir=REPORT_DIR) as work_dir:
+        sources = {}
+        with ThreadPoolExecutor(max_workers=DRIVE_UPLOAD_WORKERS, thread_name_prefix="drive-report") as downloads:
+            futures = {downloads.submit(_download_drive_file, drive, file_id, work_dir): file_id for file_id in missing}
+            for future in as_completed(futures):
+                try:
+                    sources[futures[future]] = future.result()[0]
+                except Exception as e:
+                    errors.append(f"Téléchargement Drive impossible ({futures[future]}) : {e}")
+        # Rapport incomplet (photos manquantes) : servi une fois, mais pas mis en cache
+        output_path = report_path.replace('.docx', '_incomplet.docx') if errors else report_path
+        pool.submit(
+            report_builder.build_report, report, sources, REPORT_THUMBNAIL_DIR, output_path, REPORT_THUMBNAIL_EDGE
+        ).result()
+    return output_path, errors
+
+def report_question_texts():
+    """id de question -> intitulé, pris dans le modèle du formulaire de la session."""
+    return {q_id: question.text for q_id, question in current_form_model().questions_by_id.items()}
+
+def start_report_generation(doc_id):
+    """Lance la génération en arrière-plan ; le résultat (Future) est suivi dans la session."""
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    future = get_report_executor().submit(
+        generate_report, doc_id, report_question_texts(), get_drive_client(), get_report_process_pool()
+    )
+    st.session_state['report_future'] = future
+    return future
 
 # --- GESTION DE L'ÉTAT (inchangée) ---
 def init_session_state():
@@ -383,7 +2862,14 @@ def init_session_state():
         'id_rendering_ident': None,
         'form_start_time': None,
         'submission_id': None,
-        'show_comment_on_error': False
+        'show_comment_on_error': False,
+        'background_uploads': {},
+        'submission_doc_id': None,
+        'project_site_id': None,
+        'form_version': None,
+        'project_profile': None,
+        'spooled_files': {},
+        'report_future': None
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -391,122 +2877,289 @@ def init_session_state():
 
 init_session_state()
 
-# --- LOGIQUE MÉTIER (inchangée) ---
+# --- LOGIQUE MÉTIER ---
 
-def check_condition(row, current_answers, collected_data):
-    try:
-        if int(row.get('Condition on', 0)) != 1: return True
-    except (ValueError, TypeError): return True
+class AnswerIndex:
+    """Réponses à plat des phases validées (la plus récente l'emporte), mises à jour par ajout."""
 
-    all_past_answers = {}
-    for phase_data in collected_data: all_past_answers.update(phase_data['answers'])
-    combined_answers = {**all_past_answers, **current_answers}
-    
-    condition_str = str(row.get('Condition value', '')).strip()
-    if not condition_str or "=" not in condition_str: return True
+    def __init__(self, collected_data=()):
+        self.answers = {}
+        self.phase_count = 0
+        for phase_data in collected_data:
+            self.apply_phase(phase_data)
 
-    try:
-        target_id_str, expected_value_raw = condition_str.split('=', 1)
-        target_id = int(target_id_str.strip())
-        expected_value = expected_value_raw.strip().strip('"').strip("'")
-        user_answer = combined_answers.get(target_id)
-        if user_answer is not None:
-            return str(user_answer).lower() == str(expected_value).lower()
-        else:
-            return False
-    except Exception: return True
+    def apply_phase(self, phase_data):
+        self.answers.update(phase_data['answers'])
+        self.phase_count += 1
+
+def get_answer_index(collected_data):
+    """Index de la session, reconstruit seulement si collected_data a changé hors append_collected_phase."""
+    index = st.session_state.get('answer_index')
+    if index is None or index.phase_count != len(collected_data):
+        index = AnswerIndex(collected_data)
+        st.session_state['answer_index'] = index
+    return index
+
+def append_collected_phase(entry):
+    """Ajoute une phase validée à collected_data et à l'index des réponses."""
+    collected_data = st.session_state['collected_data']
+    index = get_answer_index(collected_data)
+    collected_data.append(entry)
+    index.apply_phase(entry)
+    checkpoint_phase(entry, len(collected_data) - 1)
+
+def _answer_lookup(current_answers, past_answers):
+    def lookup(q_id):
+        if q_id in current_answers:
+            return current_answers[q_id]
+        return past_answers.get(q_id)
+    return lookup
+
+_UNSEEN = object()
+
+class VisibilityTracker:
+    """
+    Cache de visibilité des questions conditionnelles. Quand la réponse d'une question cible
+    change, seules les questions qui en dépendent (graphe du FormModel) sont réévaluées.
+    """
+
+    def __init__(self, form_model):
+        self.form_model = form_model
+        self._seen = {}
+        self._visible = {}
+
+    def is_visible(self, question, lookup):
+        condition = question.condition
+        if condition is None:
+            return True
+        for target in condition.targets:
+            value = lookup(target)
+            fingerprint = None if value is None else str(value).lower()
+            if self._seen.get(target, _UNSEEN) != fingerprint:
+                self._seen[target] = fingerprint
+                for key in self.form_model.dependents.get(target, ()):
+                    self._visible.pop(key, None)
+        key = (question.section, question.id)
+        if key not in self._visible:
+            self._visible[key] = condition.evaluate(lookup)
+        return self._visible[key]
+
+def check_condition(question, current_answers, collected_data):
+    if question.condition is None: return True
+    lookup = _answer_lookup(current_answers, get_answer_index(collected_data).answers)
+    form_model = current_form_model()
+    if form_model is None:
+        return question.condition.evaluate(lookup)
+    tracker = st.session_state.get('visibility_tracker')
+    if tracker is None or tracker.form_model is not form_model:
+        tracker = VisibilityTracker(form_model)
+        st.session_state['visibility_tracker'] = tracker
+    return tracker.is_visible(question, lookup)
 
 # -----------------------------------------------------------
 # --- FONCTION VALIDATION (Strictement identique à votre demande) ---
 # -----------------------------------------------------------
 COMMENT_ID = 100
 COMMENT_QUESTION = "Veuillez préciser pourquoi le nombre de photo partagé ne correspond pas au minimum attendu"
+COMMENT_QUESTION_ITEM = Question(id=COMMENT_ID, section="", text=COMMENT_QUESTION, type='text', mandatory=True)
 
-def validate_section(df_questions, section_name, answers, collected_data):
-    missing = []
-    section_rows = df_questions[df_questions['section'] == section_name]
-    
-    comment_val = answers.get(COMMENT_ID)
-    has_justification = comment_val is not None and str(comment_val).strip() != ""
-    project_data = st.session_state.get('project_data', {})
-    
-    expected_total, detail_str = get_expected_photo_count(section_name.strip(), project_data)
-    
-    photo_question_count = sum(
-        1 for _, row in section_rows.iterrows()
-        if str(row.get('type', '')).strip().lower() == 'photo'
+def _photo_gap_message(section_name, expected_total, detail_str, current_photo_count):
+    error_message = (
+        f"⚠️ **Écart de Photos pour '{str(section_name)}'**.\n\n"
+        f"Attendu : **{str(expected_total)}** (calculé : {str(detail_str)}).\n\n"
+        f"Reçu : **{str(current_photo_count)}**.\n\n"
+        f"Veuillez remplir le champ de commentaire."
     )
-    
-    if expected_total is not None and expected_total > 0:
-        expected_total = expected_total * photo_question_count
-        detail_str = (
-            f"{detail_str} | Multiplieur questions photo: {photo_question_count} "
-            f"-> Total ajusté: {expected_total}"
-        )
-
-    current_photo_count = 0
-    photo_questions_found = False
-    
-    for _, row in section_rows.iterrows():
-        if str(row['type']).strip().lower() == 'photo':
-            photo_questions_found = True
-            q_id = int(row['id'])
-            val = answers.get(q_id)
-            if isinstance(val, list):
-                current_photo_count += len(val)
-
-    is_count_sufficient = (
-        expected_total is None or expected_total == 0 or 
-        (expected_total > 0 and current_photo_count >= expected_total)
+    return (
+        f"**Commentaire (ID {COMMENT_ID}) :** {COMMENT_QUESTION} "
+        f"(requis en raison de l'écart de photo : Attendu {expected_total}, Reçu {current_photo_count}).\n\n"
+        f"{error_message}"
     )
-    
-    for _, row in section_rows.iterrows():
-        if int(row['id']) == COMMENT_ID: continue
-        if not check_condition(row, answers, collected_data): continue
-        
-        is_mandatory = str(row['obligatoire']).strip().lower() == 'oui'
-        q_id = int(row['id'])
-        q_type = str(row['type']).strip().lower()
-        val = answers.get(q_id)
-        
-        if is_mandatory:
-            if q_type == 'photo' and (is_count_sufficient or has_justification):
-                continue
-            
-            if isinstance(val, list):
-                if not val: missing.append(f"Question {q_id} : {row['question']} (photo(s) manquante(s))")
-            elif val is None or val == "" or (isinstance(val, (int, float)) and val == 0):
-                missing.append(f"Question {q_id} : {row['question']}")
-
-    is_photo_count_incorrect = False
-    if expected_total is not None and expected_total > 0:
-        if photo_questions_found and current_photo_count != expected_total:
-            is_photo_count_incorrect = True
-            error_message = (
-                f"⚠️ **Écart de Photos pour '{str(section_name)}'**.\n\n"
-                f"Attendu : **{str(expected_total)}** (calculé : {str(detail_str)}).\n\n"
-                f"Reçu : **{str(current_photo_count)}**.\n\n"
-                f"Veuillez remplir le champ de commentaire."
+
+@dataclass(frozen=True, slots=True)
+class ValidationStatus:
+    """État courant de la section, affiché pendant la saisie."""
+    missing: int
+    photo_count: int
+    expected_photos: object
+    photo_gap: bool
+    justified: bool
+
+class SectionValidator:
+    """
+    Validation d'une section tenue à jour pendant la saisie : à chaque update(), seules les
+    questions dont la réponse a changé, et celles dont la visibilité en dépend, sont
+    revérifiées ; le total de photos est ajusté par différence. result() rend alors le même
+    verdict que l'ancienne passe complète, sans reparcourir la section.
+    """
+
+    def __init__(self, form_model, section_name, phase_count):
+        self.form_model = form_model
+        self.section_name = section_name
+        self.phase_count = phase_count
+        self.questions = form_model.questions(section_name)
+        self._positions = {}
+        for pos, question in enumerate(self.questions):
+            self._positions.setdefault(question.id, []).append(pos)
+
+        expected_total, detail_str = expected_photo_count(section_name.strip())
+        photo_question_count = form_model.photo_question_count.get(section_name, 0)
+        if expected_total is not None and expected_total > 0:
+            expected_total = expected_total * photo_question_count
+            detail_str = (
+                f"{detail_str} | Multiplieur questions photo: {photo_question_count} "
+                f"-> Total ajusté: {expected_total}"
             )
-            if not has_justification:
-                missing.append(
-                    f"**Commentaire (ID {COMMENT_ID}) :** {COMMENT_QUESTION} "
-                    f"(requis en raison de l'écart de photo : Attendu {expected_total}, Reçu {current_photo_count}).\n\n"
-                    f"{error_message}"
-                )
+        self.expected_total = expected_total
+        self.detail_str = detail_str
+        self.photo_questions_found = photo_question_count > 0
+
+        self.photo_count = 0
+        self.has_justification = False
+        self._seen = {}
+        self._photo_counts = {}
+        self._issues = {}
+
+    def update(self, answers, collected_data):
+        """Revérifie les questions touchées depuis le dernier appel ; retourne leur nombre."""
+        comment_val = answers.get(COMMENT_ID)
+        self.has_justification = comment_val is not None and str(comment_val).strip() != ""
+        dirty = set()
+        for q_id, positions in self._positions.items():
+            # Absente et None diffèrent : une question absente de la phase prend la réponse passée
+            value = answers.get(q_id, _UNSEEN)
+            if q_id in self._seen and (self._seen[q_id] is value or self._seen[q_id] == value):
+                continue
+            self._seen[q_id] = list(value) if isinstance(value, list) else value
+            dirty.update(positions)
+            for section, dep_id in self.form_model.dependents.get(q_id, ()):
+                if section == self.section_name:
+                    dirty.update(self._positions.get(dep_id, ()))
+        for pos in dirty:
+            self._check(pos, answers, collected_data)
+        return len(dirty)
+
+    def _check(self, pos, answers, collected_data):
+        question = self.questions[pos]
+        val = answers.get(question.id)
+        if question.type == 'photo':
+            count = len(val) if isinstance(val, list) else 0
+            self.photo_count += count - self._photo_counts.get(pos, 0)
+            self._photo_counts[pos] = count
+        self._issues.pop(pos, None)
+        if question.id == COMMENT_ID or not question.mandatory:
+            return
+        if not check_condition(question, answers, collected_data):
+            return
+        if isinstance(val, list):
+            if not val: self._issues[pos] = f"Question {question.id} : {question.text} (photo(s) manquante(s))"
+        elif val is None or val == "" or (isinstance(val, (int, float)) and val == 0):
+            self._issues[pos] = f"Question {question.id} : {question.text}"
+
+    def _count_sufficient(self):
+        return (
+            self.expected_total is None or self.expected_total == 0 or
+            (self.expected_total > 0 and self.photo_count >= self.expected_total)
+        )
+
+    def photo_gap(self):
+        return (
+            self.expected_total is not None and self.expected_total > 0
+            and self.photo_questions_found and self.photo_count != self.expected_total
+        )
 
-    if not is_photo_count_incorrect and COMMENT_ID in answers:
-        del answers[COMMENT_ID]
+    def _open_issues(self):
+        # Les questions photo obligatoires sont couvertes par un total suffisant ou une justification
+        waived = self._count_sufficient() or self.has_justification
+        return [
+            message for pos, message in sorted(self._issues.items())
+            if not (waived and self.questions[pos].type == 'photo')
+        ]
 
-    return len(missing) == 0, missing
+    def status(self):
+        gap = self.photo_gap()
+        missing = len(self._open_issues()) + (1 if gap and not self.has_justification else 0)
+        return ValidationStatus(missing, self.photo_count, self.expected_total, gap, self.has_justification)
+
+    def result(self, answers):
+        """(valide, messages) comme l'ancienne validation ; retire la justification devenue inutile."""
+        missing = self._open_issues()
+        is_photo_count_incorrect = self.photo_gap()
+        if is_photo_count_incorrect and not self.has_justification:
+            missing.append(_photo_gap_message(self.section_name, self.expected_total, self.detail_str, self.photo_count))
+        if not is_photo_count_incorrect and COMMENT_ID in answers:
+            del answers[COMMENT_ID]
+        return len(missing) == 0, missing
+
+def get_section_validator(form_model, section_name):
+    """Validateur de la section en cours, recréé pour une autre section, phase ou structure."""
+    phase_count = len(st.session_state['collected_data'])
+    validator = st.session_state.get('section_validator')
+    if (validator is None or validator.form_model is not form_model
+            or validator.section_name != section_name or validator.phase_count != phase_count):
+        validator = SectionValidator(form_model, section_name, phase_count)
+        st.session_state['section_validator'] = validator
+    return validator
+
+def validate_section(form_model, section_name, answers, collected_data):
+    validator = get_section_validator(form_model, section_name)
+    validator.update(answers, collected_data)
+    return validator.result(answers)
 
 validate_phase = validate_section
 validate_identification = validate_section
 
+# --- MESURE DU TEMPS DE RENDU ---
+
+def _ui_setting(key, default):
+    """Lit un paramètre optionnel de la section [ui] des secrets."""
+    try:
+        return st.secrets["ui"].get(key, default)
+    except Exception:
+        return default
+
+UI_SHOW_RERUN_TIMINGS = bool(_ui_setting("show_rerun_timings", False))
+RERUN_TIMINGS_KEPT = 200
+# Passe à False à la fin d'une exécution complète : les appels suivants d'un fragment sont
+# alors des réexécutions partielles (le script n'est pas relancé, seul le fragment l'est)
+_RUN_STATE = {'full_run': True}
+
+def record_rerun_timing(kind, started):
+    """Ajoute la durée (ms) d'une exécution complète ou d'un fragment à l'historique de la session."""
+    timings = st.session_state.get('rerun_timings')
+    if timings is None:
+        timings = st.session_state['rerun_timings'] = collections.deque(maxlen=RERUN_TIMINGS_KEPT)
+    timings.append((kind, st.session_state.get('step'), (time.perf_counter() - started) * 1000))
+
+@contextmanager
+def fragment_timer(name):
+    """Mesure une réexécution partielle du fragment (pas son passage lors d'une exécution complète)."""
+    started = time.perf_counter()
+    yield
+    if not _RUN_STATE['full_run']:
+        record_rerun_timing(f"fragment {name}", started)
+
+def render_rerun_timings():
+    """Médiane et p95 des temps de rendu par type d'exécution et par étape."""
+    groups = {}
+    for kind, step, ms in st.session_state.get('rerun_timings') or ():
+        groups.setdefault((kind, step), []).append(ms)
+    rows = []
+    for (kind, step), values in sorted(groups.items(), key=lambda item: (str(item[0][1]), item[0][0])):
+        values.sort()
+        rows.append({'exécution': kind, 'étape': step, 'n': len(values),
+                     'médiane (ms)': round(values[len(values) // 2], 1),
+                     'p95 (ms)': round(values[min(len(values) - 1, int(len(values) * 0.95))], 1)})
+    with st.sidebar.expander("⏱️ Temps de rendu", expanded=False):
+        if rows:
+            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+        else:
+            st.caption("Aucune mesure pour l'instant.")
+
 # --- COMPOSANTS UI (inchangés) ---
 
-def render_question(row, answers, phase_name, key_suffix, loop_index):
-    q_id = int(row.get('id', 0))
+def render_question(question, answers, phase_name, key_suffix, loop_index):
+    q_id = question.id
     is_dynamic_comment = q_id == COMMENT_ID
     if is_dynamic_comment:
         q_text = COMMENT_QUESTION
@@ -515,14 +3168,12 @@ def render_question(row, answers, phase_name, key_suffix, loop_index):
         q_mandatory = True 
         q_options = []
     else:
-        q_text = row['question']
-        q_type = str(row['type']).strip().lower()
-        q_desc = row['Description']
-        q_mandatory = str(row['obligatoire']).lower() == 'oui'
-        q_options = str(row['options']).split(',') if row['options'] else []
+        q_text = question.text
+        q_type = question.type
+        q_desc = question.description
+        q_mandatory = question.mandatory
+        q_options = question.options
         
-    q_text = str(q_text).strip()
-    q_desc = str(q_desc).strip()
     label_html = f"<strong>{q_id}. {q_text}</strong>" + (' <span class="mandatory">*</span>' if q_mandatory else "")
     widget_key = f"q_{q_id}_{phase_name}_{key_suffix}_{loop_index}"
     current_val = answers.get(q_id)
@@ -538,7 +3189,7 @@ def render_question(row, answers, phase_name, key_suffix, loop_index):
              val = st.text_input("Réponse", value=current_val if current_val else "", key=widget_key, label_visibility="collapsed")
 
     elif q_type == 'select':
-        clean_opts = [opt.strip() for opt in q_options]
+        clean_opts = list(q_options)
         if "" not in clean_opts: clean_opts.insert(0, "")
         idx = clean_opts.index(current_val) if current_val in clean_opts else 0
         val = st.selectbox("Sélection", clean_opts, index=idx, key=widget_key, label_visibility="collapsed")
@@ -552,7 +3203,7 @@ def render_question(row, answers, phase_name, key_suffix, loop_index):
             val = st.number_input("Nombre", value=default_val, key=widget_key, label_visibility="collapsed")
     
     elif q_type == 'photo':
-        expected, details = get_expected_photo_count(phase_name.strip(), st.session_state.get('project_data'))
+        expected, details = expected_photo_count(phase_name.strip())
         if expected is not None and expected > 0:
             st.info(f"📸 **Photos :** Il est attendu **{expected}** photos pour cette section (Total des bornes : {details}).")
             st.divider()
@@ -560,6 +3211,8 @@ def render_question(row, answers, phase_name, key_suffix, loop_index):
         val = st.file_uploader("Images", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True, key=widget_key, label_visibility="collapsed")
         
         if val:
+            # La session ne garde que des handles : le contenu est sur disque
+            val = spool_uploaded_files(val)
             file_names = ", ".join([f.name for f in val])
             st.success(f"Nombre d'images chargées : {len(val)} ({file_names})")
         elif current_val and isinstance(current_val, list) and current_val:
@@ -573,276 +3226,460 @@ def render_question(row, answers, phase_name, key_suffix, loop_index):
     elif is_dynamic_comment and (val is None or val.strip() == ""):
         if q_id in answers: del answers[q_id]
 
+@st.fragment
+def render_question_block(section_name, indexes, key_suffix, skip_comment=False):
+    """
+    Bloc de questions réexécuté seul quand l'un de ses widgets change (voir FormModel.render_blocks) :
+    la question modifiée et celles dont la visibilité en dépend, sans relancer tout le script.
+    """
+    with fragment_timer("questions"):
+        questions = current_form_model().questions(section_name)
+        answers = st.session_state['current_phase_temp']
+        for idx in indexes:
+            question = questions[idx]
+            if skip_comment and question.id == COMMENT_ID: continue
+            if check_condition(question, answers, st.session_state['collected_data']):
+                render_question(question, answers, section_name, key_suffix, idx)
+        if not _RUN_STATE['full_run']:
+            refresh_section_status(section_name)
+
+def render_section_questions(form_model, section_name, key_suffix, skip_comment=False):
+    """Questions d'une section, un fragment par bloc de questions liées par leurs conditions."""
+    for indexes in form_model.render_blocks.get(section_name, ()):
+        render_question_block(section_name, indexes, key_suffix, skip_comment)
+
+@st.fragment
+def render_comment_question(section_name, key_suffix):
+    """Justification de l'écart photo (saisie libre réexécutée seule)."""
+    with fragment_timer("justification"):
+        render_question(COMMENT_QUESTION_ITEM, st.session_state['current_phase_temp'], section_name, key_suffix, 999)
+        if not _RUN_STATE['full_run']:
+            refresh_section_status(section_name)
+
+def refresh_section_status(section_name):
+    """
+    Réexécution partielle d'un fragment de questions : met le validateur à jour et, seulement si
+    le résumé affiché change (point complété, écart photo...), relance l'exécution complète qui
+    le réaffiche. Une frappe qui ne change pas l'état reste limitée au fragment.
+    """
+    validator = get_section_validator(current_form_model(), section_name)
+    before = validator.status()
+    validator.update(st.session_state['current_phase_temp'], st.session_state['collected_data'])
+    if validator.status() != before:
+        st.rerun()
+
+def render_live_status(section_name):
+    """Résumé de la validation en cours, affiché lors de l'exécution complète (lecture du validateur)."""
+    validator = st.session_state.get('section_validator')
+    if validator is None or validator.section_name != section_name:
+        return
+    status = validator.status()
+    photo_text = ""
+    if status.expected_photos:
+        photo_text = f" · 📸 Photos : {status.photo_count}/{status.expected_photos}"
+        if status.photo_gap and status.justified:
+            photo_text += " (écart justifié)"
+    if status.missing == 0:
+        st.success(f"✅ Prêt à valider{photo_text}")
+    else:
+        st.warning(f"⏳ {status.missing} point(s) à compléter{photo_text}")
+
+def render_project_header():
+    """Détails du projet et phases déjà complétées (affichage seul, sans widget : pas de fragment)."""
+    project_details = st.session_state['project_data']
+    project_intitule = project_details.get('Intitulé', 'Projet Inconnu')
+    with st.expander(f"📍 Projet : {project_intitule}", expanded=False):
+        st.markdown(":orange-badge[**Détails du Projet sélectionné :**]")
+        for group_title, fields in zip(
+            ["Points de charge Standard", "Points de charge Standard", "Points de charge Pré-équipés"], DISPLAY_GROUPS
+        ):
+            with st.container(border=True):
+                st.markdown(f"**{group_title}**")
+                cols = st.columns([1, 1, 1])
+                for i, field_key in enumerate(fields):
+                    renamed_key = PROJECT_RENAME_MAP.get(field_key, field_key)
+                    value = project_details.get(field_key, 'N/A')
+                    with cols[i]: st.markdown(f"**{renamed_key}** : {value}")
+
+        st.write(":orange-badge[**Phases et Identification déjà complétées :**]")
+        for idx, item in enumerate(st.session_state['collected_data']):
+            st.write(f"• **{item['phase_name']}** : {len(item['answers'])} réponses")
+        uploaded_count, upload_total = background_upload_status()
+        if upload_total:
+            st.caption(f"☁️ Photos envoyées sur Drive : {uploaded_count}/{upload_total}")
+
+def render_reference_memory():
+    """Mémoire occupée par les tables de référence partagées (une seule copie par processus)."""
+    rows = get_reference_store().memory_report()
+    site_store = get_site_store()
+    rows.append({'table': 'sites (intitulés)', 'version': None, 'courante': True,
+                 'lignes': site_store.searchable_count(),
+                 'mémoire (Ko)': round(site_store.memory_bytes() / 1024, 1)})
+    with st.sidebar.expander("📊 Tables de référence", expanded=False):
+        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
 # --- FLUX PRINCIPAL ---
 
 st.markdown('<div class="main-header"><h1>📝Formulaire Chantier </h1></div>', unsafe_allow_html=True)
 
-if st.session_state['step'] == 'PROJECT_LOAD':
-    st.info("Tentative de chargement de la structure des formulaires...")
-    with st.spinner("Chargement en cours..."):
-        df_struct = load_form_structure_from_firestore()
-        df_site = load_site_data_from_firestore()
-        
-        if df_struct is not None and df_site is not None:
-            st.session_state['df_struct'] = df_struct
-            st.session_state['df_site'] = df_site
-            st.session_state['step'] = 'PROJECT'
-            st.rerun()
-        else:
-            st.error("Impossible de charger les données.")
-            if st.button("Réessayer le chargement"):
-                load_form_structure_from_firestore.clear() 
-                load_site_data_from_firestore.clear() 
-                st.session_state['step'] = 'PROJECT_LOAD'
-                st.rerun()
+try:
+    restore_message = st.session_state.pop('draft_restore_message', None)
+    if restore_message:
+        st.success(restore_message)
+    check_form_version()
+    render_outbox_status()
 
-elif st.session_state['step'] == 'PROJECT':
-    df_site = st.session_state['df_site']
-    st.markdown("### 🏗️ Sélection du Chantier")
-    
-    if 'Intitulé' not in df_site.columns:
-        st.error("Colonne 'Intitulé' manquante.")
-    else:
-        search_term = st.text_input("Rechercher un projet (Veuillez renseigner au minimum 3 caractères pour le nom de la ville)", key="project_search_input").strip()
-        filtered_projects = []
-        selected_proj = None
-        
-        if len(search_term) >= 3:
-            mask = df_site['Intitulé'].str.contains(search_term, case=False, na=False)
-            filtered_projects_df = df_site[mask]
-            filtered_projects = [""] + filtered_projects_df['Intitulé'].dropna().unique().tolist()
-            if filtered_projects:
-                selected_proj = st.selectbox("Résultats de la recherche", filtered_projects)
-            else:
-                st.warning(f"Aucun projet trouvé pour **'{search_term}'**.")
-        elif len(search_term) > 0 and len(search_term) < 3:
-            st.info("Veuillez entrer au moins **3 caractères** pour lancer la recherche.")
+    if st.session_state['step'] == 'PROJECT_LOAD':
+        st.info("Tentative de chargement de la structure des formulaires...")
+        with st.spinner("Chargement en cours..."):
+            form_table = load_form_table()
+            site_store = get_site_store()
         
-        if selected_proj:
-            row = df_site[df_site['Intitulé'] == selected_proj].iloc[0]
-            st.info(f"Projet sélectionné : **{selected_proj}**")
-            if st.button("✅ Démarrer l'identification"):
-                st.session_state['project_data'] = row.to_dict()
-                st.session_state['form_start_time'] = datetime.now() 
-                st.session_state['submission_id'] = str(uuid.uuid4())
-                st.session_state['step'] = 'IDENTIFICATION'
-                st.session_state['current_phase_temp'] = {}
-                st.session_state['iteration_id'] = str(uuid.uuid4())
-                st.session_state['show_comment_on_error'] = False
+            if form_table is not None and site_store.wait_ready():
+                st.session_state['form_version'] = form_table.version
+                st.session_state['step'] = 'PROJECT'
                 st.rerun()
+            else:
+                st.error("Impossible de charger les données.")
+                if st.button("Réessayer le chargement"):
+                    get_reference_store().invalidate(FORM_TABLE)
+                    get_site_store().restart()
+                    st.session_state['step'] = 'PROJECT_LOAD'
+                    st.rerun()
+
+    elif st.session_state['step'] == 'PROJECT':
+        render_reference_memory()
+        site_store = get_site_store()
+
+        # Lien de reprise conservé dans l'URL (?draft=...) après un rechargement de la page
+        pending_draft = st.query_params.get('draft')
+        if pending_draft:
+            st.warning("Un audit non envoyé a été trouvé pour cette page.")
+            c1, c2 = st.columns(2)
+            with c1:
+                if st.button("📂 Reprendre l'audit en cours"):
+                    ok, msg = restore_draft(pending_draft)
+                    if ok:
+                        st.session_state['draft_restore_message'] = msg
+                        st.rerun()
+                    st.error(msg)
+            with c2:
+                if st.button("Ignorer"):
+                    del st.query_params['draft']
+                    st.rerun()
 
-elif st.session_state['step'] == 'IDENTIFICATION':
-    df = st.session_state['df_struct']
-    ID_SECTION_NAME = df['section'].iloc[0]
-    st.markdown(f"### 👤 Étape unique : {ID_SECTION_NAME}")
-    identification_questions = df[df['section'] == ID_SECTION_NAME]
-    if st.session_state['id_rendering_ident'] is None: st.session_state['id_rendering_ident'] = str(uuid.uuid4())
-    rendering_id = st.session_state['id_rendering_ident']
+        st.markdown("### 🏗️ Sélection du Chantier")
     
-    for idx, (index, row) in enumerate(identification_questions.iterrows()):
-        if check_condition(row, st.session_state['current_phase_temp'], st.session_state['collected_data']):
-            render_question(row, st.session_state['current_phase_temp'], ID_SECTION_NAME, rendering_id, idx)
-            
-    st.markdown("---")
-    if st.button("✅ Valider l'identification"):
-        is_valid, errors = validate_identification(df, ID_SECTION_NAME, st.session_state['current_phase_temp'], st.session_state['collected_data'])
-        if is_valid:
-            id_entry = {"phase_name": ID_SECTION_NAME, "answers": st.session_state['current_phase_temp'].copy()}
-            st.session_state['collected_data'].append(id_entry)
-            st.session_state['identification_completed'] = True
-            st.session_state['step'] = 'LOOP_DECISION'
-            st.session_state['current_phase_temp'] = {}
-            st.session_state['show_comment_on_error'] = False
-            st.success("Identification validée.")
-            st.rerun()
+        if site_store.searchable_count() == 0:
+            st.error("Colonne 'Intitulé' manquante.")
         else:
-            st.markdown('<div class="error-box"><b>⚠️ Erreur de validation :</b><br>' + '<br>'.join([f"- {e}" for e in errors]) + '</div>', unsafe_allow_html=True)
-
-elif st.session_state['step'] in ['LOOP_DECISION', 'FILL_PHASE']:
-    project_intitule = st.session_state['project_data'].get('Intitulé', 'Projet Inconnu')
-    with st.expander(f"📍 Projet : {project_intitule}", expanded=False):
-        project_details = st.session_state['project_data']
-        st.markdown(":orange-badge[**Détails du Projet sélectionné :**]")
+            search_term = st.text_input("Rechercher un projet (Veuillez renseigner au minimum 3 caractères pour le nom de la ville)", key="project_search_input").strip()
+            selected_site_id = None
         
-        with st.container(border=True):
-            st.markdown("**Points de charge Standard**")
-            cols1 = st.columns([1, 1, 1]) 
-            fields_l1 = DISPLAY_GROUPS[0]
-            for i, field_key in enumerate(fields_l1):
-                renamed_key = PROJECT_RENAME_MAP.get(field_key, field_key)
-                value = project_details.get(field_key, 'N/A')
-                with cols1[i]: st.markdown(f"**{renamed_key}** : {value}")
-                    
-        with st.container(border=True):
-            st.markdown("**Points de charge Standard**")
-            cols2 = st.columns([1, 1, 1])
-            fields_l2 = DISPLAY_GROUPS[1]
-            for i, field_key in enumerate(fields_l2):
-                renamed_key = PROJECT_RENAME_MAP.get(field_key, field_key)
-                value = project_details.get(field_key, 'N/A')
-                with cols2[i]: st.markdown(f"**{renamed_key}** : {value}")
-
-        with st.container(border=True):
-            st.markdown("**Points de charge Pré-équipés**")
-            cols3 = st.columns([1, 1, 1])
-            fields_l3 = DISPLAY_GROUPS[2]
-            for i, field_key in enumerate(fields_l3):
-                renamed_key = PROJECT_RENAME_MAP.get(field_key, field_key)
-                value = project_details.get(field_key, 'N/A')
-                with cols3[i]: st.markdown(f"**{renamed_key}** : {value}")
+            if len(search_term) >= 3:
+                matches = site_store.search(search_term)
+                if matches:
+                    titles = dict(matches)
+                    filtered_projects = [None] + [site_id for site_id, _ in matches]
+                    selected_site_id = st.selectbox(
+                        "Résultats de la recherche", filtered_projects,
+                        format_func=lambda site_id: titles.get(site_id, "")
+                    )
+                else:
+                    st.warning(f"Aucun projet trouvé pour **'{search_term}'**.")
+            elif len(search_term) > 0 and len(search_term) < 3:
+                st.info("Veuillez entrer au moins **3 caractères** pour lancer la recherche.")
         
-        st.write(":orange-badge[**Phases et Identification déjà complétées :**]")
-        for idx, item in enumerate(st.session_state['collected_data']):
-            st.write(f"• **{item['phase_name']}** : {len(item['answers'])} réponses")
+            if selected_site_id:
+                selected_proj = site_store.title(selected_site_id)
+                st.info(f"Projet sélectionné : **{selected_proj}**")
+                if st.button("✅ Démarrer l'identification"):
+                    try:
+                        project_record = site_store.fetch_record(selected_site_id)
+                    except Exception as e:
+                        project_record = None
+                        st.error(f"Erreur de lecture du site : {e}")
+                    if project_record is None:
+                        st.error("Site introuvable, veuillez relancer la recherche.")
+                        st.stop()
+                    st.session_state['project_data'] = project_record
+                    st.session_state['project_site_id'] = selected_site_id
+                    st.session_state['project_profile'] = build_project_profile(selected_site_id, project_record)
+                    # Un nouveau formulaire démarre sur la dernière version publiée de la structure
+                    form_table = load_form_table()
+                    if form_table is not None:
+                        st.session_state['form_version'] = form_table.version
+                    st.session_state['form_start_time'] = datetime.now() 
+                    st.session_state['submission_id'] = str(uuid.uuid4())
+                    st.session_state['step'] = 'IDENTIFICATION'
+                    st.session_state['current_phase_temp'] = {}
+                    st.session_state['iteration_id'] = str(uuid.uuid4())
+                    st.session_state['show_comment_on_error'] = False
+                    start_draft()
+                    st.rerun()
 
-    if st.session_state['step'] == 'LOOP_DECISION':
-        st.markdown("### 🔄 Gestion des Phases")
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("➕ Ajouter une phase"):
-                st.session_state['step'] = 'FILL_PHASE'
+                site_drafts = list_site_drafts(selected_site_id)
+                if site_drafts:
+                    st.markdown("**📂 Brouillons en cours sur ce chantier**")
+                    draft_labels = dict(site_drafts)
+                    draft_choice = st.selectbox("Brouillon", [d for d, _ in site_drafts], format_func=lambda d: draft_labels[d], key="site_draft_choice")
+                    if st.button("📂 Reprendre ce brouillon"):
+                        ok, msg = restore_draft(draft_choice)
+                        if ok:
+                            st.session_state['draft_restore_message'] = msg
+                            st.rerun()
+                        st.error(msg)
+
+    elif st.session_state['step'] == 'IDENTIFICATION':
+        form_model = current_form_model()
+        ID_SECTION_NAME = form_model.identification_section
+        st.markdown(f"### 👤 Étape unique : {ID_SECTION_NAME}")
+        if st.session_state['id_rendering_ident'] is None: st.session_state['id_rendering_ident'] = str(uuid.uuid4())
+        rendering_id = st.session_state['id_rendering_ident']
+    
+        render_section_questions(form_model, ID_SECTION_NAME, rendering_id)
+        get_section_validator(form_model, ID_SECTION_NAME).update(st.session_state['current_phase_temp'], st.session_state['collected_data'])
+        render_live_status(ID_SECTION_NAME)
+            
+        st.markdown("---")
+        if st.button("✅ Valider l'identification"):
+            is_valid, errors = validate_identification(form_model, ID_SECTION_NAME, st.session_state['current_phase_temp'], st.session_state['collected_data'])
+            if is_valid:
+                id_entry = {"phase_name": ID_SECTION_NAME, "answers": st.session_state['current_phase_temp'].copy()}
+                append_collected_phase(id_entry)
+                start_background_uploads(id_entry, st.session_state['project_data'].get('Intitulé', 'Projet_Inconnu'))
+                st.session_state['identification_completed'] = True
+                st.session_state['step'] = 'LOOP_DECISION'
                 st.session_state['current_phase_temp'] = {}
-                st.session_state['current_phase_name'] = None
-                st.session_state['iteration_id'] = str(uuid.uuid4())
                 st.session_state['show_comment_on_error'] = False
+                st.success("Identification validée.")
                 st.rerun()
-        with col2:
-            if st.button("🏁 Terminer l'audit"):
-                st.session_state['step'] = 'FINISHED'
-                st.rerun()
-        st.markdown('</div>', unsafe_allow_html=True)
-
-    elif st.session_state['step'] == 'FILL_PHASE':
-        df = st.session_state['df_struct']
-        ID_SECTION_NAME = df['section'].iloc[0]
-        ID_SECTION_CLEAN = str(ID_SECTION_NAME).strip().lower()
-        SECTIONS_TO_EXCLUDE_CLEAN = {ID_SECTION_CLEAN, "phase"}
-        all_sections_raw = df['section'].unique().tolist()
-        available_phases = []
-        for sec in all_sections_raw:
-            if pd.isna(sec) or not sec or str(sec).strip().lower() in SECTIONS_TO_EXCLUDE_CLEAN: continue
-            available_phases.append(sec)
+            else:
+                st.markdown('<div class="error-box"><b>⚠️ Erreur de validation :</b><br>' + '<br>'.join([f"- {e}" for e in errors]) + '</div>', unsafe_allow_html=True)
+
+    elif st.session_state['step'] in ['LOOP_DECISION', 'FILL_PHASE']:
+        render_project_header()
+
+        if st.session_state['step'] == 'LOOP_DECISION':
+            st.markdown("### 🔄 Gestion des Phases")
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("➕ Ajouter une phase"):
+                    st.session_state['step'] = 'FILL_PHASE'
+                    st.session_state['current_phase_temp'] = {}
+                    st.session_state['current_phase_name'] = None
+                    st.session_state['iteration_id'] = str(uuid.uuid4())
+                    st.session_state['show_comment_on_error'] = False
+                    st.rerun()
+            with col2:
+                if st.button("🏁 Terminer l'audit"):
+                    st.session_state['step'] = 'FINISHED'
+                    st.rerun()
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        elif st.session_state['step'] == 'FILL_PHASE':
+            form_model = current_form_model()
+            available_phases = list(form_model.available_phases)
         
-        if not st.session_state['current_phase_name']:
-              st.markdown("### 📑 Sélection de la phase")
-              phase_choice = st.selectbox("Quelle phase ?", [""] + available_phases)
-              if phase_choice:
-                  st.session_state['current_phase_name'] = phase_choice
-                  st.session_state['show_comment_on_error'] = False 
-                  st.rerun()
-              if st.button("⬅️ Retour"):
-                  st.session_state['step'] = 'LOOP_DECISION'
-                  st.session_state['current_phase_temp'] = {}
-                  st.session_state['show_comment_on_error'] = False
-                  st.rerun()
-        else:
-            current_phase = st.session_state['current_phase_name']
-            st.markdown(f"### 📝 {current_phase}")
-            if st.button("🔄 Changer de phase"):
-                st.session_state['current_phase_name'] = None
-                st.session_state['current_phase_temp'] = {}
-                st.session_state['iteration_id'] = str(uuid.uuid4())
-                st.session_state['show_comment_on_error'] = False 
-                st.rerun()
-            st.divider()
+            if not st.session_state['current_phase_name']:
+                  st.markdown("### 📑 Sélection de la phase")
+                  phase_choice = st.selectbox("Quelle phase ?", [""] + available_phases)
+                  if phase_choice:
+                      st.session_state['current_phase_name'] = phase_choice
+                      st.session_state['show_comment_on_error'] = False 
+                      st.rerun()
+                  if st.button("⬅️ Retour"):
+                      st.session_state['step'] = 'LOOP_DECISION'
+                      st.session_state['current_phase_temp'] = {}
+                      st.session_state['show_comment_on_error'] = False
+                      st.rerun()
+            else:
+                current_phase = st.session_state['current_phase_name']
+                st.markdown(f"### 📝 {current_phase}")
+                if st.button("🔄 Changer de phase"):
+                    st.session_state['current_phase_name'] = None
+                    st.session_state['current_phase_temp'] = {}
+                    st.session_state['iteration_id'] = str(uuid.uuid4())
+                    st.session_state['show_comment_on_error'] = False 
+                    st.rerun()
+                st.divider()
             
-            section_questions = df[df['section'] == current_phase]
-            visible_count = 0
-            for idx, (index, row) in enumerate(section_questions.iterrows()):
-                if int(row.get('id', 0)) == COMMENT_ID: continue
-                if check_condition(row, st.session_state['current_phase_temp'], st.session_state['collected_data']):
-                    render_question(row, st.session_state['current_phase_temp'], current_phase, st.session_state['iteration_id'], idx)
-                    visible_count += 1
+                section_questions = form_model.questions(current_phase)
+                render_section_questions(form_model, current_phase, st.session_state['iteration_id'], skip_comment=True)
+                visible_count = sum(
+                    1 for question in section_questions
+                    if question.id != COMMENT_ID
+                    and check_condition(question, st.session_state['current_phase_temp'], st.session_state['collected_data'])
+                )
             
-            if visible_count == 0 and not st.session_state.get('show_comment_on_error', False):
-                st.warning("Aucune question visible.")
+                if visible_count == 0 and not st.session_state.get('show_comment_on_error', False):
+                    st.warning("Aucune question visible.")
 
-            if st.session_state.get('show_comment_on_error', False):
+                if st.session_state.get('show_comment_on_error', False):
+                    st.markdown("---")
+                    st.markdown("### ✍️ Justification de l'Écart")
+                    render_comment_question(current_phase, st.session_state['iteration_id'])
+
+                get_section_validator(form_model, current_phase).update(st.session_state['current_phase_temp'], st.session_state['collected_data'])
+                render_live_status(current_phase)
                 st.markdown("---")
-                st.markdown("### ✍️ Justification de l'Écart")
-                comment_row = pd.Series({'id': COMMENT_ID})
-                render_question(comment_row, st.session_state['current_phase_temp'], current_phase, st.session_state['iteration_id'], 999) 
-            
-            st.markdown("---")
-            c1, c2 = st.columns([1, 2])
-            with c1:
-                if st.button("❌ Annuler"):
-                    st.session_state['step'] = 'LOOP_DECISION'
-                    st.session_state['show_comment_on_error'] = False
-                    st.rerun()
-            with c2:
-                if st.button("💾 Valider la phase"):
-                    st.session_state['show_comment_on_error'] = False 
-                    is_valid, errors = validate_phase(df, current_phase, st.session_state['current_phase_temp'], st.session_state['collected_data'])
-                    if is_valid:
-                        new_entry = {"phase_name": current_phase, "answers": st.session_state['current_phase_temp'].copy()}
-                        st.session_state['collected_data'].append(new_entry)
-                        st.success("Enregistré !")
+                c1, c2 = st.columns([1, 2])
+                with c1:
+                    if st.button("❌ Annuler"):
                         st.session_state['step'] = 'LOOP_DECISION'
+                        st.session_state['show_comment_on_error'] = False
                         st.rerun()
-                    else:
-                        is_photo_error = any(f"Commentaire (ID {COMMENT_ID})" in e for e in errors)
-                        if is_photo_error: st.session_state['show_comment_on_error'] = True
-                        html_errors = '<br>'.join([f"- {e}" for e in errors])
-                        st.markdown(f'<div class="error-box"><b>⚠️ Erreurs :</b><br>{html_errors}</div>', unsafe_allow_html=True)
-                        st.rerun()
-            st.markdown('</div>', unsafe_allow_html=True)
+                with c2:
+                    if st.button("💾 Valider la phase"):
+                        st.session_state['show_comment_on_error'] = False 
+                        is_valid, errors = validate_phase(form_model, current_phase, st.session_state['current_phase_temp'], st.session_state['collected_data'])
+                        if is_valid:
+                            new_entry = {"phase_name": current_phase, "answers": st.session_state['current_phase_temp'].copy()}
+                            append_collected_phase(new_entry)
+                            start_background_uploads(new_entry, st.session_state['project_data'].get('Intitulé', 'Projet_Inconnu'))
+                            st.success("Enregistré !")
+                            st.session_state['step'] = 'LOOP_DECISION'
+                            st.rerun()
+                        else:
+                            is_photo_error = any(f"Commentaire (ID {COMMENT_ID})" in e for e in errors)
+                            if is_photo_error: st.session_state['show_comment_on_error'] = True
+                            html_errors = '<br>'.join([f"- {e}" for e in errors])
+                            st.markdown(f'<div class="error-box"><b>⚠️ Erreurs :</b><br>{html_errors}</div>', unsafe_allow_html=True)
+                            st.rerun()
+                st.markdown('</div>', unsafe_allow_html=True)
 
-elif st.session_state['step'] == 'FINISHED':
-    st.markdown("## 🎉 Formulaire Terminé")
-    st.write(f"Projet : **{st.session_state['project_data'].get('Intitulé')}**")
+    elif st.session_state['step'] == 'FINISHED':
+        st.markdown("## 🎉 Formulaire Terminé")
+        st.write(f"Projet : **{st.session_state['project_data'].get('Intitulé')}**")
     
-    if not st.session_state['data_saved']:
-        with st.spinner("Sauvegarde dans Firestore et Upload vers Drive en cours..."):
-            
-            # --- MODIFICATION : Initialisation Drive + Sauvegarde ---
-            drive_service = get_drive_service()
-            success = False
-            submission_id_returned = "Erreur Inconnue"
-            
-            if drive_service:
-                 success, submission_id_returned = save_form_data(
-                     st.session_state['collected_data'], 
-                     st.session_state['project_data'],
-                     drive_service=drive_service # On passe le service ici
-                 )
-            else:
-                 st.error("Impossible d'initialiser Google Drive. Sauvegarde annulée.")
+        if not st.session_state['data_saved']:
+            # Écriture locale durable d'abord : la soumission ne peut plus être perdue
+            if not st.session_state.get('outbox_enqueued'):
+                st.session_state['outbox_enqueued'] = enqueue_submission(
+                    st.session_state['collected_data'], st.session_state['project_data']
+                )
 
-            if success:
-                st.balloons()
-                st.success(f"Données sauvegardées et photos uploadées avec succès ! (ID: {submission_id_returned})")
+            # Une seule livraison à la fois : si le worker détient la soumission, on attend son résultat
+            claimed, outbox_status = claim_foreground_save(st.session_state['submission_id'])
+            if outbox_status == outbox.STATUS_DONE:
+                st.success("Données sauvegardées par la boîte d'envoi du serveur.")
                 st.session_state['data_saved'] = True
+            elif not claimed:
+                render_outbox_delivery(st.session_state['submission_id'])
             else:
-                if drive_service: # Si le service était là mais que save a échoué
-                    st.error(f"Erreur lors de la sauvegarde : {submission_id_returned}")
-                if st.button("Réessayer la sauvegarde"):
-                    st.rerun()
-    else:
-        st.info("Les données ont déjà été sauvegardées sur Firestore et Drive.")
+                with st.spinner("Sauvegarde dans Firestore et Upload vers Drive en cours..."), \
+                        keep_foreground_claim(st.session_state['submission_id']):
+            
+                    # --- MODIFICATION : Initialisation Drive + Sauvegarde ---
+                    drive_service = get_drive_service()
+                    success = False
+                    submission_id_returned = "Erreur Inconnue"
+            
+                    if drive_service:
+                         success, submission_id_returned = save_form_data(
+                             st.session_state['collected_data'], 
+                             st.session_state['project_data'],
+                             drive_service=drive_service # On passe le service ici
+                         )
+                    else:
+                         st.error("Impossible d'initialiser Google Drive. Sauvegarde annulée.")
+
+                    if success:
+                        mark_submission_delivered(submission_id_returned)
+                        st.balloons()
+                        st.success(f"Données sauvegardées et photos uploadées avec succès ! (ID: {submission_id_returned})")
+                        st.session_state['data_saved'] = True
+                    else:
+                        if drive_service: # Si le service était là mais que save a échoué
+                            st.error(f"Erreur lors de la sauvegarde : {submission_id_returned}")
+                        if st.session_state.get('outbox_enqueued'):
+                            hand_over_to_outbox(st.session_state['submission_id'])
+                            st.info(
+                                "📤 Votre audit est enregistré sur le serveur et sera envoyé automatiquement "
+                                "dès que Firestore et Drive seront joignables. Vous pouvez fermer cette page "
+                                "(suivi dans « Envois en attente »)."
+                            )
+                        if st.button("Réessayer la sauvegarde"):
+                            # Clients recréés au cas où l'échec vient d'un jeton expiré ou révoqué
+                            refresh_firestore_client()
+                            refresh_drive_client()
+                            st.rerun()
+        else:
+            st.info("Les données ont déjà été sauvegardées sur Firestore et Drive.")
 
-    st.markdown("---")
+        st.markdown("---")
     
-    if st.session_state['data_saved']:
-        st.markdown("### 📥 Télécharger les données")
-        col_csv, col_zip = st.columns(2)
+        if st.session_state['data_saved']:
+            st.markdown("### 📥 Télécharger les données")
+            col_csv, col_zip = st.columns(2)
         
-        csv_data = create_csv_export(st.session_state['collected_data'], st.session_state['df_struct'])
-        date_str = datetime.now().strftime('%Y%m%d_%H%M')
-        file_name_csv = f"Export_{st.session_state['project_data'].get('Intitulé', 'Projet')}_{date_str}.csv"
+            csv_data = create_csv_export(st.session_state['collected_data'], current_form_model())
+            date_str = datetime.now().strftime('%Y%m%d_%H%M')
+            file_name_csv = f"Export_{st.session_state['project_data'].get('Intitulé', 'Projet')}_{date_str}.csv"
         
-        with col_csv:
-            st.download_button(label="📄 Télécharger les réponses (CSV)", data=csv_data, file_name=file_name_csv, mime='text/csv')
+            with col_csv:
+                st.download_button(label="📄 Télécharger les réponses (CSV)", data=csv_data, file_name=file_name_csv, mime='text/csv')
 
-        # --- Export ZIP Modifié (Info Drive) ---
-        zip_buffer = create_zip_export(st.session_state['collected_data'])
-        
-        with col_zip:
-            if zip_buffer:
-                file_name_zip = f"Infos_Drive_{st.session_state['project_data'].get('Intitulé', 'Projet')}_{date_str}.zip"
-                st.download_button(label="ℹ️ Info Photos Drive (ZIP)", data=zip_buffer.getvalue(), file_name=file_name_zip, mime='application/zip')
+            # --- Export ZIP des photos (construit à la demande depuis Drive) ---
+            with col_zip:
+                file_name_zip = f"Photos_{st.session_state['project_data'].get('Intitulé', 'Projet')}_{date_str}.zip"
+                zip_path = st.session_state.get('photo_zip_path')
+                if not (zip_path and os.path.exists(zip_path)) and st.button("📦 Préparer l'archive des photos (ZIP)"):
+                    progress_bar = st.progress(0.0, text="Récupération des photos depuis Drive...")
+                    try:
+                        zip_path, zip_errors = create_zip_export(
+                            st.session_state['submission_doc_id'],
+                            on_progress=lambda done, total: progress_bar.progress(done / total, text=f"Photos récupérées : {done}/{total}")
+                        )
+                    except Exception as e:
+                        zip_path, zip_errors = None, [f"Erreur de construction de l'archive : {e}"]
+                    progress_bar.empty()
+                    for err in zip_errors:
+                        st.error(err)
+                    if zip_path is None and not zip_errors:
+                        st.info("Aucune photo Drive pour cette soumission.")
+                    st.session_state['photo_zip_path'] = zip_path
+                if zip_path and os.path.exists(zip_path):
+                    with open(zip_path, 'rb') as zip_file:
+                        st.download_button(label="📦 Télécharger les photos (ZIP)", data=zip_file, file_name=file_name_zip, mime='application/zip')
+
+            # --- Rapport Word (généré en arrière-plan : la page reste utilisable pendant la mise en page) ---
+            report_future = st.session_state.get('report_future')
+            if report_future is None:
+                if st.button("📝 Générer le rapport Word (DOCX)"):
+                    start_report_generation(st.session_state['submission_doc_id'])
+                    st.rerun()
+            elif not report_future.done():
+                st.info("📝 Rapport Word en cours de génération (miniatures et mise en page des photos)...")
+                if st.button("🔄 Actualiser"):
+                    st.rerun()
+            else:
+                try:
+                    report_path, report_errors = report_future.result()
+                except Exception as e:
+                    report_path, report_errors = None, [f"Erreur de génération du rapport : {e}"]
+                for err in report_errors:
+                    st.warning(err)
+                if report_path and os.path.exists(report_path):
+                    file_name_docx = f"Rapport_{st.session_state['project_data'].get('Intitulé', 'Projet')}_{date_str}.docx"
+                    with open(report_path, 'rb') as report_file:
+                        st.download_button(
+                            label="📝 Télécharger le rapport (DOCX)", data=report_file, file_name=file_name_docx,
+                            mime='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+                        )
+                if st.button("🔁 Régénérer le rapport"):
+                    start_report_generation(st.session_state['submission_doc_id'])
+                    st.rerun()
     
-    st.markdown("---")
-    if st.button("⬅️ Recommencer l'audit"):
-        st.session_state.clear()
-        st.rerun()
+        st.markdown("---")
+        if st.button("⬅️ Recommencer l'audit"):
+            st.session_state.clear()
+            st.rerun()
+finally:
+    # Fin de l'exécution complète, y compris interrompue (st.stop, st.rerun, exception) : les
+    # réexécutions suivantes des fragments sont bien reconnues comme partielles
+    _RUN_STATE['full_run'] = False
+# Seules les exécutions complètes menées à terme sont comptées
+record_rerun_timing("complète", _RUN_STARTED)
+if UI_SHOW_RERUN_TIMINGS:
+    render_rerun_timings()
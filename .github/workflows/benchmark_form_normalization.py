@@ -0,0 +1,111 @@
+"""
+Benchmark de la normalisation de la structure du formulaire.
+
+Compare l'ancienne normalisation (apply ligne à ligne) à form_normalization.normalize_form_records
+sur un jeu synthétique, après avoir vérifié que les deux sorties sont identiques.
+
+Usage : python benchmark_form_normalization.py [nombre_de_lignes] [répétitions]
+"""
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import form_normalization
+
+
+def legacy_normalize(data):
+    """Ancienne version de load_form_structure_from_firestore (hors lecture Firestore)."""
+    df = pd.DataFrame(data)
+    df.columns = df.columns.str.strip()
+
+    rename_map = {'Conditon value': 'Condition value', 'condition value': 'Condition value', 'Condition Value': 'Condition value', 'Condition': 'Condition value', 'Conditon on': 'Condition on', 'condition on': 'Condition on'}
+    actual_rename = {k: v for k, v in rename_map.items() if k in df.columns}
+    df = df.rename(columns=actual_rename)
+
+    expected_cols = ['options', 'Description', 'Condition value', 'Condition on', 'section', 'id', 'question', 'type', 'obligatoire']
+    for col in expected_cols:
+        if col not in df.columns: df[col] = np.nan
+
+    df['options'] = df['options'].fillna('')
+    df['Description'] = df['Description'].fillna('')
+    df['Condition value'] = df['Condition value'].fillna('')
+    df['Condition on'] = df['Condition on'].apply(lambda x: int(x) if pd.notna(x) and str(x).isdigit() else 0)
+
+    for col in df.select_dtypes(include=['object']).columns:
+        df[col] = df[col].astype(str).str.strip()
+        try:
+            df[col] = df[col].apply(lambda x: x.encode('utf-8', 'ignore').decode('utf-8', 'ignore'))
+        except Exception: pass
+    return df
+
+
+def synthetic_records(n_rows, seed=0):
+    """Questions proches des données réelles : valeurs manquantes, espaces, anciens noms de colonnes."""
+    rng = random.Random(seed)
+    sections = ['Identification'] + [f"Phase {i}" for i in range(1, 40)]
+    records = []
+    for i in range(n_rows):
+        record = {
+            'id': i + 1,
+            'section': rng.choice(sections),
+            'question ': f"  Question n°{i + 1} : état de l'équipement ?  ",
+            'type': rng.choice(['text', 'Number', 'select ', 'photo']),
+            'obligatoire': rng.choice(['Oui', 'non', ' oui', None]),
+        }
+        if rng.random() < 0.5:
+            record['options'] = 'Oui, Non, Sans objet'
+        if rng.random() < 0.7:
+            record['Description'] = f" Aide {i} "
+        if rng.random() < 0.3:
+            record['Conditon on'] = rng.choice([1, 0, '2', 'x', None, 3.0])
+            record['Condition value'] = f"{rng.randint(1, n_rows)} = Oui"
+        if rng.random() < 0.001:
+            record['Description'] = 'texte \ud800 invalide'
+        records.append(record)
+    return records
+
+
+def overflow_records():
+    """Identifiants de condition au-delà de int64 : uint64 puis objet côté pandas."""
+    base = {'section': 'Phase 1', 'question': 'Question', 'type': 'text', 'obligatoire': 'Non'}
+    return [
+        [dict(base, id=1, **{'Condition on': 1}), dict(base, id=2, **{'Condition on': str(2 ** 63)})],
+        [dict(base, id=1, **{'Condition on': '1'}), dict(base, id=2, **{'Condition on': str(2 ** 64)}),
+         dict(base, id=3)],
+    ]
+
+
+def check_equivalence(data):
+    """Mêmes sorties que l'ancienne normalisation, y compris hors int64, et colonnes typées lisibles."""
+    pd.testing.assert_frame_equal(legacy_normalize(data), form_normalization.normalize_form_records(data))
+    for records in overflow_records():
+        actual = form_normalization.normalize_form_records(records)
+        pd.testing.assert_frame_equal(legacy_normalize(records), actual)
+        flags = form_normalization.typed_question_columns(actual)['condition_on']
+        assert flags.dtype == 'int64' and flags.tolist()[:2] == [1, 0]
+
+
+def _best_time(func, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(n_rows=10_000, repeat=5):
+    data = synthetic_records(n_rows)
+    check_equivalence(data)
+    legacy = _best_time(legacy_normalize, data, repeat)
+    vectorized = _best_time(form_normalization.normalize_form_records, data, repeat)
+    print(f"{n_rows} lignes, meilleur temps sur {repeat} essais (sorties identiques)")
+    print(f"  apply ligne à ligne : {legacy * 1000:8.1f} ms")
+    print(f"  vectorisé           : {vectorized * 1000:8.1f} ms  (x{legacy / vectorized:.1f})")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,141 @@
+"""
+Benchmark du rendu d'une section du formulaire : exécution complète (toute la section
+réaffichée, comme avant les fragments) contre réexécution d'un fragment (seul le bloc de la
+question modifiée, FormModel.render_blocks).
+
+Le fichier sert aussi de script à streamlit.testing (AppTest) : il y affiche une section
+synthétique avec les définitions réelles de app.py (compile_form_model, check_condition,
+render_question), chargées sans exécuter le flux principal. « rendu » est le temps mesuré
+dans le script, « exécution » celui de tout le passage AppTest.
+
+Usage : python benchmark_fragment_rendering.py [nombre_de_questions] [exécutions]
+"""
+import ast
+import os
+import random
+import statistics
+import sys
+import time
+from types import MappingProxyType
+
+import streamlit as st
+
+import form_normalization
+
+SECTION = 'Bornes DC'
+# Défini par main() avant AppTest : le fichier s'exécute alors comme script Streamlit
+_QUESTIONS_ENV = 'BENCHMARK_FRAGMENT_QUESTIONS'
+_APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+
+def load_app_definitions():
+    """
+    Imports, constantes, fonctions et classes de app.py, jusqu'au flux principal (try final).
+    Les appels de premier niveau (connexion Firestore, mise en page...) ne sont pas exécutés.
+    """
+    namespace = {'__name__': 'app_definitions'}
+    with open(_APP_PATH, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), _APP_PATH)
+    for node in tree.body:
+        if isinstance(node, ast.Try):
+            break
+        if isinstance(node, ast.Expr):
+            continue
+        exec(compile(ast.Module([node], []), _APP_PATH, 'exec'), namespace)
+    return namespace
+
+
+def synthetic_section(n_questions, seed=1):
+    """Questions text/select/number/photo (4/4/2/1), dont ~30 % conditionnées par un select récent."""
+    rng = random.Random(seed)
+    records = [{'id': 1, 'section': 'Identification', 'question': 'Nom', 'type': 'text',
+                'obligatoire': 'Oui', 'Condition on': 0, 'Condition value': ''}]
+    selects = []
+    for i in range(n_questions):
+        q_id = 10 + i
+        kind = rng.choices(['text', 'select', 'number', 'photo'], [4, 4, 2, 1])[0]
+        record = {'id': q_id, 'section': SECTION, 'question': f"Question {q_id} : état de l'équipement ?",
+                  'type': kind, 'obligatoire': rng.choice(['Oui', 'Non']), 'Description': f"Aide {q_id}",
+                  'Condition on': 0, 'Condition value': ''}
+        if kind == 'select':
+            record['options'] = 'Oui, Non, Sans objet'
+        if selects and rng.random() < 0.3:
+            record['Condition on'] = 1
+            record['Condition value'] = f"{rng.choice(selects[-3:])} = Oui"
+        if kind == 'select':
+            selects.append(q_id)
+        records.append(record)
+    return records
+
+
+def render_script():
+    """Exécuté par AppTest : affiche la section entière ou un seul bloc, et note le temps de rendu."""
+    if 'app' not in st.session_state:
+        app = load_app_definitions()
+        df = form_normalization.normalize_form_records(synthetic_section(int(os.environ[_QUESTIONS_ENV])))
+        st.session_state['app'] = app
+        st.session_state['model'] = app['compile_form_model'](df)
+    app, model = st.session_state['app'], st.session_state['model']
+    questions = model.questions(SECTION)
+    # Profil sans règle photo : aucune lecture Firestore pendant le rendu
+    st.session_state.setdefault('project_profile', app['ProjectProfile'](
+        site_id=None, title='', counts=MappingProxyType({}), expected_photos=MappingProxyType({})
+    ))
+    st.session_state.setdefault('collected_data', [])
+    answers = st.session_state.setdefault('current_phase_temp', {})
+    if not answers:
+        defaults = {'select': 'Oui', 'text': 'ok', 'number': 2}
+        answers.update({q.id: defaults[q.type] for q in questions if q.type in defaults})
+
+    mode = st.session_state.get('mode', 'full')
+    indexes = range(len(questions)) if mode == 'full' else model.render_blocks[SECTION][int(mode)]
+    started = time.perf_counter()
+    for i in indexes:
+        if app['check_condition'](questions[i], answers, st.session_state['collected_data']):
+            app['render_question'](questions[i], answers, SECTION, 'bench', i)
+    st.session_state.setdefault('timings', []).append((time.perf_counter() - started) * 1000)
+
+
+def _percentiles(values):
+    values = sorted(values)
+    return statistics.median(values), values[min(len(values) - 1, int(len(values) * 0.95))]
+
+
+def _measure(at, mode, runs, warmup=5):
+    """(médiane, p95) du rendu et de l'exécution AppTest, hors premiers passages."""
+    at.session_state['mode'] = mode
+    at.session_state['timings'] = []
+    walls = []
+    for _ in range(runs + warmup):
+        started = time.perf_counter()
+        at.run()
+        walls.append((time.perf_counter() - started) * 1000)
+    return _percentiles(at.session_state['timings'][warmup:]), _percentiles(walls[warmup:])
+
+
+def main(n_questions=40, runs=50):
+    from streamlit.testing.v1 import AppTest
+
+    os.environ[_QUESTIONS_ENV] = str(n_questions)
+    at = AppTest.from_file(os.path.abspath(__file__), default_timeout=60)
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception)
+    blocks = at.session_state['model'].render_blocks[SECTION]
+    sizes = [len(block) for block in blocks]
+    typical = sorted(range(len(blocks)), key=sizes.__getitem__)[len(blocks) // 2]
+    largest = sizes.index(max(sizes))
+    print(f"{n_questions} questions, {len(blocks)} blocs (le plus grand : {sizes[largest]}), "
+          f"médiane / p95 sur {runs} exécutions")
+    for label, mode in (("section entière", 'full'),
+                        (f"bloc médian ({sizes[typical]} q.)", str(typical)),
+                        (f"plus grand bloc ({sizes[largest]} q.)", str(largest))):
+        (render, render_p95), (wall, wall_p95) = _measure(at, mode, runs)
+        print(f"  {label:24s} rendu {render:6.1f} / {render_p95:6.1f} ms"
+              f"   exécution {wall:6.1f} / {wall_p95:6.1f} ms")
+
+
+if os.environ.get(_QUESTIONS_ENV):
+    render_script()
+elif __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,201 @@
+"""
+Export en masse des audits enregistrés (FormAnswers) vers CSV ou Parquet.
+
+Parcourt FormAnswers par pages (curseur start_after, tri sur submission_date) sur une
+période et éventuellement un chantier, lit les phases de chaque audit et écrit les lignes
+au fil de l'eau : la mémoire utilisée ne dépend que de la taille d'une page. Les listes de
+liens photo sont réparties sur les colonnes "Photo 1" à "Photo N".
+
+Usage :
+    python export_form_answers.py --credentials compte_service.json --start 2026-01-01 \\
+        --end 2026-02-01 --format csv --output export.csv
+Avec l'émulateur Firestore, définir FIRESTORE_EMULATOR_HOST (aucun identifiant nécessaire).
+Filtrer par chantier (--site-id / --project) et par date demande un index composite Firestore
+(champ du filtre + submission_date), proposé par Firestore lors de la première exécution.
+"""
+import argparse
+import csv
+import os
+import sys
+from datetime import datetime
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+import settings
+
+ANSWERS_COLLECTION = 'FormAnswers'
+PHASES_SUBCOLLECTION = 'phases'
+COMMENT_ID = 100
+COMMENT_LABEL = "Commentaire Écart Photo"
+BASE_COLUMNS = [
+    "ID Formulaire", "Document", "Date Début", "Date Fin", "Projet", "ID Site",
+    "Phase", "ID", "Question", "Réponse", "Nb photos",
+]
+
+
+def open_client(credentials_path=None):
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        cred = settings.EmulatorCredential()
+        project_id = os.environ.get("GCLOUD_PROJECT", "demo-questionnaire")
+    else:
+        cred = credentials.Certificate(credentials_path) if credentials_path else credentials.ApplicationDefault()
+        project_id = None
+    firebase_admin.initialize_app(cred, {'projectId': project_id} if project_id else None)
+    return firestore.client()
+
+
+def load_question_texts(db):
+    """
+    id de question -> intitulé. Lecture projetée sur les deux champs utiles ; les documents où
+    l'un d'eux manque (clé saisie avec des espaces, 'question ' par ex.) sont relus en entier,
+    clés nettoyées comme dans la normalisation de app.py.
+    """
+    projected = list(db.collection('formsquestions').select(['id', 'question']).stream())
+    incomplete = [doc.reference for doc in projected if not {'id', 'question'} <= (doc.to_dict() or {}).keys()]
+    full = {doc.id: doc for doc in db.get_all(incomplete)} if incomplete else {}
+    texts = {}
+    for doc in projected:
+        data = {str(k).strip(): v for k, v in (full.get(doc.id, doc).to_dict() or {}).items()}
+        try:
+            q_id = int(data.get('id'))
+        except (TypeError, ValueError):
+            continue
+        texts.setdefault(q_id, str(data.get('question', '')).strip())
+    return texts
+
+
+def iter_submissions(db, start=None, end=None, site_id=None, project=None, page_size=200):
+    """En-têtes FormAnswers, page par page (un seul lot de page_size documents en mémoire)."""
+    query = db.collection(ANSWERS_COLLECTION)
+    if site_id:
+        query = query.where('project_site_id', '==', site_id)
+    if project:
+        query = query.where('project_intitule', '==', project)
+    if start:
+        query = query.where('submission_date', '>=', start)
+    if end:
+        query = query.where('submission_date', '<', end)
+    query = query.order_by('submission_date')
+
+    last = None
+    while True:
+        page_query = query.limit(page_size)
+        if last is not None:
+            page_query = page_query.start_after(last)
+        page = list(page_query.stream())
+        if not page:
+            return
+        yield from page
+        last = page[-1]
+        if len(page) < page_size:
+            return
+
+
+def iter_phases(snapshot):
+    """Phases d'un audit : sous-collection phases (format actuel) ou champ collected_phases (ancien format)."""
+    header = snapshot.to_dict() or {}
+    if 'collected_phases' in header:
+        yield from header['collected_phases']
+        return
+    for phase_doc in snapshot.reference.collection(PHASES_SUBCOLLECTION).order_by('index').stream():
+        yield phase_doc.to_dict() or {}
+
+
+def _format_date(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime) else ''
+
+
+def iter_rows(db, question_texts, max_photos, **filters):
+    """Une ligne par réponse ; les listes de liens photo sont réparties en colonnes."""
+    for snapshot in iter_submissions(db, **filters):
+        header = snapshot.to_dict() or {}
+        base = {
+            "ID Formulaire": header.get('submission_id', ''),
+            "Document": snapshot.id,
+            "Date Début": _format_date(header.get('start_date')),
+            "Date Fin": _format_date(header.get('submission_date')),
+            "Projet": header.get('project_intitule', ''),
+            "ID Site": header.get('project_site_id') or '',
+        }
+        for phase in iter_phases(snapshot):
+            for q_id, value in (phase.get('answers') or {}).items():
+                q_int = int(q_id) if str(q_id).isdigit() else None
+                if q_int == COMMENT_ID:
+                    q_text = COMMENT_LABEL
+                else:
+                    q_text = question_texts.get(q_int) or f"Question ID {q_id}"
+                row = dict(base, **{"Phase": phase.get('phase_name', ''), "ID": str(q_id), "Question": q_text})
+                photos = value if isinstance(value, list) else []
+                row["Réponse"] = "" if photos else ("" if value is None else str(value))
+                row["Nb photos"] = len(photos)
+                for i in range(max_photos):
+                    row[f"Photo {i + 1}"] = str(photos[i]) if i < len(photos) else ""
+                if len(photos) > max_photos:
+                    row["Réponse"] = f"{len(photos) - max_photos} lien(s) au-delà de Photo {max_photos} : " + ", ".join(map(str, photos[max_photos:]))
+                yield row
+
+
+def write_csv(rows, columns, output):
+    with open(output, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, delimiter=';')
+        writer.writeheader()
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_parquet(rows, columns, output, batch_rows=5000):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        sys.exit("L'export Parquet nécessite pyarrow (pip install pyarrow).")
+    schema = pa.schema([(col, pa.int64() if col == "Nb photos" else pa.string()) for col in columns])
+    count = 0
+    with pq.ParquetWriter(output, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+def _parse_date(text):
+    return datetime.fromisoformat(text) if text else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export en masse des audits FormAnswers.")
+    parser.add_argument('--credentials', help="JSON du compte de service (sinon identifiants par défaut ou émulateur)")
+    parser.add_argument('--start', type=_parse_date, help="Date de soumission minimale (AAAA-MM-JJ[THH:MM])")
+    parser.add_argument('--end', type=_parse_date, help="Date de soumission maximale, exclue")
+    parser.add_argument('--site-id', help="Identifiant du document Sites")
+    parser.add_argument('--project', help="Intitulé exact du projet")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--max-photos', type=int, default=20, help="Nombre de colonnes Photo N")
+    parser.add_argument('--page-size', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    db = open_client(args.credentials)
+    columns = BASE_COLUMNS + [f"Photo {i + 1}" for i in range(args.max_photos)]
+    rows = iter_rows(
+        db, load_question_texts(db), args.max_photos,
+        start=args.start, end=args.end, site_id=args.site_id, project=args.project, page_size=args.page_size,
+    )
+    writer = write_parquet if args.format == 'parquet' else write_csv
+    count = writer(rows, columns, args.output)
+    print(f"{count} ligne(s) exportée(s) vers {args.output}")
+
+
+if __name__ == '__main__':
+    main()
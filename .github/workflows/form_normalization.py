@@ -0,0 +1,121 @@
+"""
+Normalisation vectorisée de la structure du formulaire (collection formsquestions).
+
+Module pur (pandas/numpy uniquement, sans Streamlit) : utilisable par app.py et par le
+script de benchmark. normalize_form_records produit exactement le même DataFrame que
+l'ancienne version ligne à ligne de load_form_structure_from_firestore.
+"""
+import numpy as np
+import pandas as pd
+
+RENAME_MAP = {
+    'Conditon value': 'Condition value', 'condition value': 'Condition value',
+    'Condition Value': 'Condition value', 'Condition': 'Condition value',
+    'Conditon on': 'Condition on', 'condition on': 'Condition on',
+}
+EXPECTED_COLUMNS = ['options', 'Description', 'Condition value', 'Condition on', 'section', 'id', 'question', 'type', 'obligatoire']
+QUESTION_TYPES = ['text', 'number', 'select', 'photo']
+
+_INTEGER_TEXT = r'[+-]?\d+'
+
+
+def _reencode(text):
+    """encode('utf-8', 'ignore') ne retire que les surrogates isolés : un seul encodage de
+    l'ensemble suffit à savoir s'il y a quelque chose à retirer."""
+    try:
+        '\n'.join(text).encode('utf-8')
+        return text
+    except UnicodeEncodeError:
+        return [v.encode('utf-8', 'ignore').decode('utf-8', 'ignore') for v in text]
+
+
+def _strip_text_column(values):
+    """astype(str).str.strip() puis ré-encodage UTF-8, appliqués une fois par valeur distincte :
+    section, type, obligatoire ou options ne comptent que quelques valeurs différentes."""
+    text = values.astype(str)
+    codes, uniques = pd.factorize(text)
+    # Dernière case : valeur manquante (code -1), conservée telle quelle par les types texte
+    cleaned = np.full(len(uniques) + 1, np.nan, dtype=object)
+    cleaned[:-1] = _reencode([v.strip() for v in np.asarray(uniques, dtype=object)])
+    return pd.Series(cleaned.take(codes), index=values.index, name=values.name, dtype=text.dtype)
+
+
+def _condition_on(values):
+    """Équivalent de int(x) si pd.notna(x) et str(x).isdigit(), sinon 0 (une valeur manquante
+    n'a jamais une représentation texte numérique), évalué par valeur distincte."""
+    codes, uniques = pd.factorize(values.astype(str))
+    converted = [int(v) if v.isdigit() else 0 for v in np.asarray(uniques, dtype=object)]
+    try:
+        table = np.array(converted + [0], dtype='int64')
+    except OverflowError:
+        # Au-delà de 2**63 - 1 : entiers Python, pandas choisit le type comme apply (uint64 ou object)
+        rows = np.array(converted + [0], dtype=object).take(codes).tolist()
+        return pd.Series(rows, index=values.index, name=values.name)
+    return pd.Series(table.take(codes), index=values.index, name=values.name)
+
+
+def _condition_flags(values):
+    """'Condition on' en int64. Colonne uint64 ou objet (valeurs au-delà de 2**63 - 1) : seule
+    la valeur 1 active une condition, les autres valent 0."""
+    if pd.api.types.is_signed_integer_dtype(values):
+        return values.astype('int64')
+    numbers = pd.to_numeric(values.astype(str), errors='coerce')
+    return pd.Series(np.where(numbers == 1, 1, 0), index=values.index, dtype='int64')
+
+
+def normalize_form_records(records):
+    """DataFrame normalisé des questions (même sortie que l'ancienne normalisation par apply)."""
+    df = pd.DataFrame(records)
+    df.columns = df.columns.str.strip()
+    df = df.rename(columns={k: v for k, v in RENAME_MAP.items() if k in df.columns})
+
+    for col in EXPECTED_COLUMNS:
+        if col not in df.columns:
+            df[col] = np.nan
+
+    df['options'] = df['options'].fillna('')
+    df['Description'] = df['Description'].fillna('')
+    df['Condition value'] = df['Condition value'].fillna('')
+    df['Condition on'] = _condition_on(df['Condition on'])
+
+    for col in df.select_dtypes(include=['object']).columns:
+        df[col] = _strip_text_column(df[col])
+    return df
+
+
+def _question_ids(values):
+    """Équivalent de int(valeur) ; NA quand int() échouerait (ligne ignorée)."""
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+        return values.astype('Int64')
+    if pd.api.types.is_float_dtype(values):
+        finite = np.isfinite(values)
+        return pd.Series(np.trunc(values.where(finite)), index=values.index).astype('Int64')
+    text = values.astype(str)
+    is_integer = text.str.fullmatch(_INTEGER_TEXT)
+    return pd.to_numeric(text.where(is_integer), errors='coerce').astype('Int64')
+
+
+def typed_question_columns(df):
+    """
+    Colonnes typées prêtes à compiler : id entier (NA si invalide), obligatoire booléen,
+    type en catégorie, options déjà découpées, textes nettoyés.
+    """
+    options = df['options'].astype(str)
+    split_options = options.str.split(',')
+    typed = pd.DataFrame({
+        'id': _question_ids(df['id']),
+        'section': df['section'],
+        'text': df['question'].astype(str).str.strip(),
+        'type': df['type'].astype(str).str.strip().str.lower(),
+        'description': df['Description'].astype(str).str.strip(),
+        'mandatory': df['obligatoire'].astype(str).str.strip().str.lower().eq('oui'),
+        'options': [
+            tuple(opt.strip() for opt in parts) if text else ()
+            for text, parts in zip(options, split_options)
+        ],
+        'condition_on': _condition_flags(df['Condition on']),
+        'condition_value': df['Condition value'].astype(str).str.strip(),
+    }, index=df.index)
+    known_types = sorted(set(QUESTION_TYPES) | set(typed['type'].unique()))
+    typed['type'] = pd.Categorical(typed['type'], categories=known_types)
+    return typed
@@ -0,0 +1,144 @@
+"""
+Génération en masse des rapports Word (DOCX) des audits enregistrés (FormAnswers).
+
+Les soumissions sont sélectionnées comme pour export_form_answers.py (période, chantier) et
+réparties sur un pool de processus : chaque processus ouvre ses propres clients Firestore et
+Drive, télécharge les photos dont la miniature n'est pas en cache puis met le rapport en page
+avec report_builder. Les miniatures sont partagées entre rapports et exécutions (--cache-dir).
+
+Usage :
+    python generate_reports.py --credentials compte_service.json --start 2026-01-01 \\
+        --end 2026-02-01 --output-dir rapports --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.http import MediaIoBaseDownload
+
+import export_form_answers
+import report_builder
+import settings
+
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+
+# État propre à chaque processus du pool (initialisé par _init_worker)
+_worker = {}
+
+
+def _init_worker(credentials_path, question_texts, thumbs_dir, thumb_edge):
+    _worker['db'] = export_form_answers.open_client(credentials_path)
+    creds = service_account.Credentials.from_service_account_file(credentials_path, scopes=DRIVE_SCOPES)
+    _worker['drive'] = build('drive', 'v3', credentials=creds, cache_discovery=False)
+    _worker['question_texts'] = question_texts
+    _worker['thumbs_dir'] = thumbs_dir
+    _worker['thumb_edge'] = thumb_edge
+
+
+def _download(drive, file_id, directory):
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as fh:
+        downloader = MediaIoBaseDownload(fh, drive.files().get_media(fileId=file_id), chunksize=4 * 1024 * 1024)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=5)
+    return path
+
+
+def render_submission(doc_id, output_dir):
+    """Rapport d'une soumission (dans un processus du pool). Retourne (doc_id, chemin, erreurs)."""
+    db = _worker['db']
+    snapshot = db.collection(export_form_answers.ANSWERS_COLLECTION).document(doc_id).get()
+    if not snapshot.exists:
+        return doc_id, None, ["Soumission introuvable"]
+    header = snapshot.to_dict() or {}
+    project_data = header.get('project_details')
+    if header.get('project_site_id'):
+        site = db.collection('Sites').document(header['project_site_id']).get()
+        if site.exists:
+            project_data = {str(k).strip(): v for k, v in (site.to_dict() or {}).items()}
+    report = report_builder.submission_report(
+        doc_id, header, list(export_form_answers.iter_phases(snapshot)), project_data,
+        _worker['question_texts'], settings.DISPLAY_GROUPS, settings.PROJECT_RENAME_MAP,
+    )
+
+    thumbs_dir, thumb_edge = _worker['thumbs_dir'], _worker['thumb_edge']
+    errors = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        sources = {}
+        for phase in report['phases']:
+            for answer in phase['answers']:
+                for file_id in answer['photos']:
+                    if file_id in sources or os.path.exists(report_builder.thumbnail_path(thumbs_dir, file_id, thumb_edge)):
+                        continue
+                    try:
+                        sources[file_id] = _download(_worker['drive'], file_id, work_dir)
+                    except Exception as e:
+                        errors.append(f"Téléchargement Drive impossible ({file_id}) : {e}")
+        output_path = os.path.join(output_dir, f"{doc_id.replace('/', '_')}.docx")
+        report_builder.build_report(report, sources, thumbs_dir, output_path, thumb_edge)
+    return doc_id, output_path, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rapports Word en masse des audits FormAnswers.")
+    parser.add_argument('--credentials', required=True, help="JSON du compte de service (Firestore et Drive)")
+    parser.add_argument('--start', type=export_form_answers._parse_date, help="Date de soumission minimale (AAAA-MM-JJ[THH:MM])")
+    parser.add_argument('--end', type=export_form_answers._parse_date, help="Date de soumission maximale, exclue")
+    parser.add_argument('--site-id', help="Identifiant du document Sites")
+    parser.add_argument('--project', help="Intitulé exact du projet")
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), "questionnaire_chantier", "reports", "thumbnails"),
+                        help="Répertoire des miniatures (réutilisées d'une exécution à l'autre)")
+    parser.add_argument('--thumbnail-edge', type=int, default=report_builder.THUMBNAIL_EDGE)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1))
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.makedirs(args.cache_dir, exist_ok=True)
+    db = export_form_answers.open_client(args.credentials)
+    question_texts = export_form_answers.load_question_texts(db)
+    submissions = export_form_answers.iter_submissions(
+        db, start=args.start, end=args.end, site_id=args.site_id, project=args.project,
+    )
+
+    written, failed = 0, 0
+    with ProcessPoolExecutor(
+        # 'spawn' : les clients gRPC Firestore ne survivent pas à un fork
+        max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+        initargs=(args.credentials, question_texts, args.cache_dir, args.thumbnail_edge),
+    ) as pool:
+        pending = set()
+        for snapshot in submissions:
+            pending.add(pool.submit(render_submission, snapshot.id, args.output_dir))
+            # Nombre borné de rapports en vol : la liste des soumissions reste paginée
+            if len(pending) >= args.workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                written, failed = _report_results(done, written, failed)
+        written, failed = _report_results(pending, written, failed)
+    print(f"{written} rapport(s) écrit(s) dans {args.output_dir}, {failed} en échec")
+
+
+def _report_results(futures, written, failed):
+    for future in futures:
+        try:
+            doc_id, path, errors = future.result()
+        except Exception as e:
+            print(f"ÉCHEC : {e}")
+            failed += 1
+            continue
+        for err in errors:
+            print(f"{doc_id} : {err}")
+        if path:
+            written += 1
+        else:
+            failed += 1
+    return written, failed
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Pré-traitement des photos avant upload Drive : redimensionnement, recompression JPEG,
+conversion des PNG et gestion des métadonnées EXIF.
+
+Module séparé de app.py pour être importable par les processus du pool
+(le script Streamlit lui-même ne peut pas être ré-importé dans un processus enfant).
+"""
+import io
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow optionnel : les photos sont alors envoyées telles quelles
+    Image = None
+    ImageOps = None
+
+SUPPORTED_MIME_TYPES = {'image/jpeg', 'image/jpg', 'image/png'}
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def is_available():
+    return Image is not None
+
+
+def _encode_jpeg(source, out, max_edge, jpeg_quality, keep_exif):
+    """Écrit dans out l'image source (chemin ou flux) réduite et recompressée ; retourne True si elle a été redimensionnée."""
+    with Image.open(source) as img:
+        exif = img.getexif() if keep_exif else None
+        # L'orientation est appliquée aux pixels avant de supprimer/réinitialiser l'EXIF
+        img = ImageOps.exif_transpose(img)
+        if exif is not None and EXIF_ORIENTATION_TAG in exif:
+            exif[EXIF_ORIENTATION_TAG] = 1
+
+        resized = max(img.size) > max_edge
+        if resized:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # Captures PNG avec transparence : fond blanc
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        save_kwargs = {'quality': int(jpeg_quality), 'optimize': True}
+        if exif:
+            save_kwargs['exif'] = exif.tobytes()
+        img.save(out, format='JPEG', **save_kwargs)
+    return resized
+
+
+def compress_image(data, mime_type, max_edge=2048, jpeg_quality=82, keep_exif=False):
+    """
+    Retourne (octets, type_mime) de l'image redimensionnée (bord long <= max_edge)
+    et recompressée en JPEG. Retourne l'original si l'image n'est pas gérée,
+    si le traitement échoue ou si le résultat n'est pas plus léger.
+    """
+    if Image is None or mime_type not in SUPPORTED_MIME_TYPES:
+        return data, mime_type
+    out = io.BytesIO()
+    try:
+        resized = _encode_jpeg(io.BytesIO(data), out, max_edge, jpeg_quality, keep_exif)
+    except Exception:
+        return data, mime_type
+    compressed = out.getvalue()
+
+    if len(compressed) >= len(data) and not resized and mime_type != 'image/png':
+        return data, mime_type
+    return compressed, 'image/jpeg'
+
+
+def compress_image_file(path, mime_type, output_path, max_edge=2048, jpeg_quality=82, keep_exif=False):
+    """
+    Comme compress_image, de fichier à fichier : seuls les chemins transitent entre processus
+    et le résultat est écrit dans output_path. Retourne (type_mime, taille) du fichier écrit,
+    ou None si l'original doit être envoyé tel quel (output_path est alors à ignorer).
+    """
+    if Image is None or mime_type not in SUPPORTED_MIME_TYPES:
+        return None
+    try:
+        with open(output_path, 'wb') as out:
+            resized = _encode_jpeg(path, out, max_edge, jpeg_quality, keep_exif)
+        size = os.path.getsize(output_path)
+        if size >= os.path.getsize(path) and not resized and mime_type != 'image/png':
+            return None
+    except Exception:
+        return None
+    return 'image/jpeg', size
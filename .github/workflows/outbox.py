@@ -0,0 +1,337 @@
+"""
+Boîte d'envoi locale et durable des soumissions (SQLite), vidée en arrière-plan.
+
+Une soumission terminée est d'abord écrite ici (les photos restent dans le spool disque),
+puis OutboxWorker la livre à Firestore/Drive via la fonction deliver fournie par app.py,
+avec reprise à délai exponentiel et limitation du débit. Module sans Streamlit : deliver
+et l'horloge sont injectables, ce qui permet de le faire tourner contre l'émulateur
+Firestore (FIRESTORE_EMULATOR_HOST) et un faux serveur Drive ([google_drive] api_endpoint).
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+STATUS_PENDING = 'pending'
+STATUS_IN_PROGRESS = 'in_progress'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Les soumissions livrées sont gardées ce délai pour l'affichage, puis supprimées
+DONE_RETENTION_SECONDS = 7 * 24 * 3600
+# Durée d'une réservation : passé ce délai (processus arrêté en pleine livraison), la ligne est reprise
+CLAIM_LEASE_SECONDS = 900
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    submission_id TEXT PRIMARY KEY,
+    label TEXT NOT NULL DEFAULT '',
+    payload TEXT NOT NULL,
+    photo_hashes TEXT NOT NULL DEFAULT '[]',
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    claimed_by TEXT,
+    claim_expires_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS submissions_due ON submissions (status, next_attempt_at);
+"""
+
+
+def backoff_delay(attempts, base_seconds=10, max_seconds=900):
+    """Délai avant la tentative suivante : base * 2^(n-1), plafonné, avec gigue (50 à 100 %)."""
+    delay = min(max_seconds, base_seconds * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class RateLimiter:
+    """Seau à jetons : au plus rate_per_minute livraisons par minute, par rafales de burst."""
+
+    def __init__(self, rate_per_minute, burst=1, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._clock = clock
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """0 si un jeton est disponible (et le consomme), sinon le délai d'attente en secondes."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class Outbox:
+    """Table SQLite des soumissions à livrer (une ligne par submission_id, JSON du contenu)."""
+
+    def __init__(self, path, clock=time.time):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(_SCHEMA)
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(submissions)")}
+        for column, sql_type in (('claimed_by', 'TEXT'), ('claim_expires_at', 'REAL')):
+            if column not in columns:  # Base créée par une version sans réservation
+                self._conn.execute(f"ALTER TABLE submissions ADD COLUMN {column} {sql_type}")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _update(self, sql, params=()):
+        """Exécute une mise à jour et retourne le nombre de lignes modifiées."""
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def enqueue(self, submission_id, payload, label='', photo_hashes=(), delay_seconds=0):
+        """Ajoute (ou remplace, si elle n'est pas déjà livrée) une soumission à livrer."""
+        now = self._clock()
+        self._execute(
+            """
+            INSERT INTO submissions (submission_id, label, payload, photo_hashes, status, attempts,
+                                     next_attempt_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)
+            ON CONFLICT(submission_id) DO UPDATE SET
+                label = excluded.label, payload = excluded.payload, photo_hashes = excluded.photo_hashes,
+                status = excluded.status, next_attempt_at = excluded.next_attempt_at,
+                updated_at = excluded.updated_at
+            WHERE submissions.status NOT IN (?, ?)
+            """,
+            (submission_id, label, json.dumps(payload), json.dumps(list(photo_hashes)), STATUS_PENDING,
+             now + delay_seconds, now, now, STATUS_DONE, STATUS_IN_PROGRESS),
+        )
+
+    def get(self, submission_id):
+        rows = self._execute("SELECT * FROM submissions WHERE submission_id = ?", (submission_id,))
+        return dict(rows[0]) if rows else None
+
+    def due(self, limit=10):
+        """Soumissions à livrer : en attente arrivées à échéance, ou réservées dont la réservation a expiré."""
+        now = self._clock()
+        rows = self._execute(
+            "SELECT submission_id, payload, attempts FROM submissions "
+            "WHERE (status = ? AND next_attempt_at <= ?) OR (status = ? AND claim_expires_at <= ?) "
+            "ORDER BY next_attempt_at LIMIT ?",
+            (STATUS_PENDING, now, STATUS_IN_PROGRESS, now, limit),
+        )
+        return [(row['submission_id'], json.loads(row['payload']), row['attempts']) for row in rows]
+
+    def claim(self, submission_id, owner, lease_seconds=CLAIM_LEASE_SECONDS, include_failed=False):
+        """
+        Réserve une soumission pour une livraison (statut in_progress, propriétaire, échéance).
+        True si la réservation est obtenue ou renouvelée par le même propriétaire ; False si la
+        soumission est livrée, absente ou réservée par un autre dont la réservation court encore.
+        """
+        now = self._clock()
+        claimable = (STATUS_PENDING, STATUS_FAILED) if include_failed else (STATUS_PENDING,)
+        return self._update(
+            "UPDATE submissions SET status = ?, claimed_by = ?, claim_expires_at = ?, updated_at = ? "
+            f"WHERE submission_id = ? AND (status IN ({', '.join('?' * len(claimable))}) "
+            "OR (status = ? AND (claimed_by = ? OR claim_expires_at <= ?)))",
+            (STATUS_IN_PROGRESS, owner, now + lease_seconds, now, submission_id,
+             *claimable, STATUS_IN_PROGRESS, owner, now),
+        ) == 1
+
+    def renew(self, submission_id, owner, lease_seconds=CLAIM_LEASE_SECONDS):
+        """Prolonge la réservation de owner ; False si elle a été perdue (expirée puis reprise, livrée...)."""
+        now = self._clock()
+        return self._update(
+            "UPDATE submissions SET claim_expires_at = ?, updated_at = ? "
+            "WHERE submission_id = ? AND status = ? AND claimed_by = ?",
+            (now + lease_seconds, now, submission_id, STATUS_IN_PROGRESS, owner),
+        ) == 1
+
+    def release(self, submission_id, owner):
+        """Rend une soumission réservée par owner au worker, pour une tentative immédiate."""
+        now = self._clock()
+        self._update(
+            "UPDATE submissions SET status = ?, claimed_by = NULL, claim_expires_at = NULL, "
+            "next_attempt_at = ?, updated_at = ? WHERE submission_id = ? AND status = ? AND claimed_by = ?",
+            (STATUS_PENDING, now, now, submission_id, STATUS_IN_PROGRESS, owner),
+        )
+
+    @staticmethod
+    def _fence(owner):
+        """Condition SQL (et paramètres) limitant une écriture au détenteur de la réservation."""
+        return (" AND status = ? AND claimed_by = ?", (STATUS_IN_PROGRESS, owner)) if owner else ("", ())
+
+    def mark_done(self, submission_id, owner=None):
+        """Livrée. Avec owner, sans effet (False) si la réservation a été perdue entre-temps."""
+        fence, params = self._fence(owner)
+        return self._update(
+            "UPDATE submissions SET status = ?, last_error = NULL, claimed_by = NULL, claim_expires_at = NULL, "
+            f"updated_at = ? WHERE submission_id = ?{fence}",
+            (STATUS_DONE, self._clock(), submission_id, *params),
+        ) == 1
+
+    def mark_retry(self, submission_id, error, delay_seconds, failed=False, owner=None):
+        """Nouvelle tentative plus tard. Avec owner, sans effet (False) si la réservation a été perdue."""
+        now = self._clock()
+        fence, params = self._fence(owner)
+        return self._update(
+            "UPDATE submissions SET status = ?, attempts = attempts + 1, last_error = ?, "
+            "next_attempt_at = ?, claimed_by = NULL, claim_expires_at = NULL, updated_at = ? "
+            f"WHERE submission_id = ?{fence}",
+            (STATUS_FAILED if failed else STATUS_PENDING, str(error)[:500], now + delay_seconds, now,
+             submission_id, *params),
+        ) == 1
+
+    def retry_now(self, submission_id):
+        """Remet une soumission en échec (ou en attente) en tête de file ; sans effet si elle est en cours de livraison."""
+        self._execute(
+            "UPDATE submissions SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? "
+            "WHERE submission_id = ? AND status NOT IN (?, ?)",
+            (STATUS_PENDING, self._clock(), self._clock(), submission_id, STATUS_DONE, STATUS_IN_PROGRESS),
+        )
+
+    def summary(self):
+        """Nombre de soumissions par statut."""
+        rows = self._execute("SELECT status, COUNT(*) AS n FROM submissions GROUP BY status")
+        return {row['status']: row['n'] for row in rows}
+
+    def undelivered(self, limit=20):
+        rows = self._execute(
+            "SELECT submission_id, label, status, attempts, next_attempt_at, last_error, created_at "
+            "FROM submissions WHERE status != ? ORDER BY created_at LIMIT ?",
+            (STATUS_DONE, limit),
+        )
+        return [dict(row) for row in rows]
+
+    def pending_photo_hashes(self):
+        """Empreintes des photos encore nécessaires (à protéger du nettoyage du spool)."""
+        rows = self._execute("SELECT photo_hashes FROM submissions WHERE status != ?", (STATUS_DONE,))
+        return {h for row in rows for h in json.loads(row['photo_hashes'])}
+
+    def purge_done(self, older_than_seconds=DONE_RETENTION_SECONDS):
+        self._execute(
+            "DELETE FROM submissions WHERE status = ? AND updated_at < ?",
+            (STATUS_DONE, self._clock() - older_than_seconds),
+        )
+
+
+class ClaimKeeper:
+    """
+    Renouvelle une réservation (Outbox.renew) toutes les lease_seconds / 3 pendant une livraison
+    plus longue que le bail. lost passe à True si la réservation a été perdue : la fin de la
+    livraison ne l'écrase alors pas (mark_done / mark_retry avec owner).
+    """
+
+    def __init__(self, outbox, submission_id, owner, lease_seconds=CLAIM_LEASE_SECONDS):
+        self.outbox = outbox
+        self.submission_id = submission_id
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._loop, name="outbox-lease", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _loop(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if not self.outbox.renew(self.submission_id, self.owner, self.lease_seconds):
+                    self.lost = True
+                    return
+            except Exception:
+                pass  # Base momentanément verrouillée : nouvel essai avant l'échéance
+
+
+class OutboxWorker:
+    """
+    Thread démon qui livre les soumissions dues. Chaque soumission est d'abord réservée
+    (Outbox.claim) puis sa réservation renouvelée pendant la livraison (ClaimKeeper) : une
+    sauvegarde au premier plan ne la livre pas en même temps. deliver(payload)
+    lève une exception en cas d'échec (nouvelle tentative après backoff_delay) ; au-delà de
+    max_attempts la soumission passe en échec et attend une relance manuelle.
+    """
+
+    def __init__(self, outbox, deliver, poll_seconds=10, rate_per_minute=30, max_attempts=20,
+                 base_delay_seconds=10, max_delay_seconds=900, lease_seconds=CLAIM_LEASE_SECONDS):
+        self.outbox = outbox
+        self.deliver = deliver
+        self.owner = f"worker-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.limiter = RateLimiter(rate_per_minute, burst=max(1, int(rate_per_minute // 10)))
+        self.last_run = None
+        self.last_error = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="outbox-worker", daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Déclenche un passage immédiat (nouvelle soumission, relance manuelle)."""
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+                self.outbox.purge_done()
+            except Exception as e:
+                self.last_error = str(e)  # Base locale illisible... : nouvel essai au prochain tour
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def run_once(self):
+        """Livre les soumissions dues ; retourne le nombre livré."""
+        delivered = 0
+        for submission_id, payload, attempts in self.outbox.due():
+            wait = self.limiter.wait_time()
+            while wait > 0:
+                time.sleep(wait)
+                wait = self.limiter.wait_time()
+            if not self.outbox.claim(submission_id, self.owner, self.lease_seconds):
+                continue  # Livrée ou réservée entre-temps (sauvegarde au premier plan)
+            try:
+                with ClaimKeeper(self.outbox, submission_id, self.owner, self.lease_seconds):
+                    self.deliver(payload)
+            except Exception as e:
+                attempts += 1
+                self.last_error = str(e)
+                self.outbox.mark_retry(
+                    submission_id, e,
+                    backoff_delay(attempts, self.base_delay_seconds, self.max_delay_seconds),
+                    failed=attempts >= self.max_attempts, owner=self.owner,
+                )
+                continue
+            # Réservation perdue (reprise par un autre) : sa livraison décide du statut
+            if self.outbox.mark_done(submission_id, self.owner):
+                delivered += 1
+        self.last_run = time.time()
+        return delivered
@@ -0,0 +1,154 @@
+"""
+Spool disque des photos jointes au formulaire, adressé par contenu (SHA-256).
+
+Une photo est écrite une seule fois à son ajout ; la session ne garde qu'un PhotoHandle
+(empreinte, nom, type, taille). Le handle s'utilise comme un UploadedFile Streamlit
+(name, type, size, file_id, getbuffer, getvalue, read) ; les envois lisent le fichier par
+morceaux (open) ou par un mmap refermé en sortie de bloc (mapped), dont les pages
+appartiennent au cache disque et non à la mémoire du processus.
+Module sans Streamlit, utilisable depuis des threads.
+"""
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+_EMPTY = memoryview(b'')
+
+
+@dataclass(frozen=True, slots=True)
+class PhotoHandle:
+    """Référence légère vers une photo du spool."""
+    sha256: str
+    name: str
+    type: str
+    size: int
+    path: str
+
+    @property
+    def file_id(self):
+        return self.sha256
+
+    def open(self):
+        """Flux binaire sur le fichier du spool, à fermer par l'appelant (lecture par morceaux)."""
+        return open(self.path, 'rb')
+
+    @contextmanager
+    def mapped(self):
+        """Contenu en lecture seule projeté en mémoire (mmap), libéré à la sortie du bloc."""
+        if self.size == 0:
+            yield _EMPTY
+            return
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+    def getbuffer(self):
+        """Compatibilité UploadedFile : copie du contenu (préférer open() ou mapped())."""
+        return memoryview(self.getvalue())
+
+    def getvalue(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def read(self):
+        return self.getvalue()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+class PhotoSpool:
+    """
+    Répertoire <dir>/<2 premiers caractères>/<sha256>. Les fichiers sont touchés à chaque ajout
+    et supprimés par sweep() quand ils n'ont pas servi depuis ttl_seconds.
+    """
+
+    def __init__(self, directory=None, ttl_seconds=24 * 3600):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "questionnaire_chantier", "photos")
+        self.ttl_seconds = ttl_seconds
+        # Appelables -> empreintes à conserver quel que soit leur âge (envois en attente, brouillons)
+        self._protected_sources = []
+        self._janitor = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def put(self, data, name, mime_type):
+        """Écrit le contenu (bytes ou memoryview) s'il n'est pas déjà présent et retourne son handle."""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._path(sha256)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return PhotoHandle(sha256=sha256, name=name, type=mime_type, size=len(data), path=path)
+
+    def handle(self, sha256, name, mime_type, size):
+        """Handle d'un contenu déjà écrit (reprise d'un brouillon) ; exists() indique s'il est encore là."""
+        return PhotoHandle(sha256=sha256, name=name, type=mime_type, size=size, path=self._path(sha256))
+
+    def put_uploaded(self, uploaded_file):
+        """Handle d'un UploadedFile Streamlit (lecture sans copie via getbuffer)."""
+        return self.put(uploaded_file.getbuffer(), uploaded_file.name, uploaded_file.type)
+
+    def touch(self, handle):
+        try:
+            os.utime(handle.path)
+        except OSError:
+            pass
+
+    def protect(self, source):
+        """Ajoute un appelable -> ensemble d'empreintes que sweep() ne supprime jamais."""
+        self._protected_sources.append(source)
+
+    def protected_hashes(self):
+        """Union des empreintes protégées ; une source en erreur interrompt le nettoyage."""
+        protected = set()
+        for source in self._protected_sources:
+            protected.update(source())
+        return protected
+
+    def sweep(self, now=None):
+        """Supprime les fichiers non utilisés depuis ttl_seconds (et les .tmp abandonnés). Retourne le nombre supprimé."""
+        limit = (now or time.time()) - self.ttl_seconds
+        protected = self.protected_hashes()
+        removed = 0
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                if name in protected:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime < limit:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue  # Supprimé entre-temps ou en cours d'écriture
+        return removed
+
+    def start_janitor(self, interval_seconds=3600):
+        """Thread démon qui appelle sweep() à intervalle régulier (un seul par spool)."""
+        if self._janitor is not None:
+            return
+        def _loop():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    self.sweep()
+                except Exception:
+                    pass
+        self._janitor = threading.Thread(target=_loop, name="photo-spool-janitor", daemon=True)
+        self._janitor.start()
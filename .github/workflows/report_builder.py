@@ -0,0 +1,193 @@
+"""
+Génération du rapport Word (DOCX) d'un audit enregistré.
+
+Module séparé de app.py pour être exécuté dans un pool de processus (la mise en page de
+centaines de photos ne bloque ni la session Streamlit ni le GIL du serveur) et réutilisé
+par le mode batch (generate_reports.py). Aucun accès réseau ici : les photos sont fournies
+sous forme de fichiers locaux, réduites une seule fois en miniatures gardées en cache.
+
+Structure de `report` (produite par submission_report) :
+    {"title": str, "infos": [(libellé, valeur)], "project_groups": [[(libellé, valeur)]],
+     "phases": [{"name": str, "answers": [{"id", "question", "text", "photos": [id Drive]}]}]}
+"""
+import os
+import re
+from datetime import datetime
+
+from docx import Document
+from docx.shared import Cm, Pt
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow optionnel : le rapport liste alors les photos sans les afficher
+    Image = None
+    ImageOps = None
+
+THUMBNAIL_EDGE = 480
+THUMBNAIL_QUALITY = 75
+PHOTOS_PER_ROW = 3
+PHOTO_WIDTH = Cm(5.5)
+COMMENT_ID = 100
+COMMENT_LABEL = "Commentaire Écart Photo"
+
+# webViewLink : https://drive.google.com/file/d/<id>/view?... (ou ...?id=<id>)
+_DRIVE_FILE_ID = re.compile(r'(?:/d/|[?&]id=)([A-Za-z0-9_-]{10,})')
+
+
+def drive_file_id(link):
+    match = _DRIVE_FILE_ID.search(str(link))
+    return match.group(1) if match else None
+
+
+def _format_date(value):
+    if not isinstance(value, datetime):
+        return ''
+    if value.tzinfo is not None:  # Horodatage Firestore (UTC) -> heure locale
+        value = value.astimezone()
+    return value.strftime('%d/%m/%Y %H:%M')
+
+
+def submission_report(doc_id, header, phases, project_data, question_texts, display_groups, rename_map):
+    """
+    Contenu du rapport d'une soumission FormAnswers (en-tête et phases déjà lus) : valeurs
+    simples uniquement, pour être transmis tel quel à un processus du pool.
+    """
+    report_phases = []
+    for phase in phases:
+        answers = []
+        for q_id, value in (phase.get('answers') or {}).items():
+            q_int = int(q_id) if str(q_id).isdigit() else None
+            if q_int == COMMENT_ID:
+                question = COMMENT_LABEL
+            else:
+                question = question_texts.get(q_int) or f"Question ID {q_id}"
+            if isinstance(value, list):
+                photos = [file_id for file_id in map(drive_file_id, value) if file_id]
+                unknown = len(value) - len(photos)
+                text = f"{unknown} lien(s) photo non reconnu(s)" if unknown else ""
+            else:
+                photos, text = [], "" if value is None else str(value)
+            answers.append({"id": str(q_id), "question": question, "text": text, "photos": photos})
+        report_phases.append({"name": phase.get('phase_name', ''), "answers": answers})
+
+    project_data = project_data or {}
+    return {
+        "title": f"Rapport d'audit – {header.get('project_intitule', 'N/A')}",
+        "infos": [
+            ("Projet", header.get('project_intitule', 'N/A')),
+            ("ID Formulaire", header.get('submission_id', '')),
+            ("Début", _format_date(header.get('start_date'))),
+            ("Fin", _format_date(header.get('submission_date'))),
+            ("Document", doc_id),
+            ("Phases", len(report_phases)),
+        ],
+        "project_groups": [
+            [(rename_map.get(col, col), project_data.get(col, 'N/A')) for col in group]
+            for group in display_groups
+        ] if project_data else [],
+        "phases": report_phases,
+    }
+
+
+def thumbnail_path(cache_dir, file_id, edge=THUMBNAIL_EDGE):
+    """Miniature en cache d'une photo Drive (l'id d'un fichier Drive désigne un contenu fixe)."""
+    return os.path.join(cache_dir, f"{file_id}_{edge}.jpg")
+
+
+def make_thumbnail(source_path, dest_path, edge=THUMBNAIL_EDGE):
+    """Réduit une photo (bord long <= edge, orientation EXIF appliquée) en JPEG. False si impossible."""
+    if Image is None:
+        return False
+    try:
+        with Image.open(source_path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((edge, edge))
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+            img.save(tmp_path, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+        os.replace(tmp_path, dest_path)
+        return True
+    except Exception:
+        return False
+
+
+def _touch(path):
+    """Marque une miniature en cache comme utilisée (repoussée dans le nettoyage). False si absente."""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def _add_key_values(document, pairs, columns):
+    table = document.add_table(rows=0, cols=columns)
+    table.style = 'Table Grid'
+    for start in range(0, len(pairs), columns):
+        cells = table.add_row().cells
+        for cell, (label, value) in zip(cells, pairs[start:start + columns]):
+            paragraph = cell.paragraphs[0]
+            paragraph.add_run(f"{label} : ").bold = True
+            paragraph.add_run("" if value is None else str(value))
+    return table
+
+
+def _add_photos(document, file_ids, thumbs):
+    table = document.add_table(rows=0, cols=PHOTOS_PER_ROW)
+    for start in range(0, len(file_ids), PHOTOS_PER_ROW):
+        cells = table.add_row().cells
+        for cell, file_id in zip(cells, file_ids[start:start + PHOTOS_PER_ROW]):
+            path = thumbs.get(file_id)
+            if path:
+                cell.paragraphs[0].add_run().add_picture(path, width=PHOTO_WIDTH)
+            else:
+                cell.paragraphs[0].add_run(f"Photo indisponible ({file_id})").italic = True
+
+
+def build_report(report, photo_sources, thumbs_dir, output_path, thumb_edge=THUMBNAIL_EDGE):
+    """
+    Écrit le rapport DOCX. photo_sources = {id Drive: fichier local} pour les photos dont la
+    miniature n'est pas encore en cache. Retourne output_path.
+    """
+    os.makedirs(thumbs_dir, exist_ok=True)
+    thumbs = {}
+    for phase in report['phases']:
+        for answer in phase['answers']:
+            for file_id in answer.get('photos', ()):
+                if file_id in thumbs:
+                    continue
+                path = thumbnail_path(thumbs_dir, file_id, thumb_edge)
+                source = photo_sources.get(file_id)
+                if _touch(path):
+                    thumbs[file_id] = path
+                elif source and make_thumbnail(source, path, thumb_edge):
+                    thumbs[file_id] = path
+                else:
+                    thumbs[file_id] = None
+
+    document = Document()
+    document.styles['Normal'].font.size = Pt(10)
+    document.add_heading(report['title'], level=0)
+    _add_key_values(document, report.get('infos', []), 2)
+
+    if report.get('project_groups'):
+        document.add_heading("Détails du projet", level=1)
+        for group in report['project_groups']:
+            _add_key_values(document, group, len(group) or 1)
+            document.add_paragraph()
+
+    for phase in report['phases']:
+        document.add_heading(phase['name'], level=1)
+        for answer in phase['answers']:
+            paragraph = document.add_paragraph()
+            paragraph.add_run(f"{answer['id']}. {answer['question']}").bold = True
+            if answer.get('text'):
+                document.add_paragraph(str(answer['text']))
+            if answer.get('photos'):
+                _add_photos(document, answer['photos'], thumbs)
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    document.save(tmp_path)
+    os.replace(tmp_path, output_path)
+    return output_path
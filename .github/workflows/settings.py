@@ -0,0 +1,34 @@
+"""
+Constantes et identifiants partagés par app.py et les scripts en ligne de commande
+(export_form_answers.py, generate_reports.py). Module sans Streamlit.
+"""
+from firebase_admin import credentials
+from google.auth.credentials import AnonymousCredentials
+
+# --- LOGIQUE DE RENOMMAGE ET D'AFFICHAGE DU PROJET ---
+
+PROJECT_RENAME_MAP = {
+    'Intitulé': 'Intitulé',
+    'Fournisseur Bornes AC [Bornes]': 'Fournisseur Bornes AC',
+    'Fournisseur Bornes DC [Bornes]': 'Fournisseur Bornes DC',
+    'L [Plan de Déploiement]': 'PDC Lent',
+    'R [Plan de Déploiement]': 'PDC Rapide',
+    'UR [Plan de Déploiement]': 'PDC Ultra-rapide',
+    'Pré L [Plan de Déploiement]': 'PDC L pré-équipés',
+    'Pré R [Plan de Déploiement]': 'PDC R pré-équipés',
+    'Pré UR [Plan de Déploiement]': 'PDC UR pré-équipés',
+}
+
+DISPLAY_GROUPS = [
+    ['Intitulé', 'Fournisseur Bornes AC [Bornes]', 'Fournisseur Bornes DC [Bornes]'],
+    ['L [Plan de Déploiement]', 'R [Plan de Déploiement]', 'UR [Plan de Déploiement]'],
+    ['Pré L [Plan de Déploiement]', 'Pré R [Plan de Déploiement]', 'Pré UR [Plan de Déploiement]'],
+]
+
+# --- ÉMULATEUR FIRESTORE ---
+
+class EmulatorCredential(credentials.Base):
+    """Identifiants anonymes pour l'émulateur Firestore (aucun compte de service nécessaire)."""
+
+    def get_credential(self):
+        return AnonymousCredentials()